@@ -0,0 +1,132 @@
+"""
+Benchmarks the fetch → aggregate → render → publish pipeline against a local
+stand-in for the eco-visio API, for every combination of the given numbers of
+counters, years of history and intervals, e.g.
+
+    python -m benchmarks --counters 4 16 --years 2 5 --intervals days months --output results.json
+
+Results are written as JSON. Two result files can be compared with
+
+    python -m benchmarks --compare baseline.json results.json
+"""
+import os
+import sys
+import json
+import logging
+import platform
+import tempfile
+import subprocess
+
+from datetime import datetime
+from itertools import product
+from argparse import ArgumentParser, Namespace
+
+logger = logging.getLogger("benchmarks")
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(prog="benchmarks", description=__doc__.splitlines()[1])
+    parser.add_argument("--counters", type=int, nargs="+", default=[4], help="numbers of counters to benchmark with, at least 3")
+    parser.add_argument("--years", type=int, nargs="+", default=[2], help="numbers of whole years of history before the current one, at least 1")
+    parser.add_argument("--intervals", nargs="+", choices=["quarter_hours", "hours", "days", "weeks", "months"], default=["days"], help="intervals to aggregate the history at")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per scenario; the median is reported")
+    parser.add_argument("--output", help="file to write the results to instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"), help="compare two result files instead of benchmarking")
+    parser.add_argument("--threshold", type=float, default=10, help="percentage by which a time or peak memory has to grow to count as a regression")
+    args = parser.parse_args()
+
+    # The published message ranks the top 3 counters and compares with the preceding year
+    if min(args.counters) < 3 or min(args.years) < 1:
+        parser.error("benchmarks need at least 3 counters and 1 year of history")
+
+    return args
+
+def get_revision() -> str or None:
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def get_comparable_values(results: dict) -> dict[str, float]:
+    """Flattens results into {"4 counters/2 years/days/publish_cold/render": seconds, ...}."""
+    values = {}
+
+    for case in results["cases"]:
+        case_name = f"{case['counters']} counters/{case['years']} years/{case['interval']}"
+
+        for scenario_name, scenario in case["scenarios"].items():
+            values[f"{case_name}/{scenario_name}/wall"] = scenario["wall_seconds"]
+            values[f"{case_name}/{scenario_name}/peak_memory"] = scenario["peak_memory_bytes"]
+            values[f"{case_name}/{scenario_name}/requests"] = scenario["requests"]
+
+            for stage_name, stage in scenario["stages"].items():
+                values[f"{case_name}/{scenario_name}/{stage_name}"] = stage["seconds"]
+
+    return values
+
+def compare(baseline_file: str, results_file: str, threshold: float) -> bool:
+    """Logs every value that changed by more than threshold percent between two result files. Returns False if any of them regressed by more than threshold percent."""
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = get_comparable_values(json.load(f))
+
+    with open(results_file, encoding="utf-8") as f:
+        results = get_comparable_values(json.load(f))
+
+    regressions = 0
+
+    for name in sorted(baseline.keys() & results.keys()):
+        before, after = baseline[name], results[name]
+        change = (after - before) / before * 100 if before else 0
+        regressed = change > threshold
+
+        regressions += regressed
+
+        if abs(change) > threshold:
+            logger.info(f"{'REGRESSED' if regressed else 'improved'} {name}: {before:.4g} -> {after:.4g} ({change:+.1f}%)")
+
+    logger.info(f"{regressions} regressions above {threshold}% between {baseline_file} and {results_file}")
+
+    return regressions == 0
+
+def run() -> None:
+    args = parse_args()
+
+    logging.basicConfig(encoding="utf-8", level=logging.INFO, format="%(message)s")
+    # The pipeline logs every tweet it assembles
+    logging.getLogger("eco_counter_bot").setLevel(logging.WARNING)
+
+    if args.compare:
+        sys.exit(0 if compare(*args.compare, args.threshold) else 1)
+
+    # The count store is read from the environment on first use, so it has to be pointed at a scratch file first
+    os.environ["COUNT_STORE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="eco-counter-benchmark-"), "counts.sqlite")
+
+    # Tweets go to a stub, but the sink still wants its credentials to be set
+    for name in ("TWITTER_API_KEY", "TWITTER_API_SECRET", "TWITTER_ACCESS_TOKEN", "TWITTER_ACCESS_SECRET"):
+        os.environ.setdefault(f"BENCHMARK_{name}", "benchmark")
+
+    from eco_counter_bot.models import Interval
+    from benchmarks.pipeline import run_case, warm_up
+
+    started_at = datetime.now()
+    warm_up()
+
+    results = {
+        "revision": get_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started_at": started_at.isoformat(timespec="seconds"),
+        "repeat": args.repeat,
+        "cases": [
+            run_case(counters, years, Interval[interval.upper()], args.repeat)
+            for counters, years, interval in product(args.counters, args.years, args.intervals)
+        ],
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+        logger.info(f"Wrote results to {args.output}")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+if __name__ == "__main__":
+    run()
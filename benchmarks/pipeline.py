@@ -0,0 +1,217 @@
+import time
+import logging
+import threading
+import tracemalloc
+
+from string import Template
+from types import SimpleNamespace
+from statistics import median
+from functools import wraps
+from unittest import mock
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from datetime import date, timedelta
+from typing import Callable
+
+from eco_counter_bot import bot, counter_service, grapher, reports, publisher, sinks
+from eco_counter_bot.count_store import get_count_store
+from eco_counter_bot.models import CounterConfig, DateRange, Interval, PeriodQuery, SinkConfig, TenantConfig
+
+from benchmarks.stand_in_server import StandInServer, installed_years_ago
+
+logger = logging.getLogger(__name__)
+
+class StageTimer:
+    """
+    Adds up the time spent in each pipeline stage. Stages that run on several
+    threads at once (fetch) add up across threads, so they can exceed the
+    wall time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def wrap(self, stage: str, function: Callable) -> Callable:
+        @wraps(function)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.seconds[stage] += time.perf_counter() - started
+                    self.calls[stage] += 1
+
+        return timed
+
+class StubTweetSink:
+    """Takes the place of the tweet service and keeps what would have been published."""
+
+    def __init__(self):
+        self.published = []
+        self.media = {}
+
+    def upload_media(self, filename, image=None) -> SimpleNamespace:
+        media_id = f"BENCHMARK_MEDIA_ID_{len(self.media)}"
+        self.media[media_id] = image
+        return SimpleNamespace(media_id=media_id)
+
+    def post(self, text: str, media_ids: list[str] or None = None, reply_to: str or None = None) -> str:
+        self.published.append((text, [self.media[media_id] for media_id in media_ids or []]))
+        return f"BENCHMARK_TWEET_ID_{len(self.published)}"
+
+# Stage name, and the object and attribute the stage's work is looked up through
+STAGES = [
+    ("load", reports, "get_counts_for_periods"),
+    ("fetch", counter_service, "get_counts"),
+    ("store_read", get_count_store, "get_counts"),
+    ("store_write", get_count_store, "put_counts"),
+    ("aggregate", counter_service, "resolve_query"),
+    ("flatten", counter_service, "flatten"),
+    # The chart totals call the copy reports imported
+    ("flatten", reports, "flatten"),
+    ("totals", get_count_store, "get_period_total"),
+    ("render", reports, "generate_yearly_plot"),
+]
+
+@contextmanager
+def instrument(timer: StageTimer, sink: StubTweetSink):
+    """Times every stage and routes publishing to the stub sink for the duration of the block."""
+    with ExitStack() as stack:
+        for stage, target, attribute in STAGES:
+            # The store is only opened on first use
+            target = target() if target is get_count_store else target
+            stack.enter_context(mock.patch.object(target, attribute, timer.wrap(stage, getattr(target, attribute))))
+
+        stack.enter_context(mock.patch.object(sink, "upload_media", timer.wrap("upload", sink.upload_media)))
+        stack.enter_context(mock.patch.object(sink, "post", timer.wrap("publish", sink.post)))
+        stack.enter_context(mock.patch.object(sinks, "get_tweet_service", lambda credentials_prefix="", timeout_seconds=None: sink))
+
+        yield
+
+def make_tenant(server: StandInServer, counters: int) -> TenantConfig:
+    return TenantConfig(
+        id="benchmark",
+        chart_title="Benchmark bike counts",
+        locale="lb_LU",
+        tweet_template=None,
+        credentials_prefix="BENCHMARK_",
+        sinks=[SinkConfig(type="twitter")],
+        data_quality_policy="report",
+        counters=[
+            CounterConfig(id=f"benchmark/{index}", name=f"Counter {index}", url_template=Template(server.url_template(index)))
+            for index in range(counters)
+        ]
+    )
+
+def clear_count_store() -> None:
+    get_count_store().write([(f"DELETE FROM {table}", [()]) for table in ("counts", "intraday_counts", "rollups", "backfill_checkpoints", "publications", "outbox")])
+    grapher.render_cache.clear()
+
+def clear_outputs() -> None:
+    """Forgets what was rendered and published, so the next run goes all the way again."""
+    get_count_store().write([("DELETE FROM publications", [()]), ("DELETE FROM outbox", [()])])
+    grapher.render_cache.clear()
+
+def publish(tenant: TenantConfig, installed_on: date, interval: Interval) -> None:
+    bot.publish_yesterdays_results(tenant)
+    publisher.publisher.drain()
+
+def load_history(tenant: TenantConfig, installed_on: date, interval: Interval) -> None:
+    history = DateRange(start=installed_on, end=date.today() - timedelta(days=1))
+    counter_service.get_counts_for_periods(tenant["counters"], [PeriodQuery(period=history, interval=interval)])
+
+# Scenario name, how to prepare for it and what to run, in the order they run in
+SCENARIOS = [
+    # Everything is fetched, stored and rendered from scratch
+    ("publish_cold", clear_count_store, publish),
+    # The counts are already stored, as on every run after the first one
+    ("publish_warm", clear_outputs, publish),
+    # All years of every counter are loaded and aggregated at the given interval
+    ("history", clear_count_store, load_history),
+]
+
+def run_scenario(server: StandInServer, tenant: TenantConfig, run: Callable, installed_on: date, interval: Interval) -> dict:
+    timer = StageTimer()
+    sink = StubTweetSink()
+    server.reset_stats()
+
+    with instrument(timer, sink):
+        started = time.perf_counter()
+        run(tenant, installed_on, interval)
+        wall_seconds = time.perf_counter() - started
+
+    if run is publish and not sink.published:
+        raise RuntimeError("The pipeline did not publish anything, see the log for the error")
+
+    return {
+        "wall_seconds": wall_seconds,
+        "stage_seconds": dict(timer.seconds),
+        "stage_calls": dict(timer.calls),
+        "requests": server.requests,
+        "response_bytes": server.response_bytes,
+    }
+
+def measure_peak_memory(tenant: TenantConfig, run: Callable, installed_on: date, interval: Interval) -> int:
+    """Runs once more under tracemalloc, which slows everything down too much to time the same run."""
+    tracemalloc.start()
+
+    try:
+        with instrument(StageTimer(), StubTweetSink()):
+            run(tenant, installed_on, interval)
+
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def summarize(runs: list[dict], peak_memory_bytes: int) -> dict:
+    stages = sorted({stage for run in runs for stage in run["stage_calls"]})
+
+    return {
+        "wall_seconds": median(run["wall_seconds"] for run in runs),
+        "wall_seconds_min": min(run["wall_seconds"] for run in runs),
+        "stages": {
+            stage: {
+                "seconds": median(run["stage_seconds"].get(stage, 0) for run in runs),
+                "calls": runs[0]["stage_calls"].get(stage, 0),
+            }
+            for stage in stages
+        },
+        "requests": runs[0]["requests"],
+        "response_bytes": runs[0]["response_bytes"],
+        "peak_memory_bytes": peak_memory_bytes,
+    }
+
+def run_case(counters: int, years: int, interval: Interval, repeat: int) -> dict:
+    """Benchmarks every scenario for `counters` counters with `years` whole years of history, `repeat` times each."""
+    installed_on = installed_years_ago(years)
+    scenario_runs = defaultdict(list)
+    peak_memory = {}
+
+    logger.info(f"Benchmarking {counters} counters with {years} years of history at interval {interval.name.lower()}")
+
+    with StandInServer(installed_on) as server:
+        tenant = make_tenant(server, counters)
+
+        for _ in range(repeat):
+            for name, prepare, run in SCENARIOS:
+                prepare()
+                scenario_runs[name].append(run_scenario(server, tenant, run, installed_on, interval))
+
+        for name, prepare, run in SCENARIOS:
+            prepare()
+            peak_memory[name] = measure_peak_memory(tenant, run, installed_on, interval)
+
+    return {
+        "counters": counters,
+        "years": years,
+        "interval": interval.name.lower(),
+        "scenarios": {name: summarize(scenario_runs[name], peak_memory[name]) for name, _, _ in SCENARIOS},
+    }
+
+def warm_up() -> None:
+    """Starts the image exporter up front, so its start-up time does not end up in the first case."""
+    grapher.warm_up_renderer()
@@ -0,0 +1,147 @@
+import json
+import threading
+import numpy as np
+
+from datetime import date, datetime
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# eco-visio interval values and the datetime64 unit their buckets are truncated to
+BUCKET_UNITS = {
+    4: None,
+    5: "week",
+    6: "datetime64[M]",
+}
+
+# eco-visio sub-daily interval values and their length in minutes
+SUB_DAILY_MINUTES = {
+    2: 15,
+    3: 60,
+}
+
+# Share of a day's bikes passing in each hour, with a morning and an evening peak
+HOURLY_PROFILE = np.array([1, 0, 0, 0, 1, 2, 5, 9, 11, 6, 4, 4, 5, 5, 4, 5, 7, 10, 8, 5, 3, 3, 2, 1]) / 100
+
+def generate_daily_counts(counter_index: int, dates: np.ndarray) -> np.ndarray:
+    """Deterministic bike counts with a weekly and a yearly rhythm, different for every counter and independent of the requested range."""
+    days = dates.astype(np.int64)
+
+    # 1970-01-01 was a Thursday, i.e. weekday 3
+    weekday_factor = np.where((days + 3) % 7 >= 5, 0.6, 1.0)
+    # Lowest in mid-January, highest in mid-July
+    season_factor = 1 - 0.6 * np.cos((days - 15) / 365.25 * 2 * np.pi)
+    noise = (days * 2654435761 + counter_index * 40503) % 200
+
+    return (400 + 150 * (counter_index % 7)) * season_factor * weekday_factor + noise
+
+def spread_over_day(dates: np.ndarray, counts: np.ndarray, minutes: int) -> tuple[np.ndarray, np.ndarray]:
+    """Splits daily counts into intervals of the given minutes, following HOURLY_PROFILE."""
+    per_hour = 60 // minutes
+    shares = np.repeat(HOURLY_PROFILE / per_hour, per_hour)
+
+    timestamps = (dates.astype("datetime64[m]")[:, None] + np.arange(len(shares)) * minutes).ravel()
+
+    return timestamps, np.round(counts[:, None] * shares).ravel()
+
+def bucket_counts(dates: np.ndarray, counts: np.ndarray, interval: int) -> tuple[np.ndarray, np.ndarray]:
+    unit = BUCKET_UNITS[interval]
+
+    if unit is None or not len(dates):
+        return dates, counts
+
+    bucket_starts = dates - (dates.astype(np.int64) + 3) % 7 if unit == "week" else dates.astype(unit).astype("datetime64[D]")
+    buckets, bucket_indices = np.unique(bucket_starts, return_inverse=True)
+
+    return buckets, np.bincount(bucket_indices, weights=counts)
+
+class StandInServer:
+    """
+    A local stand-in for the eco-visio counting API. Serves synthetic counts
+    for any counter index, from `installed_on` up to yesterday, in the
+    [["mm/dd/yyyy", "n"], ...] format of the real API, and keeps track of how
+    many requests and response bytes it served.
+    """
+
+    def __init__(self, installed_on: date):
+        self.installed_on = np.datetime64(installed_on, "D")
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.response_bytes = 0
+        self.http_server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.http_server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.http_server.server_address
+        return f"http://{host}:{port}"
+
+    def url_template(self, counter_index: int) -> str:
+        return f"{self.url}/counters/{counter_index}?begin=$start_date&end=$end_date&interval=$interval"
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.requests = 0
+            self.response_bytes = 0
+
+    def render_counts(self, counter_index: int, start_date: date, end_date: date, interval: int) -> bytes:
+        first_day = max(np.datetime64(start_date, "D"), self.installed_on)
+        # The API's end date is exclusive, and today is never complete
+        last_day = min(np.datetime64(end_date, "D"), np.datetime64(date.today(), "D"))
+
+        dates = np.arange(first_day, last_day, dtype="datetime64[D]")
+        counts = generate_daily_counts(counter_index, dates)
+
+        if interval in SUB_DAILY_MINUTES:
+            dates, counts = spread_over_day(dates, counts, SUB_DAILY_MINUTES[interval])
+            date_format = "%m/%d/%Y %H:%M"
+        else:
+            dates, counts = bucket_counts(dates, counts, interval)
+            date_format = "%m/%d/%Y"
+
+        return json.dumps([
+            [timestamp.strftime(date_format), str(int(count))]
+            for timestamp, count in zip(dates.tolist(), counts.tolist())
+        ]).encode()
+
+    def make_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                parameters = {name: values[0] for name, values in parse_qs(url.query).items()}
+
+                body = server.render_counts(
+                    int(url.path.rsplit("/", 1)[-1]),
+                    datetime.strptime(parameters["begin"], "%d/%m/%Y").date(),
+                    datetime.strptime(parameters["end"], "%d/%m/%Y").date(),
+                    int(parameters["interval"])
+                )
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+                with server.lock:
+                    server.requests += 1
+                    server.response_bytes += len(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self) -> "StandInServer":
+        threading.Thread(target=self.http_server.serve_forever, daemon=True, name="stand-in-server").start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+def installed_years_ago(years: int) -> date:
+    """The 1st of January `years` years before the current one, so the counters cover whole years plus this one."""
+    return date(date.today().year - years, 1, 1)
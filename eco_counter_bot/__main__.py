@@ -1,17 +1,66 @@
 import logging
 
-from datetime import datetime
+from argparse import ArgumentParser, Namespace
+from datetime import date, datetime, timedelta
 
 from eco_counter_bot.config import config
-from eco_counter_bot.bot import publish_yesterdays_results
+from eco_counter_bot.utils import today
+from eco_counter_bot.models import Interval, ReportType
+from eco_counter_bot.tenants import load_tenants
+from eco_counter_bot.bot import publish_all_tenants
+from eco_counter_bot.backfill import backfill
+from eco_counter_bot.reports import generate_reports, get_reference_dates, write_reports
+from eco_counter_bot.daemon import run_daemon
+from eco_counter_bot.startup_profiler import profile_startup
+from eco_counter_bot.metrics import metrics
 
 logging.basicConfig(encoding='utf-8')
 logger = logging.getLogger(f"eco_counter_bot")
 logger.setLevel(config.get("LOG_LEVEL", "INFO"))
 
+def parse_args() -> Namespace:
+    parser = ArgumentParser(prog="eco_counter_bot", description="Publishes yesterday's bike counts")
+    parser.add_argument("--dev", action="store_true", help="use the dev configuration and do not tweet")
+    parser.add_argument("--backfill", action="store_true", help="import the full history of every counter into the count store instead of publishing")
+    parser.add_argument("--report", choices=[report_type.value for report_type in ReportType], help="write the reports of this type for every period ending between --since and --until to --output-dir instead of publishing")
+    parser.add_argument("--since", type=date.fromisoformat, help="first day to backfill or report on (YYYY-MM-DD), defaults to each counter's installation for backfills and to --until for reports")
+    parser.add_argument("--until", type=date.fromisoformat, help="last day to report on (YYYY-MM-DD), defaults to yesterday")
+    parser.add_argument("--output-dir", default="reports", help="directory to write reports to")
+    parser.add_argument("--interval", choices=[interval.name.lower() for interval in Interval], default="days", help="interval to backfill")
+    parser.add_argument("--daemon", action="store_true", help="stay resident and publish every day on an internal schedule")
+    parser.add_argument("--force", action="store_true", help="publish even if yesterday's results were already published")
+    parser.add_argument("--profile-startup", action="store_true", help="report how long each code path spends importing, then exit")
+    return parser.parse_args()
+
 def run() -> None:
+    args = parse_args()
+
+    if args.profile_startup:
+        profile_startup()
+        return
+
     logger.info(f"eco_counter_bot started at {datetime.now()}")
-    publish_yesterdays_results()
+
+    tenants = load_tenants()
+
+    try:
+        if args.backfill:
+            backfill([counter for tenant in tenants for counter in tenant["counters"]], Interval[args.interval.upper()], args.since)
+        elif args.report:
+            report_type = ReportType(args.report)
+            until = args.until or today() - timedelta(days=1)
+            reference_dates = get_reference_dates(report_type, args.since or until, until)
+
+            for tenant in tenants:
+                write_reports(generate_reports(tenant, report_type, reference_dates), args.output_dir)
+        elif args.daemon:
+            run_daemon(tenants)
+        else:
+            publish_all_tenants(tenants, args.force)
+    finally:
+        metrics.log_summary()
+        metrics.write_report()
+
     logger.info(f"Run finished at {datetime.now()}")
 
 if __name__ == "__main__":
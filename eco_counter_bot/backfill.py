@@ -0,0 +1,104 @@
+import logging
+
+from itertools import islice
+from typing import Iterator
+from datetime import date, timedelta
+
+from eco_counter_bot.config import config
+from eco_counter_bot.utils import RateLimiter, today
+from eco_counter_bot.models import CounterConfig, CounterData, DateRange, Interval
+from eco_counter_bot.counter_api import MAX_CONNECTIONS, EcoCounterApiError, get_counts
+from eco_counter_bot.counter_service import fetch_executor
+from eco_counter_bot.count_store import get_count_store
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+# Lower bound when looking for the installation date of a counter
+EARLIEST_DATE = date(2000, 1, 1)
+
+def get_chunk_boundary(index: int, interval: Interval, chunk_days: int) -> date:
+    """Returns the start of the index-th chunk of chunk_days from EARLIEST_DATE, moved back to an interval boundary."""
+    return CounterData(EARLIEST_DATE + timedelta(days=index * chunk_days), interval, []).start.astype("datetime64[D]").item()
+
+def iterate_chunks(start_date: date, end_date: date, interval: Interval, chunk_days: int) -> Iterator[DateRange]:
+    """
+    Yields chunks of about chunk_days covering the range, newest first. The
+    chunks lie on a fixed grid counted from EARLIEST_DATE, so they stay the
+    same from one day to the next and a resumed import finds the checkpoints
+    of an earlier one. Only the newest and oldest chunks are clipped to the range.
+    """
+    index = (end_date - EARLIEST_DATE).days // chunk_days + 1
+
+    while get_chunk_boundary(index, interval, chunk_days) > end_date:
+        index -= 1
+
+    chunk_end = end_date
+
+    while chunk_end >= start_date:
+        chunk_start = max(get_chunk_boundary(index, interval, chunk_days), start_date)
+        yield DateRange(start=chunk_start, end=chunk_end)
+        chunk_end = chunk_start - timedelta(days=1)
+        index -= 1
+
+def backfill(counters: list[CounterConfig], interval: Interval = Interval.DAYS, since: date or None = None, until: date or None = None) -> None:
+    """
+    Imports the history of every counter into the count store, walking back
+    from `until` (yesterday by default) in chunks. Chunks run in parallel
+    waves within a request rate limit, and each imported chunk is
+    checkpointed so an interrupted import resumes where it stopped.
+
+    Without `since`, a counter's import stops at the first wave that returns
+    no data at all, which is taken as its installation date.
+    """
+    until = until or today() - timedelta(days=1)
+    chunk_days = int(config.get("BACKFILL_CHUNK_DAYS", 92))
+    rate_limiter = RateLimiter(float(config.get("BACKFILL_REQUESTS_PER_SECOND", 2)))
+
+    def import_chunk(counter: CounterConfig, chunk: DateRange) -> CounterData:
+        rate_limiter.wait()
+        return get_counts(counter, chunk["start"], chunk["end"], interval)
+
+    remaining_chunks = {counter["id"]: iterate_chunks(since or EARLIEST_DATE, until, interval, chunk_days) for counter in counters}
+    active_counters = list(counters)
+
+    logger.info(f"Backfilling {interval} counts of {len(counters)} counters up to {until}")
+
+    while active_counters:
+        wave = []
+        wave_data_points = {counter["id"]: 0 for counter in active_counters}
+        wave_failed = set()
+
+        for counter in active_counters:
+            for chunk in islice(remaining_chunks[counter["id"]], MAX_CONNECTIONS):
+                checkpoint = get_count_store().get_backfill_checkpoint(counter["id"], interval, chunk)
+
+                if checkpoint is not None:
+                    wave_data_points[counter["id"]] += checkpoint
+                    wave.append((counter, chunk, None))
+                else:
+                    wave.append((counter, chunk, fetch_executor.submit(import_chunk, counter, chunk)))
+
+        for counter, chunk, future in wave:
+            if future is None:
+                continue
+
+            try:
+                counter_data = future.result()
+            except EcoCounterApiError as e:
+                logger.error(f"Could not import chunk {chunk} of counter {counter['id']}, it will be retried on the next run: {e}")
+                wave_failed.add(counter["id"])
+                continue
+
+            get_count_store().put_counts(counter["id"], chunk, counter_data)
+            get_count_store().put_backfill_checkpoint(counter["id"], interval, chunk, len(counter_data))
+            wave_data_points[counter["id"]] += len(counter_data)
+
+        counters_in_wave = {counter["id"] for counter, _, _ in wave}
+
+        for counter in list(active_counters):
+            counter_id = counter["id"]
+            before_installation = since is None and wave_data_points[counter_id] == 0 and counter_id not in wave_failed
+
+            if counter_id not in counters_in_wave or before_installation:
+                logger.info(f"Finished backfilling counter {counter_id}")
+                active_counters.remove(counter)
@@ -1,145 +1,197 @@
+import time
 import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+from eco_counter_bot.config import config
+from eco_counter_bot.utils import content_hash, today
+from eco_counter_bot.tenants import DEFAULT_TENANT, MIN_COUNTERS
+from eco_counter_bot.models import CounterConfig, DateRange, OutboxEntry, Publication, ReportType, TenantConfig
+from eco_counter_bot.counter_service import NoDataFoundException, DataNotReadyException
+from eco_counter_bot.count_store import get_count_store
+from eco_counter_bot.metrics import metrics
+from eco_counter_bot.sinks import create_sinks
+from eco_counter_bot.publisher import MAX_ATTEMPTS, is_parked, publisher
+from eco_counter_bot.data_quality import QualityCheck, get_policy, report_quality
+from eco_counter_bot.grapher import warm_up_renderer
+from eco_counter_bot.reports import ReportDataset, compose_report, get_dataset_range, render_report
 
-from string import Template
-from datetime import date, timedelta
-from dateutil.relativedelta import relativedelta
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
 
-from eco_counter_bot.utils import format_number_lb
-from eco_counter_bot.counters import counters as all_counters
-from eco_counter_bot.models import CounterData, DataPoint, DateRange, Interval, YesterdaysResultsTweetParams
-from eco_counter_bot.counter_service import NoDataFoundException, get_counts_for_period, extract_highlights
-from eco_counter_bot.tweet_service import tweet_service
-from eco_counter_bot.grapher import generate_yearly_plot
-from eco_counter_bot.emojis import EMOJIS
+def get_dataset_when_ready(tenant: TenantConfig, period: DateRange, day: date) -> ReportDataset:
+    """
+    Loads the tenant's counts over period once every counter has a plausible
+    count for day. With POLL_UNTIL_READY_MINUTES set, incomplete data is
+    fetched again every POLL_INTERVAL_MINUTES until then, otherwise it fails
+    straight away.
 
-logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+    The counts are checked for gaps, zero runs, repeated dates and outliers
+    first. Under the "report" policy, only counters without a count for day
+    hold the post up. Under the others, so do counters whose count looks
+    wrong; once polling gives up, "impute" fills in their expected counts,
+    "exclude" leaves them out, and "delay" does not post.
+    """
+    poll_seconds = float(config.get("POLL_UNTIL_READY_MINUTES", 0)) * 60
+    poll_interval_seconds = float(config.get("POLL_INTERVAL_MINUTES", 15)) * 60
+    give_up_at = time.monotonic() + poll_seconds
+    policy = get_policy(tenant)
 
-TWEET_TEMPLATE = Template(f"""Yesterday's {EMOJIS['BICYCLE']} counts ($yesterdays_date):
+    while True:
+        dataset = ReportDataset.load(tenant, period)
 
-{EMOJIS['CHECKERED_FLAG']} Total: $count_total
+        with metrics.span("check_data_quality", tenant=tenant["id"]):
+            quality_check = QualityCheck(dataset.counters_with_counts, day)
 
-Top 3:
-{EMOJIS['MEDAL_1']} $counter_name_1: $counter_count_1
-{EMOJIS['MEDAL_2']} $counter_name_2: $counter_count_2
-{EMOJIS['MEDAL_3']} $counter_name_3: $counter_count_3
+        bad_counters = quality_check.get_counters(("missing",) if policy == "report" else ("missing", "suspect"))
 
-$year_reference year's total: $count_current_year_total
-Preceding year's total: $count_preceding_year_total
-Preceding year's relative total: $count_preceding_year_relative_total
-Change: $percentage_change_emoji $percentage_change_number%
+        if not bad_counters:
+            report_quality(tenant, quality_check)
+            return dataset
 
-$more_or_missing_text
-""")
+        bad_names = ", ".join(counter["name"] for counter in bad_counters)
 
-MORE_TEXT = Template(f"$more more than last year's total! {EMOJIS['PARTY']}")
-MISSING_TEXT = Template(f"$missing missing compared to last year's total!")
+        if time.monotonic() + poll_interval_seconds > give_up_at:
+            report_quality(tenant, quality_check)
+            return apply_quality_policy(dataset, quality_check, policy, bad_counters)
 
-def is_current_week(reference_date: date) -> bool:
-    reference_date_week = reference_date.isocalendar().week
-    todays_date_week = date.today().isocalendar().week
-    return reference_date_week == todays_date_week
+        logger.info(f"No plausible counts for {day} yet from {bad_names}, checking again in {poll_interval_seconds / 60:g} minutes")
+        time.sleep(poll_interval_seconds)
 
-def is_current_year(reference_date: date) -> bool:
-    return reference_date.year == date.today().year
+def apply_quality_policy(dataset: ReportDataset, quality_check: QualityCheck, policy: str, bad_counters: list[CounterConfig]) -> ReportDataset:
+    bad_names = ", ".join(counter["name"] for counter in bad_counters)
 
-def to_daily_total(counter_data: CounterData) -> CounterData:
-    summed = [counter_data[0]]
+    if policy == "exclude" and len(dataset.counter_ids) - len(bad_counters) >= MIN_COUNTERS:
+        logger.warning(f"Leaving {bad_names} out of the post for {quality_check.day}")
+        metrics.increment("data_quality_excluded_counters", len(bad_counters), tenant=dataset.tenant["id"])
+        return dataset.without_counters(bad_counters)
 
-    for index, current_count in enumerate(counter_data):
-        if index > 0:
-            dp = DataPoint(
-                date=current_count["date"],
-                count=(summed[index-1]["count"] + current_count["count"])
-            )
+    if policy == "impute" and quality_check.can_impute(bad_counters):
+        logger.warning(f"Posting expected counts for {quality_check.day} in place of those of {bad_names}")
+        metrics.increment("data_quality_imputed_counters", len(bad_counters), tenant=dataset.tenant["id"])
+        return dataset.with_counts(quality_check.impute())
 
-            summed.append(dp)
+    raise DataNotReadyException(f"No plausible counts for {quality_check.day} yet from {bad_names}")
 
-    return summed
+def log_previous_publication(tenant: TenantConfig, publication: Publication, day: date, current_day: date) -> None:
+    """Tells whether the counts of a day that was already published changed since, without waiting for them to be complete."""
+    try:
+        draft = compose_report(ReportDataset.load(tenant, get_dataset_range([day])), ReportType.DAILY, day, current_day)
+    except Exception as e:
+        logger.info(f"Counts of {day} for tenant {tenant['id']} were already published at {publication['published_at']}, skipping ({e})")
+        return
 
-def publish_yesterdays_results() -> None:
-    today = date.today()
-    yesterday = today - timedelta(days=1)
+    if publication["input_hash"] == draft["input_hash"]:
+        logger.info(f"Counts of {day} for tenant {tenant['id']} were already published at {publication['published_at']}, skipping")
+    else:
+        logger.warning(f"Counts of {day} for tenant {tenant['id']} changed since they were published at {publication['published_at']}, not publishing again without --force")
+
+def publish_yesterdays_results(tenant: TenantConfig = DEFAULT_TENANT, force: bool = False) -> None:
+    """
+    Queues the post of yesterday's counts for each of the tenant's sinks,
+    unless the day was already published (without force) or queued, or the
+    post is identical to an earlier one. publisher.drain() waits for it.
+    """
+    current_day = today()
+    yesterday = current_day - timedelta(days=1)
+    logger.debug(f"Yesterday's date is {yesterday}")
 
-    current_week = DateRange(
-        start=yesterday - timedelta(days=yesterday.weekday()),
-        end=yesterday
-    )
+    previous_publication = None if force else get_count_store().get_publication(tenant["id"], yesterday)
 
-    current_year_relative = DateRange(
-        start=yesterday.replace(month=1, day=1),
-        end=yesterday
-    )
+    if previous_publication:
+        log_previous_publication(tenant, previous_publication, yesterday, current_day)
+        metrics.increment("publications_skipped", reason="already_published")
+        return
 
-    preceding_year_relative = DateRange(
-        start=yesterday.replace(year=yesterday.year - 1, month=1, day=1),
-        end=yesterday + relativedelta(years=-1)
-    )
+    sinks = create_sinks(tenant)
 
-    preceding_year_full = DateRange(
-        start=yesterday.replace(year=yesterday.year - 1, month=1, day=1),
-        end=yesterday.replace(year=yesterday.year - 1, month=12, day=31)
-    )
+    # Start the image exporter and e.g. authenticate with Twitter while the counts are being fetched
+    threading.Thread(target=warm_up_renderer, daemon=True).start()
+    for sink in sinks:
+        publisher.warm_up(sink)
 
     try:
         logger.debug("Attempting to get highlights")
-        current_week_counts = get_counts_for_period(all_counters, current_week, Interval.DAYS)
-        current_year_counts = get_counts_for_period(all_counters, current_year_relative, Interval.DAYS)
-        preceding_year_relative_counts = get_counts_for_period(all_counters, preceding_year_relative, Interval.MONTHS)
-        preceding_year_full_counts = get_counts_for_period(all_counters, preceding_year_full, Interval.DAYS)
-
-        current_week_highlights = extract_highlights(current_week_counts)
-        current_year_highlights = extract_highlights(current_year_counts)
-        preceding_year_relative_highlights = extract_highlights(preceding_year_relative_counts)
-        preceding_year_full_highlights = extract_highlights(preceding_year_full_counts)
+        dataset = get_dataset_when_ready(tenant, get_dataset_range([yesterday]), yesterday)
+        draft = compose_report(dataset, ReportType.DAILY, yesterday, current_day)
     except NoDataFoundException as e:
         logger.warning(e, exc_info=True)
         return
+    except DataNotReadyException as e:
+        logger.warning(f"Not publishing for tenant {tenant['id']}: {e}")
+        metrics.increment("publications_skipped", reason="not_ready")
+        return
     except Exception as e:
-        logger.error(f"Encountered unexpected error, aborting. {e}", exc_info=True)
+        logger.error(f"Encountered unexpected error for tenant {tenant['id']}, aborting. {e}", exc_info=True)
         return
 
-    logger.debug(f"Yesterday's date is {yesterday}")
+    queued_entries = get_count_store().get_outbox_entries(tenant["id"], yesterday)
+
+    if any(is_parked(entry) for entry in queued_entries):
+        logger.error(f"Post of {yesterday} for tenant {tenant['id']} is parked in the outbox after failing {MAX_ATTEMPTS} times, remove it there to post the day again")
+        metrics.increment("publications_skipped", reason="parked")
+        return
 
-    percentage_change = (current_year_highlights["period_total_count"] - preceding_year_relative_highlights["period_total_count"]) / preceding_year_relative_highlights["period_total_count"] * 100
+    if queued_entries:
+        logger.info(f"Post of {yesterday} for tenant {tenant['id']} is already in the outbox since {queued_entries[0]['created_at']}, leaving it to be resumed")
+        metrics.increment("publications_skipped", reason="queued")
+        return
 
-    yesterdays_ordered_counts = current_week_highlights["most_recent_counts_sorted"]
+    logger.info(f"Assembled tweet message: {draft['text']}")
 
-    excess_compared_to_last_year = current_year_highlights["period_total_count"] - preceding_year_full_highlights["period_total_count"]
+    report = render_report(draft)
 
-    more_or_missing_text = MORE_TEXT.substitute({ "more": format_number_lb(excess_compared_to_last_year) }) \
-        if excess_compared_to_last_year >= 0 else MISSING_TEXT.substitute({ "missing": format_number_lb(abs(excess_compared_to_last_year)) })
+    output_hash = content_hash(report["text"], report["image"])
+    identical_publication = get_count_store().find_publication_by_output(tenant["id"], output_hash)
 
-    tweet_template_params = YesterdaysResultsTweetParams(
-        yesterdays_date = yesterday.strftime("%d/%m"),
-        count_total = format_number_lb(current_week_highlights["most_recent_flattened_count"]),
-        counter_name_1 = yesterdays_ordered_counts[0]["counter"]["name"],
-        counter_name_2 = yesterdays_ordered_counts[1]["counter"]["name"],
-        counter_name_3 = yesterdays_ordered_counts[2]["counter"]["name"],
-        counter_count_1 = format_number_lb(yesterdays_ordered_counts[0]["count"]),
-        counter_count_2 = format_number_lb(yesterdays_ordered_counts[1]["count"]),
-        counter_count_3 = format_number_lb(yesterdays_ordered_counts[2]["count"]),
-        year_reference = "This" if is_current_year(yesterday) else "Last",
-        count_current_year_total = format_number_lb(current_year_highlights["period_total_count"]),
-        count_preceding_year_total = format_number_lb(preceding_year_full_highlights["period_total_count"]),
-        count_preceding_year_relative_total = format_number_lb(preceding_year_relative_highlights["period_total_count"]),
-        percentage_change_emoji = EMOJIS["DOWN_RIGHT_ARROW"] if percentage_change < 0 else EMOJIS["UP_RIGHT_ARROW"],
-        percentage_change_number = format_number_lb(round(percentage_change, 1)),
-        more_or_missing_text = more_or_missing_text
-    )
+    if identical_publication:
+        logger.info(f"The post for tenant {tenant['id']} is identical to the one published at {identical_publication['published_at']}, skipping")
+        metrics.increment("publications_skipped", reason="duplicate")
+        return
 
-    logger.debug(f"Assembled tweet params: {tweet_template_params}")
+    for sink in sinks:
+        publisher.enqueue(sink, OutboxEntry(
+            tenant_id=tenant["id"],
+            date=yesterday,
+            sink=sink.name,
+            input_hash=report["input_hash"],
+            output_hash=output_hash,
+            parts=sink.split(report["text"]),
+            params=report["params"],
+            media_filename="daily_fig.png",
+            image=report["image"],
+            media_id=None,
+            media_uploaded_at=None,
+            post_ids=[],
+            not_before=None,
+            attempts=0,
+            last_error=None,
+            created_at=datetime.now()
+        ))
+
+def publish_all_tenants(tenants: list[TenantConfig], force: bool = False) -> None:
+    """
+    Runs the pipeline of every tenant in its own thread, so a slow or failing
+    city does not hold up the others, after queuing the posts earlier runs
+    left in the outbox. Returns once every post was sent or left in the
+    outbox.
+    """
+    if not tenants:
+        logger.warning("No tenants to publish for")
+        return
 
-    tweet_message = TWEET_TEMPLATE.substitute(tweet_template_params)
+    publisher.resume(tenants)
 
-    logger.info(f"Assembled tweet message: {tweet_message}")
+    def publish_tenant(tenant: TenantConfig) -> None:
+        with metrics.span("publish", tenant=tenant["id"]):
+            publish_yesterdays_results(tenant, force)
 
-    preceding_year_daily_total = to_daily_total(preceding_year_full_highlights["flattened_counts"])
-    current_year_daily_total = to_daily_total(current_year_highlights["flattened_counts"])
+    with ThreadPoolExecutor(max_workers=len(tenants), thread_name_prefix="tenant") as tenant_executor:
+        futures = {tenant["id"]: tenant_executor.submit(publish_tenant, tenant) for tenant in tenants}
 
-    generate_yearly_plot(preceding_year_daily_total, current_year_daily_total)
+    for tenant_id, future in futures.items():
+        if future.exception():
+            logger.error(f"Publishing failed for tenant {tenant_id}: {future.exception()}", exc_info=future.exception())
 
-    try:
-        logger.debug("Attempting to tweet")
-        tweet_service.tweet_thread(tweet_message, media_filename="tmp/daily_fig.png")
-    except Exception as e:
-        logger.error(f"Error while tweeting: {e}", exc_info=True)
+    publisher.drain()
@@ -0,0 +1,478 @@
+import json
+import logging
+import sqlite3
+import threading
+import numpy as np
+
+from pathlib import Path
+from functools import lru_cache
+from datetime import date, datetime
+
+from eco_counter_bot.config import config
+from eco_counter_bot.utils import replacing_atomically
+from eco_counter_bot.replay import API_MODE, FIXTURES_DIR
+from eco_counter_bot.models import MISSING_COUNT, Interval, CounterData, DateRange, OutboxEntry, Publication
+from eco_counter_bot.rollups import ROLLUP_KINDS, split_period, sum_by_bucket
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS counts (
+    counter_id TEXT NOT NULL,
+    interval INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    count INTEGER,
+    PRIMARY KEY (counter_id, interval, date)
+);
+CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+    counter_id TEXT NOT NULL,
+    interval INTEGER NOT NULL,
+    start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    data_points INTEGER NOT NULL,
+    PRIMARY KEY (counter_id, interval, start_date, end_date)
+);
+CREATE TABLE IF NOT EXISTS intraday_counts (
+    counter_id TEXT NOT NULL,
+    interval INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    counts BLOB NOT NULL,
+    PRIMARY KEY (counter_id, interval, date)
+);
+CREATE TABLE IF NOT EXISTS publications (
+    tenant_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    output_hash TEXT NOT NULL,
+    post_ids TEXT NOT NULL,
+    published_at TEXT NOT NULL,
+    PRIMARY KEY (tenant_id, date)
+);
+CREATE INDEX IF NOT EXISTS publications_by_output ON publications (tenant_id, output_hash);
+CREATE TABLE IF NOT EXISTS outbox (
+    tenant_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    sink TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    output_hash TEXT NOT NULL,
+    parts TEXT NOT NULL,
+    params TEXT NOT NULL,
+    media_filename TEXT NOT NULL,
+    image BLOB,
+    media_id TEXT,
+    media_uploaded_at TEXT,
+    post_ids TEXT NOT NULL,
+    not_before TEXT,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (tenant_id, date, sink)
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    counter_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    PRIMARY KEY (counter_id, kind, bucket)
+);
+"""
+
+# Builds the rollups of daily counts that were stored before rollups existed
+REBUILD_ROLLUPS = """
+INSERT INTO rollups (counter_id, kind, bucket, total)
+SELECT counter_id, 'week', date(date, 'weekday 0', '-6 days'), SUM(count) FROM counts WHERE interval = :days AND count IS NOT NULL GROUP BY 1, 3
+UNION ALL
+SELECT counter_id, 'month', strftime('%Y-%m-01', date), SUM(count) FROM counts WHERE interval = :days AND count IS NOT NULL GROUP BY 1, 3
+UNION ALL
+SELECT counter_id, 'year', strftime('%Y-01-01', date), SUM(count) FROM counts WHERE interval = :days AND count IS NOT NULL GROUP BY 1, 3
+"""
+
+# Moves the entries of an outbox from before sinks existed, which were all posted to Twitter, into the current one
+MIGRATE_OUTBOX = """
+INSERT INTO outbox (tenant_id, date, sink, input_hash, output_hash, parts, params, media_filename, image, media_id, media_uploaded_at, post_ids, not_before, attempts, last_error, created_at)
+SELECT tenant_id, date, 'twitter', input_hash, output_hash, parts, '{}', media_filename, image, media_id, media_uploaded_at, post_ids, not_before, attempts, last_error, created_at FROM outbox_before_sinks;
+DROP TABLE outbox_before_sinks;
+"""
+
+# Sub-daily counts of a day are stored as one little-endian int32 array
+INTRADAY_DTYPE = np.dtype("<i4")
+
+MINUTES_PER_DAY = 24 * 60
+
+ADD_TO_ROLLUP = "INSERT INTO rollups (counter_id, kind, bucket, total) VALUES (?, ?, ?, ?) ON CONFLICT (counter_id, kind, bucket) DO UPDATE SET total = total + excluded.total"
+
+INSERT_PUBLICATION = "INSERT OR REPLACE INTO publications (tenant_id, date, input_hash, output_hash, post_ids, published_at) VALUES (?, ?, ?, ?, ?, ?)"
+
+OUTBOX_COLUMNS = "tenant_id, date, sink, input_hash, output_hash, parts, params, media_filename, image, media_id, media_uploaded_at, post_ids, not_before, attempts, last_error, created_at"
+
+class CountStore:
+    """
+    SQLite store of the fetched counts, their weekly, monthly and yearly
+    rollups, and what was published and is still to be sent for each tenant.
+    It is shared by all tenant pipelines, so the connection is only used
+    through query() and write(), which hold a lock.
+    """
+
+    def __init__(self, path: str):
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        logger.debug(f"Opening count store at {path}")
+
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        outbox_columns = [row[1] for row in self.connection.execute("PRAGMA table_info(outbox)")]
+
+        if outbox_columns and "sink" not in outbox_columns:
+            logger.info("Migrating the outbox to per-sink entries")
+            self.connection.execute("ALTER TABLE outbox RENAME TO outbox_before_sinks")
+            self.connection.executescript(SCHEMA + MIGRATE_OUTBOX)
+        else:
+            self.connection.executescript(SCHEMA)
+
+        self.connection.commit()
+
+        if not self.query("SELECT 1 FROM rollups LIMIT 1", ()):
+            with self.lock, self.connection:
+                self.connection.execute(REBUILD_ROLLUPS, {"days": Interval.DAYS.value})
+
+    def save_snapshot(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        with replacing_atomically(path) as temporary_path:
+            snapshot = sqlite3.connect(temporary_path)
+
+            with self.lock:
+                self.connection.backup(snapshot)
+
+            snapshot.close()
+
+    def load_snapshot(self, path: Path) -> None:
+        snapshot = sqlite3.connect(path)
+
+        with self.lock:
+            snapshot.backup(self.connection)
+
+        snapshot.close()
+
+    def query(self, sql: str, parameters: tuple) -> list[tuple]:
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def write(self, statements: list[tuple[str, list[tuple]]]) -> None:
+        """Runs every (sql, rows) statement in a single transaction."""
+        with self.lock, self.connection:
+            for sql, rows in statements:
+                self.connection.executemany(sql, rows)
+
+    def get_counts(self, counter_id: str, start_date: date, end_date: date, interval: Interval = Interval.DAYS) -> CounterData:
+        if interval.is_sub_daily:
+            return self.get_intraday_counts(counter_id, start_date, end_date, interval)
+
+        rows = self.query(
+            "SELECT date, count FROM counts WHERE counter_id = ? AND interval = ? AND date BETWEEN ? AND ? AND count IS NOT NULL ORDER BY date",
+            (counter_id, interval.value, start_date.isoformat(), end_date.isoformat())
+        )
+
+        dates, counts = zip(*rows) if rows else ((), ())
+
+        return CounterData.from_dates(dates, counts, interval)
+
+    def get_intraday_counts(self, counter_id: str, start_date: date, end_date: date, interval: Interval) -> CounterData:
+        rows = self.query(
+            "SELECT date, counts FROM intraday_counts WHERE counter_id = ? AND interval = ? AND date BETWEEN ? AND ? ORDER BY date",
+            (counter_id, interval.value, start_date.isoformat(), end_date.isoformat())
+        )
+
+        if not rows:
+            return CounterData.from_dates([], [], interval)
+
+        days = np.array([day for day, _ in rows], dtype="datetime64[D]")
+        day_positions = (days - days[0]).astype(np.int64)
+
+        values = np.full((day_positions[-1] + 1, MINUTES_PER_DAY // interval.minutes), MISSING_COUNT, dtype=np.int32)
+        values[day_positions] = np.frombuffer(b"".join(counts for _, counts in rows), dtype=INTRADAY_DTYPE).reshape(len(rows), -1)
+
+        # Slicing trims the leading and trailing intervals without data
+        return CounterData(days[0], interval, values.ravel())[:]
+
+    def get_missing_range(self, counter_id: str, start_date: date, end_date: date, interval: Interval = Interval.DAYS) -> DateRange or None:
+        """Returns the smallest range covering every day between start_date and end_date not stored yet at the given daily or sub-daily interval."""
+        rows = self.query(
+            f"SELECT date FROM {'intraday_counts' if interval.is_sub_daily else 'counts'} WHERE counter_id = ? AND interval = ? AND date BETWEEN ? AND ?",
+            (counter_id, interval.value, start_date.isoformat(), end_date.isoformat())
+        )
+        known_days = np.array([row[0] for row in rows], dtype="datetime64[D]")
+
+        all_days = np.arange(np.datetime64(start_date, "D"), np.datetime64(end_date, "D") + 1)
+        missing_days = np.setdiff1d(all_days, known_days)
+
+        if not len(missing_days):
+            return None
+
+        return DateRange(start=missing_days[0].item(), end=missing_days[-1].item())
+
+    def put_counts(self, counter_id: str, requested_range: DateRange, counter_data: CounterData) -> None:
+        """
+        Stores the counts returned for requested_range. Intervals before the
+        last returned data point that are absent from the response are stored
+        as known gaps; intervals after it are left unknown so they get
+        requested again on the next run.
+        """
+        if counter_data.interval.is_sub_daily:
+            self.put_intraday_counts(counter_id, requested_range, counter_data)
+            return
+
+        rows = list(zip(counter_data.dates.astype(str).tolist(), counter_data.counts.tolist()))
+
+        if len(counter_data):
+            grid = CounterData(requested_range["start"], counter_data.interval, [])
+            dates_until_last = grid.dates_at(np.arange(grid.positions_of(counter_data.end)))
+            known_gaps = np.setdiff1d(dates_until_last, counter_data.dates)
+            rows.extend((day, None) for day in known_gaps.astype(str).tolist())
+
+        logger.debug(f"Storing {len(rows)} {counter_data.interval} data points for counter {counter_id}")
+
+        statements = [(
+            "INSERT OR REPLACE INTO counts (counter_id, interval, date, count) VALUES (?, ?, ?, ?)",
+            [(counter_id, counter_data.interval.value, day, count) for day, count in rows]
+        )]
+
+        with self.lock:
+            if counter_data.interval == Interval.DAYS and rows:
+                statements.append((ADD_TO_ROLLUP, self.get_rollup_changes(counter_id, rows)))
+
+            self.write(statements)
+
+    def put_intraday_counts(self, counter_id: str, requested_range: DateRange, counter_data: CounterData) -> None:
+        """Stores sub-daily counts as one array per day, with MISSING_COUNT for known gaps, up to the last day the response covers completely."""
+        if not len(counter_data):
+            return
+
+        interval = counter_data.interval
+        first_day = np.datetime64(requested_range["start"], "D")
+        # The last interval of a complete day ends at midnight
+        last_complete_day = (counter_data.end + interval.minutes).astype("datetime64[D]") - 1
+        day_count = int((last_complete_day - first_day).astype(np.int64)) + 1
+
+        if day_count <= 0:
+            return
+
+        intervals_per_day = MINUTES_PER_DAY // interval.minutes
+        values = counter_data.reindex(first_day, day_count * intervals_per_day).astype(INTRADAY_DTYPE).reshape(day_count, intervals_per_day)
+        days = np.arange(first_day, last_complete_day + 1).astype(str).tolist()
+
+        logger.debug(f"Storing {day_count} days of {interval} data points for counter {counter_id}")
+
+        self.write([(
+            "INSERT OR REPLACE INTO intraday_counts (counter_id, interval, date, counts) VALUES (?, ?, ?, ?)",
+            [(counter_id, interval.value, day, day_values.tobytes()) for day, day_values in zip(days, values)]
+        )])
+
+    def get_rollup_changes(self, counter_id: str, rows: list[tuple[str, int or None]]) -> list[tuple]:
+        """Returns the amount each rollup bucket changes by when the given daily rows replace the stored ones."""
+        days = [day for day, _ in rows]
+        stored_counts = dict(self.query(
+            "SELECT date, count FROM counts WHERE counter_id = ? AND interval = ? AND date BETWEEN ? AND ?",
+            (counter_id, Interval.DAYS.value, min(days), max(days))
+        ))
+
+        deltas = np.array([(count or 0) - (stored_counts.get(day) or 0) for day, count in rows], dtype=np.int64)
+        changed = deltas != 0
+        changed_dates = np.array(days, dtype="datetime64[D]")[changed]
+
+        return [
+            (counter_id, kind, bucket, delta)
+            for kind in ROLLUP_KINDS
+            for bucket, delta in sum_by_bucket(changed_dates, deltas[changed], kind)
+        ]
+
+    def get_rollup_totals(self, counter_ids: list[str], kind: str, buckets: list[date]) -> int:
+        """Returns the combined total of the given counters over the given week, month or year buckets."""
+        if not buckets:
+            return 0
+
+        rows = self.query(
+            f"SELECT COALESCE(SUM(total), 0) FROM rollups WHERE kind = ? AND counter_id IN ({', '.join('?' * len(counter_ids))}) AND bucket IN ({', '.join('?' * len(buckets))})",
+            (kind, *counter_ids, *[bucket.isoformat() for bucket in buckets])
+        )
+
+        return rows[0][0]
+
+    def get_period_total(self, counter_ids: list[str], start_date: date, end_date: date) -> int:
+        """
+        Returns the combined daily count of the given counters between two
+        days. Whole years and months come from the rollups, so only the loose
+        days at either end are summed from the daily counts.
+        """
+        day_ranges, months, years = split_period(start_date, end_date)
+        total = self.get_rollup_totals(counter_ids, "year", years) + self.get_rollup_totals(counter_ids, "month", months)
+
+        for first_day, last_day in day_ranges:
+            total += self.query(
+                f"SELECT COALESCE(SUM(count), 0) FROM counts WHERE interval = ? AND counter_id IN ({', '.join('?' * len(counter_ids))}) AND date BETWEEN ? AND ?",
+                (Interval.DAYS.value, *counter_ids, first_day.isoformat(), last_day.isoformat())
+            )[0][0]
+
+        return total
+
+    def get_backfill_checkpoint(self, counter_id: str, interval: Interval, chunk: DateRange) -> int or None:
+        """Returns how many data points an already imported chunk had, or None if it was not imported yet."""
+        rows = self.query(
+            "SELECT data_points FROM backfill_checkpoints WHERE counter_id = ? AND interval = ? AND start_date = ? AND end_date = ?",
+            (counter_id, interval.value, chunk["start"].isoformat(), chunk["end"].isoformat())
+        )
+
+        return rows[0][0] if rows else None
+
+    def put_backfill_checkpoint(self, counter_id: str, interval: Interval, chunk: DateRange, data_points: int) -> None:
+        self.write([(
+            "INSERT OR REPLACE INTO backfill_checkpoints (counter_id, interval, start_date, end_date, data_points) VALUES (?, ?, ?, ?, ?)",
+            [(counter_id, interval.value, chunk["start"].isoformat(), chunk["end"].isoformat(), data_points)]
+        )])
+
+    def get_publication(self, tenant_id: str, day: date) -> Publication or None:
+        rows = self.query(
+            "SELECT tenant_id, date, input_hash, output_hash, post_ids, published_at FROM publications WHERE tenant_id = ? AND date = ?",
+            (tenant_id, day.isoformat())
+        )
+
+        return to_publication(rows[0]) if rows else None
+
+    def find_publication_by_output(self, tenant_id: str, output_hash: str) -> Publication or None:
+        rows = self.query(
+            "SELECT tenant_id, date, input_hash, output_hash, post_ids, published_at FROM publications WHERE tenant_id = ? AND output_hash = ?",
+            (tenant_id, output_hash)
+        )
+
+        return to_publication(rows[0]) if rows else None
+
+    def put_publication(self, publication: Publication) -> None:
+        self.write([(INSERT_PUBLICATION, [to_publication_row(publication)])])
+
+    def get_outbox_entries(self, tenant_id: str or None = None, day: date or None = None) -> list[OutboxEntry]:
+        """Returns the entries of the outbox, or only those of a tenant's day, oldest first."""
+        if tenant_id is None:
+            rows = self.query(f"SELECT {OUTBOX_COLUMNS} FROM outbox ORDER BY created_at", ())
+        else:
+            rows = self.query(f"SELECT {OUTBOX_COLUMNS} FROM outbox WHERE tenant_id = ? AND date = ? ORDER BY created_at", (tenant_id, day.isoformat()))
+
+        return [to_outbox_entry(row) for row in rows]
+
+    def put_outbox_entry(self, entry: OutboxEntry) -> None:
+        self.write([(
+            f"INSERT OR REPLACE INTO outbox ({OUTBOX_COLUMNS}) VALUES ({', '.join('?' * len(OUTBOX_COLUMNS.split(', ')))})",
+            [(
+                entry["tenant_id"], entry["date"].isoformat(), entry["sink"], entry["input_hash"], entry["output_hash"],
+                json.dumps(entry["parts"]), json.dumps(entry["params"]), entry["media_filename"], entry["image"], *get_outbox_progress(entry), entry["created_at"].isoformat(timespec="seconds")
+            )]
+        )])
+
+    def update_outbox_progress(self, entry: OutboxEntry) -> None:
+        """Saves how far the entry was sent, without writing its image again."""
+        self.write([(
+            "UPDATE outbox SET media_id = ?, media_uploaded_at = ?, post_ids = ?, not_before = ?, attempts = ?, last_error = ? WHERE tenant_id = ? AND date = ? AND sink = ?",
+            [(*get_outbox_progress(entry), entry["tenant_id"], entry["date"].isoformat(), entry["sink"])]
+        )])
+
+    def complete_outbox_entry(self, entry: OutboxEntry, publication: Publication or None) -> None:
+        """
+        Removes a fully sent entry from the outbox and records its publication,
+        if given, in the same transaction. The posts of the other sinks of the
+        same post are kept in the publication.
+        """
+        statements = [("DELETE FROM outbox WHERE tenant_id = ? AND date = ? AND sink = ?", [(entry["tenant_id"], entry["date"].isoformat(), entry["sink"])])]
+
+        with self.lock:
+            if publication:
+                previous_publication = self.get_publication(publication["tenant_id"], publication["date"])
+
+                if previous_publication and previous_publication["output_hash"] == publication["output_hash"]:
+                    publication = Publication(publication, post_ids=[*previous_publication["post_ids"], *publication["post_ids"]])
+
+                statements.append((INSERT_PUBLICATION, [to_publication_row(publication)]))
+
+            self.write(statements)
+
+def to_publication_row(publication: Publication) -> tuple:
+    return (
+        publication["tenant_id"], publication["date"].isoformat(), publication["input_hash"], publication["output_hash"],
+        json.dumps(publication["post_ids"]), publication["published_at"].isoformat(timespec="seconds")
+    )
+
+def to_publication(row: tuple) -> Publication:
+    tenant_id, day, input_hash, output_hash, post_ids, published_at = row
+
+    return Publication(
+        tenant_id=tenant_id,
+        date=date.fromisoformat(day),
+        input_hash=input_hash,
+        output_hash=output_hash,
+        post_ids=json.loads(post_ids),
+        published_at=datetime.fromisoformat(published_at)
+    )
+
+def to_optional_datetime(value: str or None) -> datetime or None:
+    return datetime.fromisoformat(value) if value else None
+
+def get_outbox_progress(entry: OutboxEntry) -> tuple:
+    return (
+        entry["media_id"],
+        entry["media_uploaded_at"].isoformat(timespec="seconds") if entry["media_uploaded_at"] else None,
+        json.dumps(entry["post_ids"]),
+        entry["not_before"].isoformat(timespec="seconds") if entry["not_before"] else None,
+        entry["attempts"],
+        entry["last_error"]
+    )
+
+def to_outbox_entry(row: tuple) -> OutboxEntry:
+    tenant_id, day, sink, input_hash, output_hash, parts, params, media_filename, image, media_id, media_uploaded_at, post_ids, not_before, attempts, last_error, created_at = row
+
+    return OutboxEntry(
+        tenant_id=tenant_id,
+        date=date.fromisoformat(day),
+        sink=sink,
+        input_hash=input_hash,
+        output_hash=output_hash,
+        parts=json.loads(parts),
+        params=json.loads(params),
+        media_filename=media_filename,
+        image=image,
+        media_id=media_id,
+        media_uploaded_at=to_optional_datetime(media_uploaded_at),
+        post_ids=json.loads(post_ids),
+        not_before=to_optional_datetime(not_before),
+        attempts=attempts,
+        last_error=last_error,
+        created_at=datetime.fromisoformat(created_at)
+    )
+
+@lru_cache(maxsize=None)
+def get_count_store() -> CountStore:
+    """
+    Opens the store at COUNT_STORE_PATH on first use, so importing this module
+    touches no files.
+
+    Which requests a run makes depends on what the store already holds, so a
+    recording run saves a snapshot of the store next to its fixtures. A replay
+    starts from an in-memory copy of that snapshot instead of the real store:
+    it makes the same requests every time and never writes to the real store.
+    """
+    snapshot_path = FIXTURES_DIR / "counts.sqlite"
+
+    if API_MODE == "replay":
+        count_store = CountStore(":memory:")
+
+        if snapshot_path.exists():
+            count_store.load_snapshot(snapshot_path)
+        else:
+            logger.warning(f"No count store snapshot in {FIXTURES_DIR}, replaying from an empty store")
+
+        return count_store
+
+    count_store = CountStore(config.get("COUNT_STORE_PATH", "data/counts.sqlite"))
+
+    if API_MODE == "record":
+        count_store.save_snapshot(snapshot_path)
+
+    return count_store
@@ -1,21 +1,237 @@
+import re
+import time
 import requests
 import logging
+import threading
+import numpy as np
 
-from datetime import date, datetime, timedelta
+from array import array
+from typing import Iterable
+from urllib.parse import urlsplit
+from datetime import date, timedelta
+from tenacity import RetryCallState, retry, retry_if_exception_type, stop_after_attempt, stop_after_delay, wait_random_exponential, before_sleep_log
 
-from eco_counter_bot.models import Interval, CounterConfig, CounterTemplateValues, DataPoint, CounterData
+from eco_counter_bot.config import config
+from eco_counter_bot.metrics import metrics
+from eco_counter_bot.replay import mount_transport
+from eco_counter_bot.data_quality import record_duplicate_dates
+from eco_counter_bot.models import Interval, CounterConfig, CounterTemplateValues, CounterData
 
 logger = logging.getLogger(f"eco_counter_bot.{__name__}")
 
+MAX_CONNECTIONS = int(config.get("FETCH_MAX_WORKERS", 8))
+TIMEOUT = (float(config.get("API_CONNECT_TIMEOUT", 5)), float(config.get("API_READ_TIMEOUT", 30)))
+MAX_ATTEMPTS = int(config.get("API_MAX_ATTEMPTS", 4))
+MAX_RETRY_SECONDS = float(config.get("API_MAX_RETRY_SECONDS", 60))
+
+session = requests.Session()
+mount_transport(session, MAX_CONNECTIONS)
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Matches one ["mm/dd/yyyy", "n"] data point; the count may or may not be quoted
+DATA_POINT_PATTERN = re.compile(rb'\[\s*"([^"]+)"\s*,\s*"?(-?\d+)"?\s*\]')
+
 class EcoCounterApiError(Exception):
     pass
 
+class RetryableApiError(EcoCounterApiError):
+    pass
+
+class CircuitOpenError(EcoCounterApiError):
+    pass
+
+class CircuitBreaker:
+    """
+    Stops requests to a host after `failure_threshold` consecutive failures.
+    Once `reset_seconds` have passed, a single trial request is let through;
+    it closes the circuit again unless it fails in a way worth retrying.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    def before_request(self, host: str) -> None:
+        with self.lock:
+            if self.opened_at is None:
+                return
+
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                raise CircuitOpenError(f"Circuit for {host} is open after {self.failures} consecutive failures")
+
+            # Let one trial request through and keep the others out until it reports back
+            self.opened_at = time.monotonic()
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self, host: str) -> None:
+        with self.lock:
+            self.failures += 1
+
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Opening circuit for {host} after {self.failures} consecutive failures")
+
+                self.opened_at = time.monotonic()
+
+circuit_breakers: dict[str, CircuitBreaker] = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(host: str) -> CircuitBreaker:
+    with circuit_breakers_lock:
+        if host not in circuit_breakers:
+            circuit_breakers[host] = CircuitBreaker(
+                int(config.get("API_CIRCUIT_FAILURE_THRESHOLD", 5)),
+                float(config.get("API_CIRCUIT_RESET_SECONDS", 300))
+            )
+
+        return circuit_breakers[host]
+
 def parse_date_for_api(date_: date) -> str:
     return date_.strftime("%d/%m/%Y")
 
-def parse_date_from_api(date_: str) -> date:
-    return datetime.strptime(date_, "%m/%d/%Y").date()
+def parse_dates_from_api(raw_dates: np.ndarray) -> np.ndarray:
+    """Parses an array of fixed-format mm/dd/yyyy byte strings into datetime64[D] without going through strptime."""
+    digits = raw_dates.view(np.uint8).reshape(len(raw_dates), raw_dates.itemsize)[:, :10].astype(np.int64) - ord("0")
+
+    months = digits[:, 0] * 10 + digits[:, 1]
+    days = digits[:, 3] * 10 + digits[:, 4]
+    years = digits[:, 6] * 1000 + digits[:, 7] * 100 + digits[:, 8] * 10 + digits[:, 9]
+
+    return ((years - 1970) * 12 + months - 1).astype("datetime64[M]").astype("datetime64[D]") + (days - 1)
+
+def parse_timestamps_from_api(raw_timestamps: np.ndarray) -> np.ndarray:
+    """Parses an array of fixed-format "mm/dd/yyyy HH:MM" byte strings into datetime64[m]."""
+    dates = parse_dates_from_api(raw_timestamps).astype("datetime64[m]")
+
+    if raw_timestamps.itemsize < 16:
+        return dates
+
+    digits = raw_timestamps.view(np.uint8).reshape(len(raw_timestamps), raw_timestamps.itemsize)[:, 11:16].astype(np.int64) - ord("0")
+
+    return dates + (digits[:, 0] * 10 + digits[:, 1]) * 60 + digits[:, 3] * 10 + digits[:, 4]
+
+def parse_counts_stream(chunks: Iterable[bytes], interval: Interval, counter_id: str or None = None) -> CounterData:
+    """
+    Decodes a [["mm/dd/yyyy", "n"], ...] payload chunk by chunk, or for
+    sub-daily intervals a [["mm/dd/yyyy HH:MM", "n"], ...] one. Counts go
+    straight into a compact array and dates are only kept as raw bytes; if the
+    first and last date show the series has no gaps, no other date is parsed.
+    Repeated dates are found by comparing the raw bytes, keep their last count
+    and are recorded as issues of counter_id.
+    """
+    raw_date_batches = []
+    counts = array("i")
+    pending = b""
 
+    for chunk in chunks:
+        pending += chunk
+        complete_until = pending.rfind(b"]") + 1
+
+        matches = DATA_POINT_PATTERN.findall(pending, 0, complete_until)
+        pending = pending[complete_until:]
+
+        if matches:
+            raw_dates, raw_counts = zip(*matches)
+            raw_date_batches.append(np.array(raw_dates))
+            counts.extend(map(int, raw_counts))
+
+    if not counts:
+        return CounterData.from_dates([], [], interval)
+
+    parse_dates = parse_timestamps_from_api if interval.is_sub_daily else parse_dates_from_api
+    raw_dates = np.concatenate(raw_date_batches)
+    counts = np.frombuffer(counts, dtype=np.intc)
+
+    # eco-visio returns dates in ascending order, so a repeated date directly follows itself. Left in, it would
+    # shift every later count by one interval whenever it is offset by a gap
+    repeated = raw_dates[1:] == raw_dates[:-1]
+
+    if repeated.any():
+        duplicate_dates = parse_dates(raw_dates[1:][repeated])
+        logger.warning(f"Counts of {counter_id or 'unknown counter'} repeat {len(duplicate_dates)} dates, keeping the last count of each: {duplicate_dates.tolist()}")
+
+        if counter_id:
+            record_duplicate_dates(counter_id, duplicate_dates)
+
+        keep = np.append(~repeated, True)
+        raw_dates, counts = raw_dates[keep], counts[keep]
+
+    first_date, last_date = parse_dates(np.array([raw_dates[0], raw_dates[-1]]))
+    series = CounterData(first_date, interval, counts)
+
+    # In ascending order, a span of exactly one interval per point means there are no gaps
+    if series.dates_at(len(counts) - 1) == last_date:
+        return series
+
+    logger.debug(f"Series from {first_date} to {last_date} has gaps, parsing all {len(counts)} dates")
+
+    return CounterData.from_dates(parse_dates(raw_dates), counts, interval)
+
+def count_response_bytes(chunks: Iterable[bytes], host: str) -> Iterable[bytes]:
+    for chunk in chunks:
+        metrics.increment("api_response_bytes", len(chunk), host=host)
+        yield chunk
+
+def is_retryable_status(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+def fetch_counts(request_url: str, interval: Interval, counter_id: str or None = None) -> CounterData:
+    host = urlsplit(request_url).netloc
+    circuit_breaker = get_circuit_breaker(host)
+
+    try:
+        circuit_breaker.before_request(host)
+    except CircuitOpenError:
+        metrics.increment("api_circuit_rejections", host=host)
+        raise
+
+    try:
+        with metrics.span("api_request", host=host), session.get(request_url, stream=True, timeout=TIMEOUT) as r:
+            metrics.increment("api_responses", host=host, status=r.status_code)
+
+            if r.status_code != 200:
+                error_type = RetryableApiError if is_retryable_status(r.status_code) else EcoCounterApiError
+                raise error_type(f"Error while making request: HTTP {r.status_code} {r.text}")
+
+            counter_data = parse_counts_stream(count_response_bytes(r.iter_content(chunk_size=STREAM_CHUNK_SIZE), host), interval, counter_id)
+    except requests.RequestException as e:
+        metrics.increment("api_connection_errors", host=host)
+        circuit_breaker.record_failure(host)
+        raise RetryableApiError(f"Error while making request: {e}") from e
+    except RetryableApiError:
+        circuit_breaker.record_failure(host)
+        raise
+    except Exception:
+        # The host answered, just not with counts, so e.g. a 404 still closes a half-open circuit
+        circuit_breaker.record_success()
+        raise
+
+    circuit_breaker.record_success()
+
+    return counter_data
+
+log_retry = before_sleep_log(logger, logging.WARNING)
+
+def before_retry(retry_state: RetryCallState) -> None:
+    metrics.increment("api_retries")
+    log_retry(retry_state)
+
+@metrics.timed("get_counts")
+@retry(
+    retry=retry_if_exception_type(RetryableApiError),
+    wait=wait_random_exponential(multiplier=0.5, max=15),
+    stop=stop_after_attempt(MAX_ATTEMPTS) | stop_after_delay(MAX_RETRY_SECONDS),
+    before_sleep=before_retry,
+    reraise=True
+)
 def get_counts(counter: CounterConfig, start_date: date, end_date: date, interval: Interval) -> CounterData:
     exclusive_end_date_for_api = end_date + timedelta(days=1)
 
@@ -29,10 +245,5 @@ def get_counts(counter: CounterConfig, start_date: date, end_date: date, interva
 
     logger.debug(f"Attempting API request with template values {template_values} and request url {request_url}")
 
-    r = requests.get(request_url)
-
-    if r.status_code != 200:
-        raise EcoCounterApiError(f"Error while making request: {r.text}")
-
-    return list(map(lambda datapoint: DataPoint(date=parse_date_from_api(datapoint[0]), count=int(datapoint[1])),r.json()))
+    return fetch_counts(request_url, interval, counter["id"])
 
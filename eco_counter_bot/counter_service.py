@@ -1,77 +1,110 @@
 import logging
+import numpy as np
 
 from datetime import date
-from functools import reduce
-from eco_counter_bot.models import CounterConfig, DataPoint, DateRange
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from eco_counter_bot.models import CounterConfig, DateRange, PeriodQuery
 
-from eco_counter_bot.models import Interval, CounterData, CounterWithSingleCount, CounterWithCounts, CountHighlights
-from eco_counter_bot.counter_api import get_counts
+from eco_counter_bot.models import MISSING_COUNT, Interval, CounterData, CounterWithSingleCount, CounterWithCounts, CountHighlights
+from eco_counter_bot.counter_api import MAX_CONNECTIONS, EcoCounterApiError, get_counts
+from eco_counter_bot.count_store import get_count_store
+from eco_counter_bot.metrics import metrics
+from eco_counter_bot.query_planner import plan_daily_range, plan_base_interval, resolve_query
 
 logger = logging.getLogger(f"eco_counter_bot.{__name__}")
 
+fetch_executor = ThreadPoolExecutor(max_workers=MAX_CONNECTIONS, thread_name_prefix="fetch")
+
 class NoDataFoundException(Exception):
     pass
 
+class DataNotReadyException(Exception):
+    pass
+
 def get_count_for_day(counter_data: CounterData, day: date) -> int:
-    data_match = next(filter(lambda count: count["date"] == day, counter_data), None)
+    count = counter_data.count_for(day)
 
-    if not data_match:
+    if count is None:
         logger.warn(f"Requested day not found in returned data, looked for {day.strftime('%Y/%m/%d')}, found {counter_data}. Returning 0")
         return 0
 
-    return data_match["count"]
+    return count
 
 def flatten(bike_counts: list[CounterData]) -> CounterData:
-    check_counts = bike_counts[0]
-    check_data_count = len(check_counts)
-    check_first_date = check_counts[0]["date"]
-    check_last_date = check_counts[-1]["date"]
+    non_empty_counts = [bike_count for bike_count in bike_counts if len(bike_count.values)]
+    interval = bike_counts[0].interval
 
-    for bike_count in bike_counts:
-        data_count = len(bike_count)
-        first_date = bike_count[0]["date"] if data_count else None
-        last_date = bike_count[-1]["date"] if data_count else None
+    if not non_empty_counts:
+        return CounterData(bike_counts[0].start, interval, [])
 
-        if data_count != check_data_count or first_date != check_first_date or last_date != check_last_date:
-            logger.warn("Likely data mismatch detected during flattening - sums might not be accurate")
+    grid = CounterData(min(bike_count.start for bike_count in non_empty_counts), interval, [])
+    grid_length = int(max(grid.positions_of(bike_count.end) for bike_count in non_empty_counts)) + 1
 
-    count_with_most_data_points = max(bike_counts, key=lambda bike_count: len(bike_count))
+    values = np.stack([bike_count.reindex(grid.start, grid_length) for bike_count in bike_counts])
+    present = values != MISSING_COUNT
+    present_anywhere = present.any(axis=0)
 
-    flattened_count = list(
-        map(
-            lambda data_point: DataPoint(date=data_point["date"], count=0),
-            count_with_most_data_points
-        )
-    )
+    for counter_present in present:
+        missing_positions = np.flatnonzero(present_anywhere & ~counter_present)
+
+        if len(missing_positions):
+            logger.warn("Likely data mismatch detected during flattening - sums might not be accurate")
 
-    for count in bike_counts:
-        for flattened_data_point in flattened_count:
-            reference_date = flattened_data_point["date"]
+            for missing_date in grid.dates_at(missing_positions).tolist():
+                logger.warn(f"Missing data point for date {missing_date.strftime('%Y/%m/%d')} while flattening")
 
-            match_in_count = next(filter(lambda data_point: data_point["date"] == reference_date, count), None)
+    flattened_values = np.where(present, values, 0).sum(axis=0, dtype=np.int64)
 
-            if match_in_count:
-                flattened_data_point["count"] += match_in_count["count"]
-            else:
-                logger.warn(f"Missing data point for date {reference_date.strftime('%Y/%m/%d')} while flattening")
+    return CounterData(grid.start, interval, np.where(present_anywhere, flattened_values, MISSING_COUNT))
 
-    return flattened_count
+def get_counters_missing_day(counters_with_counts: list[CounterWithCounts], day: date) -> list[CounterConfig]:
+    """Returns the counters that have no count for the given day yet."""
+    return [counter_with_counts["counter"] for counter_with_counts in counters_with_counts if counter_with_counts["counts"].count_for(day) is None]
 
 def filter_counts_by_date(counter_data: CounterData, start_date: date, end_date: date) -> CounterData:
-    return list(filter(lambda data_point: start_date <= data_point["date"] <= end_date, counter_data))
+    return counter_data.between(start_date, end_date)
 
 def sum_counts(counter_data: CounterData) -> int:
-    return reduce(lambda current_sum, data_point: current_sum + data_point["count"], counter_data, 0)
+    return counter_data.total()
+
+def get_counts_for_periods(counters: list[CounterConfig], queries: list[PeriodQuery]) -> list[list[CounterWithCounts]]:
+    """
+    Gets the counts of all counters for every query in one batch. The queries
+    are merged into one range of days per counter, loaded at days or, if a
+    query needs it, at the finest sub-daily interval asked for. Whatever part
+    of it the count store cannot serve is fetched concurrently, at most one
+    request per counter. Each query is then sliced and aggregated locally.
+    """
+    daily_range = plan_daily_range(queries)
+    base_interval = plan_base_interval(queries)
+    fetch_futures = {}
+
+    for counter in counters:
+        missing_range = get_count_store().get_missing_range(counter["id"], daily_range["start"], daily_range["end"], base_interval)
+        metrics.increment("count_store_misses" if missing_range else "count_store_hits")
+
+        if missing_range:
+            logger.debug(f"Fetching {base_interval} counts for counter {counter['id']} from {missing_range['start']} to {missing_range['end']}")
+            fetch_futures[counter["id"]] = (missing_range, fetch_executor.submit(get_counts, counter, missing_range["start"], missing_range["end"], base_interval))
+
+    for counter_id, (missing_range, future) in fetch_futures.items():
+        try:
+            get_count_store().put_counts(counter_id, missing_range, future.result())
+        except EcoCounterApiError as e:
+            logger.warning(f"Could not fetch {missing_range} for counter {counter_id}, falling back to stored counts: {e}")
+            metrics.increment("stale_fallbacks")
+
+    base_counts = {counter["id"]: get_count_store().get_counts(counter["id"], daily_range["start"], daily_range["end"], base_interval) for counter in counters}
+
+    return [
+        [CounterWithCounts(counter=counter, counts=resolve_query(base_counts[counter["id"]], query)) for counter in counters]
+        for query in queries
+    ]
 
 def get_counts_for_period(counters: list[CounterConfig], period: DateRange, interval: Interval = Interval.DAYS) -> list[CounterWithCounts]:
-    return list(
-        map(
-            lambda counter: {"counter": counter, "counts": get_counts(counter, period["start"], period["end"], interval)},
-            counters
-        )
-    )
+    return get_counts_for_periods(counters, [PeriodQuery(period=period, interval=interval)])[0]
 
+@metrics.timed("extract_highlights")
 def extract_highlights(counters_with_counts: list[CounterWithCounts]) -> CountHighlights:
     flattened_counts = flatten(list(map(lambda counter_with_counts: counter_with_counts["counts"], counters_with_counts)))
 
@@ -2,6 +2,10 @@ from string import Template
 
 from eco_counter_bot.models import CounterConfig
 
+def make_url_template(organisation_id: int, counter_id: int, flow_ids: list[int]) -> Template:
+    flow_ids_param = "%3B".join(map(str, flow_ids))
+    return Template(f"https://www.eco-visio.net/api/aladdin/1.0.0/pbl/publicwebpageplus/data/{counter_id}?idOrganisme={organisation_id}&idPdc={counter_id}&fin=$end_date&debut=$start_date&interval=$interval&flowIds={flow_ids_param}")
+
 counters = [
     CounterConfig(id="viaduc",     name="Viaduc",           url_template=Template("https://www.eco-visio.net/api/aladdin/1.0.0/pbl/publicwebpageplus/data/100065111?idOrganisme=4586&idPdc=100065111&fin=$end_date&debut=$start_date&interval=$interval&flowIds=101065111%3B102065111")),
     CounterConfig(id="lift",       name="Pfaffenthal-Lift", url_template=Template("https://www.eco-visio.net/api/aladdin/1.0.0/pbl/publicwebpageplus/data/100136902?idOrganisme=4586&idPdc=100136902&fin=$end_date&debut=$start_date&interval=$interval&flowIds=101136902%3B102136902%3B103136902%3B104136902")),
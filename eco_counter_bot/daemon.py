@@ -0,0 +1,83 @@
+import sched
+import time
+import logging
+import threading
+
+from datetime import datetime, time as time_of_day, timedelta
+
+from eco_counter_bot.config import config
+from eco_counter_bot.utils import today
+from eco_counter_bot.models import DateRange, TenantConfig
+from eco_counter_bot.counter_service import get_counts_for_period
+from eco_counter_bot.sinks import create_sinks
+from eco_counter_bot.grapher import warm_up_renderer
+from eco_counter_bot.bot import publish_all_tenants
+from eco_counter_bot.metrics import metrics
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+def get_next_run(run_at: time_of_day, now: datetime) -> datetime:
+    next_run = datetime.combine(now.date(), run_at)
+    return next_run if next_run > now else next_run + timedelta(days=1)
+
+def refresh_counts(tenants: list[TenantConfig]) -> None:
+    """Pulls the most recent week into the count store, so the daily post only has to fetch what is new since."""
+    yesterday = today() - timedelta(days=1)
+    all_counters = [counter for tenant in tenants for counter in tenant["counters"]]
+    get_counts_for_period(all_counters, DateRange(start=yesterday - timedelta(days=6), end=yesterday))
+
+def warm_up_sinks(tenant: TenantConfig) -> None:
+    for sink in create_sinks(tenant):
+        sink.warm_up()
+
+def run_daemon(tenants: list[TenantConfig]) -> None:
+    """
+    Keeps the bot resident and publishes yesterday's results every day at
+    DAEMON_DAILY_AT (local time of the process). The HTTP session, count
+    store, sink clients and image exporter stay warm between runs. With
+    DAEMON_REFRESH_MINUTES set, recent counts are also refreshed in between.
+    """
+    daily_at = datetime.strptime(config.get("DAEMON_DAILY_AT", "06:00"), "%H:%M").time()
+    refresh_minutes = int(config.get("DAEMON_REFRESH_MINUTES", 0))
+
+    scheduler = sched.scheduler(time.time, time.sleep)
+
+    def run_job(job, name: str) -> None:
+        logger.info(f"Running {name} at {datetime.now()}")
+
+        try:
+            job()
+        except Exception as e:
+            logger.error(f"Error during {name}, keeping the daemon running: {e}", exc_info=True)
+
+        # Metrics add up over the daemon's lifetime; the report is refreshed after every job
+        metrics.write_report()
+
+    def schedule_daily_post() -> None:
+        next_run = get_next_run(daily_at, datetime.now())
+        logger.info(f"Next daily post at {next_run}")
+        scheduler.enterabs(next_run.timestamp(), 0, daily_post)
+
+    def daily_post() -> None:
+        run_job(lambda: publish_all_tenants(tenants), "daily post")
+        schedule_daily_post()
+
+    def refresh() -> None:
+        run_job(lambda: refresh_counts(tenants), "count refresh")
+        scheduler.enter(refresh_minutes * 60, 1, refresh)
+
+    logger.info("Starting daemon, warming up")
+
+    threading.Thread(target=warm_up_renderer, daemon=True).start()
+    for tenant in tenants:
+        run_job(lambda: warm_up_sinks(tenant), f"sink warm-up for tenant {tenant['id']}")
+
+    schedule_daily_post()
+
+    if refresh_minutes:
+        scheduler.enter(0, 1, refresh)
+
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        logger.info("Daemon stopped")
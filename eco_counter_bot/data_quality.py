@@ -0,0 +1,230 @@
+import json
+import logging
+import warnings
+import threading
+import numpy as np
+
+from pathlib import Path
+from datetime import date
+from collections import defaultdict
+
+from eco_counter_bot.config import config
+from eco_counter_bot.metrics import metrics
+from eco_counter_bot.utils import write_atomically
+from eco_counter_bot.models import MISSING_COUNT, Interval, CounterConfig, CounterData, CounterWithCounts, CounterQualityReport, DataIssue, TenantConfig
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+# What to do about counters without a plausible count for the day of a post:
+# "report" only logs them, "impute" fills in their expected counts, "exclude"
+# leaves them out of the post and "delay" does not post until they are fixed
+POLICIES = ("report", "impute", "exclude", "delay")
+DEFAULT_POLICY = config.get("DATA_QUALITY_POLICY", "report")
+
+# A counter reporting 0 for this many days in a row is taken to be broken rather than unused
+ZERO_RUN_MIN_DAYS = int(config.get("DATA_QUALITY_ZERO_RUN_DAYS", 2))
+
+# Counts are compared to the same weekday of the preceding weeks
+HISTORY_WEEKS = int(config.get("DATA_QUALITY_HISTORY_WEEKS", 8))
+MIN_HISTORY_WEEKS = int(config.get("DATA_QUALITY_MIN_HISTORY_WEEKS", 4))
+OUTLIER_THRESHOLD = float(config.get("DATA_QUALITY_OUTLIER_THRESHOLD", 6))
+
+# Scales a median absolute deviation to the standard deviation of normally distributed data
+MAD_SCALE = 1.4826
+
+# The network-wide change of a day is only told apart from a single counter's with this many counters
+MIN_COUNTERS_FOR_DAY_FACTOR = 3
+
+duplicate_dates_lock = threading.Lock()
+duplicate_dates: dict[str, set[date]] = defaultdict(set)
+
+def record_duplicate_dates(counter_id: str, dates: np.ndarray) -> None:
+    """Remembers dates the API returned more than one count for, to be reported with the counter's other issues."""
+    metrics.increment("duplicate_dates", len(dates), counter=counter_id)
+
+    with duplicate_dates_lock:
+        duplicate_dates[counter_id].update(dates.astype("datetime64[D]").tolist())
+
+def find_runs(mask: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the row, first and last column of every run of True values in the rows of a 2D mask."""
+    edges = np.diff(np.pad(mask, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+
+    # Both are in row-major order, so the n-th end closes the n-th run
+    return rows, starts, np.nonzero(edges == -1)[1] - 1
+
+def to_run_mask(shape: tuple[int, int], rows: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    edges = np.zeros((shape[0], shape[1] + 1), dtype=np.int32)
+    np.add.at(edges, (rows, starts), 1)
+    np.add.at(edges, (rows, ends + 1), -1)
+
+    return np.cumsum(edges[:, :-1], axis=1) > 0
+
+def get_weekday_history(values: np.ndarray, weeks: int) -> np.ndarray:
+    """Stacks, for every day, the values of the same weekday in each of the preceding weeks."""
+    history = np.full((weeks, *values.shape), np.nan)
+
+    for week in range(1, weeks + 1):
+        history[week - 1, :, 7 * week:] = values[:, :max(values.shape[1] - 7 * week, 0)]
+
+    return history
+
+class QualityCheck:
+    """
+    The daily counts of several counters checked against each other and
+    against their own history, all at once on a common grid of days:
+
+    - gaps: days without a count since the counter's first count
+    - zero runs: at least ZERO_RUN_MIN_DAYS days in a row counting 0
+    - duplicates: dates the API returned more than one count for
+    - outliers: counts further than OUTLIER_THRESHOLD robust standard
+      deviations from the median of the same weekday over the preceding
+      HISTORY_WEEKS weeks, scaled by how much all counters changed that day
+      so e.g. a rainy day or a holiday does not count against any of them
+
+    Every check is a handful of array operations over counters and days, so
+    it stays cheap for years of counts.
+    """
+
+    def __init__(self, counters_with_counts: list[CounterWithCounts], day: date):
+        self.counters = [counter_with_counts["counter"] for counter_with_counts in counters_with_counts]
+        self.day = day
+
+        all_counts = [counter_with_counts["counts"] for counter_with_counts in counters_with_counts]
+        non_empty_counts = [counts for counts in all_counts if len(counts.values)]
+
+        self.grid = CounterData(min([day, *(counts.start.item() for counts in non_empty_counts)]), Interval.DAYS, [])
+        self.day_position = int(self.grid.positions_of(day))
+        grid_length = max([self.day_position, *(int(self.grid.positions_of(counts.end)) for counts in non_empty_counts)]) + 1
+
+        self.values = np.stack([counts.reindex(self.grid.start, grid_length) for counts in all_counts]) if all_counts else np.empty((0, grid_length), dtype=np.int32)
+        self.missing = self.values == MISSING_COUNT
+
+        # Days before a counter's first count are no gaps, it was not set up yet
+        self.gaps = self.missing & np.maximum.accumulate(~self.missing, axis=1)
+
+        rows, starts, ends = find_runs(self.values == 0)
+        long_enough = ends - starts + 1 >= ZERO_RUN_MIN_DAYS
+        self.zero_runs = to_run_mask(self.values.shape, rows[long_enough], starts[long_enough], ends[long_enough])
+
+        observed = np.where(self.missing | self.zero_runs, np.nan, self.values)
+        history = get_weekday_history(observed, HISTORY_WEEKS)
+
+        # Days without any history yet are expected to be all-NaN
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+
+            expected = np.nanmedian(history, axis=0)
+            spread = np.nanmedian(np.abs(history - expected), axis=0) * MAD_SCALE
+
+            ratios = np.where(expected > 0, observed / np.where(expected > 0, expected, 1), np.nan)
+            day_factor = np.nanmedian(ratios, axis=0)
+
+        day_factor = np.where(np.count_nonzero(~np.isnan(ratios), axis=0) >= MIN_COUNTERS_FOR_DAY_FACTOR, day_factor, 1)
+        has_history = np.count_nonzero(~np.isnan(history), axis=0) >= MIN_HISTORY_WEEKS
+
+        self.expected = np.where(has_history, expected * day_factor, np.nan)
+        # Counts vary at least like a Poisson process, which keeps a steady history from making every deviation an outlier
+        scale = np.maximum(spread * day_factor, np.sqrt(np.maximum(self.expected, 1)))
+
+        self.outliers = has_history & (np.abs(observed - self.expected) > OUTLIER_THRESHOLD * scale)
+
+        self.reports = [self.get_counter_report(index) for index in range(len(self.counters))]
+
+    def get_duplicate_dates(self, counter: CounterConfig) -> list[date]:
+        last_date = self.grid.date_at(self.values.shape[1] - 1)
+
+        with duplicate_dates_lock:
+            return sorted(day for day in duplicate_dates.get(counter["id"], ()) if self.grid.start.item() <= day <= last_date)
+
+    def get_counter_report(self, index: int) -> CounterQualityReport:
+        counter = self.counters[index]
+        issues = []
+
+        for kind, mask in (("gap", self.gaps[index:index + 1]), ("zero_run", self.zero_runs[index:index + 1])):
+            _, starts, ends = find_runs(mask)
+            issues += [
+                DataIssue(kind=kind, start=start, end=end, count=None, expected=None)
+                for start, end in zip(self.grid.dates_at(starts).tolist(), self.grid.dates_at(ends).tolist())
+            ]
+
+        outlier_positions = np.flatnonzero(self.outliers[index])
+        issues += [
+            DataIssue(kind="outlier", start=day, end=day, count=count, expected=round(expected, 1))
+            for day, count, expected in zip(
+                self.grid.dates_at(outlier_positions).tolist(), self.values[index, outlier_positions].tolist(), self.expected[index, outlier_positions].tolist()
+            )
+        ]
+
+        duplicates = self.get_duplicate_dates(counter)
+        issues += [DataIssue(kind="duplicate", start=day, end=day, count=None, expected=None) for day in duplicates]
+
+        present = ~self.missing[index]
+        first_position = int(np.argmax(present)) if present.any() else None
+
+        if self.missing[index, self.day_position]:
+            reference_day_status = "missing"
+        elif self.zero_runs[index, self.day_position] or self.outliers[index, self.day_position] or self.day in duplicates:
+            reference_day_status = "suspect"
+        else:
+            reference_day_status = "ok"
+
+        return CounterQualityReport(
+            counter_id=counter["id"],
+            counter_name=counter["name"],
+            first_date=self.grid.date_at(first_position) if first_position is not None else None,
+            completeness=round(float(present[first_position:].mean()), 4) if first_position is not None else 0.0,
+            reference_day_status=reference_day_status,
+            issues=sorted(issues, key=lambda issue: (issue["start"], issue["kind"]))
+        )
+
+    def get_counters(self, statuses: tuple[str, ...]) -> list[CounterConfig]:
+        """Returns the counters whose count for the day has one of the given statuses."""
+        return [counter for counter, report in zip(self.counters, self.reports) if report["reference_day_status"] in statuses]
+
+    def impute(self) -> list[CounterWithCounts]:
+        """Returns the counts with every gap, zero run and outlier replaced by its expected count, where there is one."""
+        flagged = (self.gaps | self.zero_runs | self.outliers) & ~np.isnan(self.expected)
+        values = np.where(flagged, np.rint(np.nan_to_num(self.expected)), self.values).astype(np.int32)
+
+        return [
+            CounterWithCounts(counter=counter, counts=CounterData(self.grid.start, Interval.DAYS, counter_values))
+            for counter, counter_values in zip(self.counters, values)
+        ]
+
+    def can_impute(self, counters: list[CounterConfig]) -> bool:
+        return all(not np.isnan(self.expected[self.counters.index(counter), self.day_position]) for counter in counters)
+
+def get_policy(tenant: TenantConfig) -> str:
+    policy = tenant.get("data_quality_policy") or DEFAULT_POLICY
+
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown data quality policy {policy} for tenant {tenant['id']}, expected one of {', '.join(POLICIES)}")
+
+    return policy
+
+def report_quality(tenant: TenantConfig, check: QualityCheck) -> None:
+    """Logs and counts the issues found, and with DATA_QUALITY_REPORT_DIR set writes them to <dir>/<tenant>.json."""
+    for report in check.reports:
+        for issue in report["issues"]:
+            metrics.increment("data_quality_issues", tenant=tenant["id"], kind=issue["kind"])
+
+        if report["reference_day_status"] != "ok":
+            day_issues = [issue["kind"] for issue in report["issues"] if issue["start"] <= check.day <= issue["end"]]
+            logger.warning(f"Count of {report['counter_name']} for {check.day} is {report['reference_day_status']} ({', '.join(day_issues) or 'no count'})")
+
+        logger.debug(f"Data quality of {report['counter_name']}: {report['completeness']:.1%} complete, {len(report['issues'])} issues")
+
+    report_dir = config.get("DATA_QUALITY_REPORT_DIR")
+
+    if not report_dir:
+        return
+
+    report_path = Path(report_dir) / f"{tenant['id']}.json"
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    write_atomically(report_path, json.dumps({
+        "tenant_id": tenant["id"],
+        "date": check.day.isoformat(),
+        "policy": get_policy(tenant),
+        "counters": check.reports
+    }, default=str, ensure_ascii=False, indent=2))
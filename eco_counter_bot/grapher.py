@@ -1,111 +1,162 @@
-import pandas
-import os
+import base64
+import logging
+import threading
+import numpy as np
 
-import plotly.express as px
+from pathlib import Path
+from typing import TYPE_CHECKING
+from functools import lru_cache
+from collections import OrderedDict
 
-from arrow import Arrow
-from datetime import datetime
+from eco_counter_bot.config import config
+from eco_counter_bot.metrics import metrics
+from eco_counter_bot.utils import content_hash, format_number_for_locale
+from eco_counter_bot.models import CounterData
 
-from eco_counter_bot.utils import format_number_lb
-from eco_counter_bot.models import CounterData, DataPoint
+if TYPE_CHECKING:
+    import plotly.graph_objects as go
 
-def customize_legend_name(fig, new_names):
-    for i, new_name in enumerate(new_names):
-        fig.data[i].name = new_name
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
 
-def get_count_for(day: datetime or Arrow, count_data: CounterData) -> int or None:
-    return next(filter(lambda data_point: data_point["date"].day == day.date().day and data_point["date"].month == day.date().month, count_data), DataPoint(date=day, count=None))["count"]
+RESOURCES_PATH = Path(__file__).resolve().parent.parent / "res"
+
+CURRENT_YEAR_COLOR = "#636efa"
+PREVIOUS_YEAR_COLOR = "#EF553B"
+
+# Kaleido keeps one export process per Python process; it is not safe to use from several threads at once
+render_lock = threading.Lock()
+
+# Rendered images keyed by a hash of everything that goes into them, most recently used last
+RENDER_CACHE_SIZE = int(config.get("RENDER_CACHE_SIZE", 8))
+render_cache: OrderedDict[str, bytes] = OrderedDict()
+
+def load_image_as_data_uri(filename: str) -> str:
+    encoded = base64.b64encode((RESOURCES_PATH / filename).read_bytes()).decode("ascii")
+    return f"data:image/png;base64,{encoded}"
+
+@lru_cache(maxsize=None)
+def get_figure_skeleton() -> "go.Figure":
+    """Builds everything of the yearly plot that does not depend on the data, once per process."""
+    import plotly.graph_objects as go
+
+    fig = go.Figure(layout=dict(
+        template="plotly_white",
+        width=800,
+        height=600,
+        legend_title_text="Year",
+        xaxis=dict(title_text="Date", dtick="M1", tickformat="%b"),
+        yaxis=dict(title_text="<b>Bike</b> counts", rangemode="nonnegative"),
+    ))
+
+    fig.add_layout_image(
+        dict(
+            source=load_image_as_data_uri("header.png"),
+            xref="paper", yref="paper",
+            x=1, y=1.025,
+            sizex=0.5, sizey=0.5,
+            xanchor="right", yanchor="bottom"
+        )
+    )
+
+    fig.add_layout_image(
+        dict(
+            source=load_image_as_data_uri("footer.png"),
+            xref="paper", yref="paper",
+            x=1, y=0,
+            sizex=0.5, sizey=0.5,
+            xanchor="right", yanchor="bottom"
+        )
+    )
+
+    return fig
+
+def warm_up_renderer() -> None:
+    """Starts the Kaleido export process and builds the figure skeleton ahead of the first real render."""
+    import plotly.io as pio
+    import plotly.graph_objects as go
+
+    get_figure_skeleton()
+
+    with render_lock:
+        pio.to_image(go.Figure(), format="png", width=10, height=10)
+
+def align_to_year(count_data: CounterData, year: int) -> np.ndarray:
+    """Places every count on the same month and day of the given year. Days without data are NaN."""
+    year_start = np.datetime64(f"{year}-01-01")
+    months = count_data.dates.astype("datetime64[M]")
+
+    target_months = np.datetime64(f"{year}-01", "M") + months.astype(np.int64) % 12
+    target_dates = target_months.astype("datetime64[D]") + (count_data.dates - months.astype("datetime64[D]"))
+
+    # A 29th of February has no counterpart in a non-leap year and would spill into March
+    fits_year = target_dates.astype("datetime64[M]") == target_months
+
+    values = np.full((np.datetime64(f"{year + 1}-01-01") - year_start).astype(np.int64), np.nan)
+    values[(target_dates[fits_year] - year_start).astype(np.int64)] = count_data.counts[fits_year]
+
+    return values
+
+@metrics.timed("render")
+def generate_yearly_plot(previous_year_cd: CounterData, current_year_cd: CounterData, title: str = "Luxembourg-City bike counts", locale: str = "lb_LU") -> bytes:
+    """Renders the cumulative counts of both years as a PNG and returns its bytes."""
+    import plotly.graph_objects as go
 
-def generate_yearly_plot(previous_year_cd: CounterData, current_year_cd: CounterData):
     previous_year_simple = previous_year_cd[0]["date"].year
     current_year_simple = current_year_cd[0]["date"].year
 
-    current_year_start = current_year_cd[0]["date"].replace(month=1, day=1)
-    current_year_end = current_year_start.replace(month=12, day=31)
-
     cutoff_day = current_year_cd[-1]["date"]
     cutoff_day_index =  cutoff_day.timetuple().tm_yday - 1
 
-    all_current_year_days = list(Arrow.range("day", Arrow.fromdate(current_year_start), Arrow.fromdate(current_year_end)))
+    all_current_year_days = np.arange(np.datetime64(f"{current_year_simple}-01-01"), np.datetime64(f"{current_year_simple + 1}-01-01"))
 
-    previous_year_values = [get_count_for(day, previous_year_cd) for day in all_current_year_days]
-    current_year_values = [get_count_for(day, current_year_cd) for day in all_current_year_days]
+    previous_year_values = align_to_year(previous_year_cd, current_year_simple)
+    current_year_values = align_to_year(current_year_cd, current_year_simple)
 
-    data = {
-        'date': all_current_year_days,
-        'curr': current_year_values,
-        'prev': previous_year_values
-    }
+    render_key = content_hash(previous_year_values, current_year_values, previous_year_simple, current_year_simple, cutoff_day, title, locale)
 
-    print(data)
+    with render_lock:
+        if render_key in render_cache:
+            logger.debug(f"Reusing cached render {render_key}")
+            metrics.increment("render_cache_hits")
+            render_cache.move_to_end(render_key)
+            return render_cache[render_key]
 
-    df = pandas.DataFrame(data)
+    metrics.increment("render_cache_misses")
 
-    fig = px.line(
-        df,
-        x="date",
-        y=["curr", "prev"],
-        title=f"<b>Luxembourg-City bike counts</b><br>{current_year_simple} vs {previous_year_simple}<br><i>{cutoff_day.strftime('%d %B %Y')}</i>",
-        labels={ "date": "Date", "curr": current_year_simple, "prev": previous_year_simple, "variable": "Year" },
-        width=800,
-        height=600,
-    )
+    fig = go.Figure(get_figure_skeleton())
 
-    fig.update_traces(line=dict(width=4))
+    fig.add_scatter(x=all_current_year_days, y=current_year_values, name=current_year_simple, mode="lines", line=dict(width=4, color=CURRENT_YEAR_COLOR))
+    fig.add_scatter(x=all_current_year_days, y=previous_year_values, name=previous_year_simple, mode="lines", line=dict(width=4, color=PREVIOUS_YEAR_COLOR))
 
-    customize_legend_name(fig, [current_year_simple, previous_year_simple])
+    fig.update_layout(title_text=f"<b>{title}</b><br>{current_year_simple} vs {previous_year_simple}<br><i>{cutoff_day.strftime('%d %B %Y')}</i>")
 
-    fig.add_scatter(x = [fig.data[1].x[cutoff_day_index]], y = [fig.data[1].y[cutoff_day_index]],
+    fig.add_scatter(x = [all_current_year_days[cutoff_day_index]], y = [previous_year_values[cutoff_day_index]],
                         mode = 'markers + text',
                         marker = {'color':'red', 'size':14},
                         showlegend = False,
-                        text = f"<b>{format_number_lb(int(fig.data[1].y[cutoff_day_index]))}</b>",
+                        text = f"<b>{format_number_for_locale(int(previous_year_values[cutoff_day_index]), locale)}</b>",
                         textposition='middle right',
                         textfont = { 'color': 'red' })
 
-    fig.add_scatter(x = [fig.data[0].x[cutoff_day_index]], y = [fig.data[0].y[cutoff_day_index]],
+    fig.add_scatter(x = [all_current_year_days[cutoff_day_index]], y = [current_year_values[cutoff_day_index]],
                         mode = 'markers + text',
                         marker = {'color':'blue', 'size':14},
                         showlegend = False,
-                        text = f"<b>{format_number_lb(int(fig.data[0].y[cutoff_day_index])):}</b>",
+                        text = f"<b>{format_number_for_locale(int(current_year_values[cutoff_day_index]), locale):}</b>",
                         textposition='top left',
                         textfont = { 'color': 'blue' })
 
-    fig.add_hline(y=fig.data[1].y[-1], line_dash="dot", line_color="red",
-        annotation_text=f"{previous_year_simple} total: <b>{format_number_lb(int(fig.data[1].y[-1]))}</b>", 
+    fig.add_hline(y=previous_year_values[-1], line_dash="dot", line_color="red",
+        annotation_text=f"{previous_year_simple} total: <b>{format_number_for_locale(int(previous_year_values[-1]), locale)}</b>",
         annotation_position="top right",
         annotation_font_color="red")
 
-    fig.update_yaxes(title_text="<b>Bike</b> counts", secondary_y=False)
-    fig.update_yaxes(rangemode="nonnegative")
-
-    fig.update_xaxes(
-        dtick="M1",
-        tickformat="%b")
-
-    fig.add_layout_image(
-        dict(
-            source="https://raw.githubusercontent.com/fedus/eco_counter_bot/main/res/header.png",
-            xref="paper", yref="paper",
-            x=1, y=1.025,
-            sizex=0.5, sizey=0.5,
-            xanchor="right", yanchor="bottom"
-        )
-    )
-
-    fig.add_layout_image(
-        dict(
-            source="https://raw.githubusercontent.com/fedus/eco_counter_bot/main/res/footer.png",
-            xref="paper", yref="paper",
-            x=1, y=0,
-            sizex=0.5, sizey=0.5,
-            xanchor="right", yanchor="bottom"
-        )
-    )
+    with render_lock, metrics.span("export_image"):
+        image = fig.to_image(format="png")
 
-    fig.update_layout(template='plotly_white')
+        render_cache[render_key] = image
 
-    if not os.path.exists("tmp"):
-        os.mkdir("tmp")
+        if len(render_cache) > RENDER_CACHE_SIZE:
+            render_cache.popitem(last=False)
 
-    fig.write_image("tmp/daily_fig.png")
+    return image
@@ -0,0 +1,201 @@
+import json
+import time
+import logging
+import threading
+
+from pathlib import Path
+from datetime import datetime
+from functools import wraps
+from contextlib import contextmanager
+from collections import defaultdict
+from typing import Callable, Iterator
+
+from eco_counter_bot.config import config
+from eco_counter_bot.utils import write_atomically
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+# Finished spans kept for the JSON report; the aggregated timings are kept regardless
+MAX_TRACE_SPANS = int(config.get("METRICS_MAX_TRACE_SPANS", 10000))
+
+PROMETHEUS_PREFIX = "eco_counter_bot"
+
+Labels = tuple[tuple[str, str], ...]
+
+def to_labels(labels: dict) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_prometheus_labels(labels: Labels, **extra_labels: str) -> str:
+    all_labels = [*labels, *extra_labels.items()]
+
+    if not all_labels:
+        return ""
+
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in all_labels) + "}"
+
+class SpanTiming:
+    __slots__ = ("count", "total_seconds", "max_seconds", "errors")
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.errors = 0
+
+class Metrics:
+    """
+    Counters and timed spans since the start of the run (or the last reset),
+    shared by all threads. Spans nest per thread; every finished span is added
+    to the timing of its name and labels and, up to MAX_TRACE_SPANS, kept in
+    the trace of the JSON report.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started_at = datetime.now()
+            self.started = time.perf_counter()
+            self.counters: dict[tuple[str, Labels], float] = defaultdict(float)
+            self.timings: dict[tuple[str, Labels], SpanTiming] = defaultdict(SpanTiming)
+            self.trace: list[dict] = []
+            self.next_span_id = 0
+
+    def increment(self, name: str, amount: float = 1, **labels) -> None:
+        with self.lock:
+            self.counters[(name, to_labels(labels))] += amount
+
+    @contextmanager
+    def span(self, name: str, **labels) -> Iterator[None]:
+        parents = self.local.__dict__.setdefault("parents", [])
+
+        with self.lock:
+            span_id = self.next_span_id
+            self.next_span_id += 1
+
+        parent_id = parents[-1] if parents else None
+        parents.append(span_id)
+        started = time.perf_counter()
+        failed = False
+
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            parents.pop()
+
+            with self.lock:
+                timing = self.timings[(name, to_labels(labels))]
+                timing.count += 1
+                timing.total_seconds += duration
+                timing.max_seconds = max(timing.max_seconds, duration)
+                timing.errors += failed
+
+                if len(self.trace) < MAX_TRACE_SPANS:
+                    self.trace.append({
+                        "id": span_id,
+                        "parent": parent_id,
+                        "name": name,
+                        "labels": labels,
+                        "thread": threading.current_thread().name,
+                        "start_seconds": started - self.started,
+                        "duration_seconds": duration,
+                        "failed": failed,
+                    })
+
+    def timed(self, name: str) -> Callable:
+        """Decorator that wraps every call of the function in a span."""
+        def decorator(function: Callable) -> Callable:
+            @wraps(function)
+            def timed_function(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+
+            return timed_function
+
+        return decorator
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {
+                "started_at": self.started_at.isoformat(timespec="seconds"),
+                "duration_seconds": time.perf_counter() - self.started,
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "timings": [
+                    {"name": name, "labels": dict(labels), "count": timing.count, "total_seconds": timing.total_seconds, "max_seconds": timing.max_seconds, "errors": timing.errors}
+                    for (name, labels), timing in sorted(self.timings.items())
+                ],
+                "trace": sorted(self.trace, key=lambda span: span["start_seconds"]),
+            }
+
+    def to_prometheus(self) -> str:
+        """Renders the counters and span timings in the Prometheus text exposition format."""
+        lines = []
+
+        with self.lock:
+            for counter_name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{counter_name}_total counter")
+                lines.extend(
+                    f"{PROMETHEUS_PREFIX}_{name}_total{format_prometheus_labels(labels)} {value:g}"
+                    for (name, labels), value in sorted(self.counters.items()) if name == counter_name
+                )
+
+            timings = sorted(self.timings.items())
+
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_span_seconds summary")
+            for (name, labels), timing in timings:
+                lines.append(f"{PROMETHEUS_PREFIX}_span_seconds_sum{format_prometheus_labels(labels, span=name)} {timing.total_seconds:.6f}")
+                lines.append(f"{PROMETHEUS_PREFIX}_span_seconds_count{format_prometheus_labels(labels, span=name)} {timing.count}")
+
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_span_max_seconds gauge")
+            lines.extend(f"{PROMETHEUS_PREFIX}_span_max_seconds{format_prometheus_labels(labels, span=name)} {timing.max_seconds:.6f}" for (name, labels), timing in timings)
+
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_span_errors_total counter")
+            lines.extend(f"{PROMETHEUS_PREFIX}_span_errors_total{format_prometheus_labels(labels, span=name)} {timing.errors}" for (name, labels), timing in timings)
+
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_run_duration_seconds gauge")
+            lines.append(f"{PROMETHEUS_PREFIX}_run_duration_seconds {time.perf_counter() - self.started:.6f}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_report(self) -> None:
+        """
+        Writes the run's metrics to METRICS_FILE, if set: in the Prometheus
+        text format when METRICS_FORMAT is "prometheus" (e.g. for the node
+        exporter's textfile collector), as a JSON run report otherwise.
+        """
+        metrics_file = config.get("METRICS_FILE")
+
+        if not metrics_file:
+            return
+
+        report = self.to_prometheus() if config.get("METRICS_FORMAT", "json") == "prometheus" else json.dumps(self.to_json(), indent=2)
+        write_atomically(Path(metrics_file), report)
+
+        logger.debug(f"Wrote metrics to {metrics_file}")
+
+    def log_summary(self) -> None:
+        """Logs where the run's time went, per span name."""
+        totals = defaultdict(SpanTiming)
+
+        with self.lock:
+            for (name, _), timing in self.timings.items():
+                totals[name].count += timing.count
+                totals[name].total_seconds += timing.total_seconds
+
+        for name, timing in sorted(totals.items(), key=lambda item: item[1].total_seconds, reverse=True):
+            logger.debug(f"{timing.total_seconds:8.3f} s in {timing.count} x {name}")
+
+metrics = Metrics()
@@ -1,18 +1,74 @@
+import numpy as np
+
 from enum import Enum
-from typing import TypedDict
+from typing import Iterator, TypedDict
+from functools import cached_property
+from collections.abc import Mapping
 from string import Template
-from datetime import date
+from datetime import date, datetime, timedelta
 
 class Interval(Enum):
+    QUARTER_HOURS = 2
+    HOURS = 3
     DAYS = 4
     WEEKS = 5
     MONTHS = 6
 
+    @property
+    def minutes(self) -> int or None:
+        """Length of a sub-daily interval in minutes, None for daily and longer ones."""
+        return {Interval.QUARTER_HOURS: 15, Interval.HOURS: 60}.get(self)
+
+    @property
+    def is_sub_daily(self) -> bool:
+        return self.minutes is not None
+
+    @property
+    def time_unit(self) -> str:
+        """The datetime64 unit series of this interval keep their timestamps in."""
+        return "m" if self.is_sub_daily else "D"
+
+def get_bucket_starts(dates: np.ndarray or np.datetime64, interval: Interval) -> np.ndarray or np.datetime64:
+    """Returns the first minute or day of the interval each date falls in."""
+    if interval.is_sub_daily:
+        minutes = dates.astype("datetime64[m]")
+        return minutes - minutes.astype(np.int64) % interval.minutes
+
+    dates = dates.astype("datetime64[D]")
+
+    if interval == Interval.WEEKS:
+        # 1970-01-01 was a Thursday, i.e. weekday 3
+        return dates - (dates.astype(np.int64) + 3) % 7
+
+    if interval == Interval.MONTHS:
+        return dates.astype("datetime64[M]").astype("datetime64[D]")
+
+    return dates
+
 class CounterConfig(TypedDict):
     id: str
     name: str
     url_template: Template
 
+class SinkConfig(TypedDict, total=False):
+    type: str
+    name: str
+    timeout_seconds: float
+    credentials_prefix: str
+    base_url: str
+    url: str
+    output_dir: str
+
+class TenantConfig(TypedDict):
+    id: str
+    chart_title: str
+    locale: str
+    tweet_template: Template or None
+    credentials_prefix: str
+    counters: list[CounterConfig]
+    sinks: list[SinkConfig]
+    data_quality_policy: str or None
+
 class CounterTemplateValues(TypedDict):
     start_date: str
     end_date: str
@@ -22,12 +78,207 @@ class DataPoint(TypedDict):
     date: date
     count: int
 
-CounterData = list[DataPoint]
+MISSING_COUNT = -1
+
+class DataPointView(Mapping):
+    """Read-only DataPoint pointing into a CounterSeries, so no dict or date is built until a key is read."""
+
+    __slots__ = ("series", "position")
+
+    def __init__(self, series: "CounterSeries", position: int):
+        self.series = series
+        self.position = position
+
+    def __getitem__(self, key: str) -> date or int:
+        if key == "date":
+            return self.series.date_at(self.position)
+
+        if key == "count":
+            return int(self.series.values[self.position])
+
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(("date", "count"))
+
+    def __len__(self) -> int:
+        return 2
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+class CounterSeries:
+    """
+    Counts of consecutive intervals from a start date on, kept in a single
+    contiguous array. Intervals without data hold MISSING_COUNT. Indexing,
+    slicing and iteration only see the intervals that have data, and yield
+    DataPointViews for callers that work point by point.
+
+    Sub-daily series keep their timestamps in minutes, so their "dates" are
+    datetimes; all other series keep days.
+
+    The positions of the intervals with data are found once, when first
+    needed, so looping over indices stays linear. The values must therefore
+    not be changed in place once the series was read.
+    """
+
+    def __init__(self, start: date or np.datetime64, interval: Interval, values: np.ndarray, dtype: type = np.int32):
+        # Buckets are dated by their first minute or day
+        self.start = get_bucket_starts(np.datetime64(start, interval.time_unit), interval)
+        self.interval = interval
+        self.values = np.asarray(values, dtype=dtype)
+
+    @classmethod
+    def from_dates(cls, dates: np.ndarray, counts: np.ndarray, interval: Interval = Interval.DAYS) -> "CounterSeries":
+        dates = np.asarray(dates, dtype=f"datetime64[{interval.time_unit}]")
+
+        if not len(dates):
+            return cls(date.min, interval, [])
+
+        series = cls(dates.min(), interval, [])
+        positions = series.positions_of(dates)
+
+        series.values = np.full(positions.max() + 1, MISSING_COUNT, dtype=np.int32)
+        series.values[positions] = counts
+
+        return series
+
+    @classmethod
+    def from_data_points(cls, data_points: list[DataPoint], interval: Interval = Interval.DAYS) -> "CounterSeries":
+        return cls.from_dates(
+            [data_point["date"] for data_point in data_points],
+            [data_point["count"] for data_point in data_points],
+            interval
+        )
+
+    def positions_of(self, dates: np.ndarray or date) -> np.ndarray or int:
+        dates = np.asarray(dates, dtype=f"datetime64[{self.interval.time_unit}]")
+
+        if self.interval.is_sub_daily:
+            return (dates - self.start).astype(np.int64) // self.interval.minutes
+
+        if self.interval == Interval.MONTHS:
+            return (dates.astype("datetime64[M]") - self.start.astype("datetime64[M]")).astype(np.int64)
+
+        days = (dates - self.start).astype(np.int64)
+        return days // 7 if self.interval == Interval.WEEKS else days
+
+    def dates_at(self, positions: np.ndarray or int) -> np.ndarray:
+        if self.interval.is_sub_daily:
+            return self.start + positions * self.interval.minutes
+
+        if self.interval == Interval.MONTHS:
+            return (self.start.astype("datetime64[M]") + positions).astype("datetime64[D]")
+
+        return self.start + positions * (7 if self.interval == Interval.WEEKS else 1)
+
+    def date_at(self, position: int) -> date:
+        return self.dates_at(position).item()
+
+    def reindex(self, start: np.datetime64, length: int) -> np.ndarray:
+        """Returns the values placed on a grid of the same interval beginning at start."""
+        grid = np.full(length, MISSING_COUNT, dtype=self.values.dtype)
+
+        if len(self.values):
+            offset = int(CounterSeries(start, self.interval, []).positions_of(self.start))
+            # Whatever lies outside the grid is cut off
+            overlap = self.values[max(-offset, 0):max(length - offset, 0)]
+            grid[max(offset, 0):max(offset, 0) + len(overlap)] = overlap
+
+        return grid
+
+    @property
+    def present(self) -> np.ndarray:
+        return self.values != MISSING_COUNT
+
+    @cached_property
+    def present_positions(self) -> np.ndarray:
+        return np.flatnonzero(self.present)
+
+    @property
+    def end(self) -> np.datetime64 or None:
+        return self.dates_at(len(self.values) - 1) if len(self.values) else None
+
+    @property
+    def dates(self) -> np.ndarray:
+        return self.dates_at(self.present_positions)
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self.values[self.present]
+
+    def __len__(self) -> int:
+        return len(self.present_positions)
+
+    def __getitem__(self, index: int or slice) -> DataPointView or "CounterSeries":
+        positions = self.present_positions[index]
+
+        if not isinstance(index, slice):
+            return DataPointView(self, int(positions))
+
+        if not len(positions):
+            return CounterSeries(self.start, self.interval, [], self.values.dtype)
+
+        if index.step not in (None, 1):
+            return CounterSeries.from_dates(self.dates_at(positions), self.values[positions], self.interval)
+
+        return CounterSeries(self.dates_at(positions[0]), self.interval, self.values[positions[0]:positions[-1] + 1], self.values.dtype)
+
+    def __iter__(self) -> Iterator[DataPointView]:
+        return (DataPointView(self, position) for position in self.present_positions.tolist())
+
+    def __repr__(self) -> str:
+        if not len(self):
+            return "CounterSeries([])"
+
+        return f"CounterSeries({len(self)} points from {self[0]['date']} to {self[-1]['date']}, total {self.total()})"
+
+    def count_for(self, day: date) -> int or None:
+        position = int(self.positions_of(day))
+
+        if not 0 <= position < len(self.values) or self.date_at(position) != day or self.values[position] == MISSING_COUNT:
+            return None
+
+        return int(self.values[position])
+
+    def between(self, start_date: date, end_date: date) -> "CounterSeries":
+        first_position = int(self.positions_of(start_date))
+        last_position = int(self.positions_of(end_date))
+
+        # A day without a time includes all of its sub-daily intervals
+        if self.interval.is_sub_daily and not isinstance(end_date, datetime):
+            last_position = int(self.positions_of(end_date + timedelta(days=1))) - 1
+
+        if self.dates_at(first_position) < np.datetime64(start_date, self.interval.time_unit):
+            first_position += 1
+
+        first_position = max(first_position, 0)
+        last_position = min(last_position, len(self.values) - 1)
+
+        if first_position > last_position:
+            return CounterSeries(start_date, self.interval, [], self.values.dtype)
+
+        return CounterSeries(self.dates_at(first_position), self.interval, self.values[first_position:last_position + 1], self.values.dtype)
+
+    def total(self) -> int:
+        return int(np.sum(self.values, where=self.present, dtype=np.int64))
+
+    def cumulative(self) -> "CounterSeries":
+        present = self.present
+        summed = np.cumsum(np.where(present, self.values, 0), dtype=np.int64)
+
+        return CounterSeries(self.start, self.interval, np.where(present, summed, MISSING_COUNT), np.int64)
+
+CounterData = CounterSeries
 
 class DateRange(TypedDict):
     start: date
     end: date
 
+class PeriodQuery(TypedDict):
+    period: DateRange
+    interval: Interval
+
 class CounterWithSingleCount(TypedDict):
     counter: CounterConfig
     count: int
@@ -42,6 +293,74 @@ class CountHighlights(TypedDict):
     most_recent_counts_sorted: list[CounterWithSingleCount]
     period_total_count: int
 
+class DataIssue(TypedDict):
+    kind: str
+    start: date
+    end: date
+    count: int or None
+    expected: float or None
+
+class CounterQualityReport(TypedDict):
+    counter_id: str
+    counter_name: str
+    first_date: date or None
+    completeness: float
+    reference_day_status: str
+    issues: list[DataIssue]
+
+class ReportType(Enum):
+    DAILY = "daily"
+    WEEKLY = "weekly"
+    MONTHLY = "monthly"
+    YEARLY = "yearly"
+
+class ReportDraft(TypedDict):
+    tenant_id: str
+    report_type: ReportType
+    reference_date: date
+    text: str
+    params: dict
+    input_hash: str
+    chart_title: str
+    locale: str
+    previous_year_totals: CounterData
+    current_year_totals: CounterData
+
+class Report(TypedDict):
+    tenant_id: str
+    report_type: ReportType
+    reference_date: date
+    text: str
+    params: dict
+    input_hash: str
+    image: bytes
+
+class Publication(TypedDict):
+    tenant_id: str
+    date: date
+    input_hash: str
+    output_hash: str
+    post_ids: list[str]
+    published_at: datetime
+
+class OutboxEntry(TypedDict):
+    tenant_id: str
+    date: date
+    sink: str
+    input_hash: str
+    output_hash: str
+    parts: list[str]
+    params: dict
+    media_filename: str
+    image: bytes or None
+    media_id: str or None
+    media_uploaded_at: datetime or None
+    post_ids: list[str]
+    not_before: datetime or None
+    attempts: int
+    last_error: str or None
+    created_at: datetime
+
 class YesterdaysResultsTweetParams(TypedDict):
     yesterdays_date: str
     count_total: int
@@ -57,3 +376,17 @@ class YesterdaysResultsTweetParams(TypedDict):
     percentage_change_emoji: str
     percentage_change_number: float
     more_or_missing_text: str
+
+class RecapTweetParams(TypedDict):
+    period_title: str
+    period_label: str
+    count_total: int
+    counter_name_1: str
+    counter_name_2: str
+    counter_name_3: str
+    counter_count_1: int
+    counter_count_2: int
+    counter_count_3: int
+    count_preceding_total: int
+    percentage_change_emoji: str
+    percentage_change_number: float
@@ -0,0 +1,173 @@
+import time
+import queue
+import logging
+import threading
+
+from datetime import datetime
+
+from eco_counter_bot.config import config
+from eco_counter_bot.models import OutboxEntry, Publication, TenantConfig
+from eco_counter_bot.count_store import get_count_store
+from eco_counter_bot.metrics import metrics
+from eco_counter_bot.utils import RateLimitedError
+from eco_counter_bot.replay import API_MODE
+from eco_counter_bot.sinks import OutputSink, create_sinks
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+# Longer rate limit waits are left to the next run, which resumes the post from the outbox
+MAX_RATE_LIMIT_WAIT_SECONDS = float(config.get("PUBLISH_MAX_RATE_LIMIT_WAIT_MINUTES", 20)) * 60
+
+# An entry that failed this often stays parked in the outbox and is not sent again until it is removed from there
+MAX_ATTEMPTS = int(config.get("PUBLISH_MAX_ATTEMPTS", 5))
+
+def is_parked(entry: OutboxEntry) -> bool:
+    return entry["attempts"] >= MAX_ATTEMPTS
+
+class Publisher:
+    """
+    Sends the posts of the outbox in the background, with one sender thread
+    per sink (or per account, for sinks sharing one), so sending to one sink
+    overlaps with sending to the others and with fetching and rendering for
+    other tenants, and a failure or rate limit only holds up the sink it
+    applies to.
+
+    Entries are saved to the outbox before they are queued, and every
+    uploaded image and posted part is saved as it happens. An entry that
+    failed or hit a long rate limit stays in the outbox and resume() picks it
+    up where it stopped, without running the pipeline again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues: dict[str, queue.Queue] = {}
+
+    def get_queue(self, sink: OutputSink) -> queue.Queue:
+        """Returns the queue of a sink, starting its sender thread on first use."""
+        with self.lock:
+            if sink.queue_key not in self.queues:
+                self.queues[sink.queue_key] = queue.Queue()
+                threading.Thread(target=self.run_sender, args=(sink, self.queues[sink.queue_key]), name=f"sender-{sink.queue_key}", daemon=True).start()
+
+            return self.queues[sink.queue_key]
+
+    def warm_up(self, sink: OutputSink) -> None:
+        """Starts the sink's sender, which e.g. authenticates while the post is still being made."""
+        self.get_queue(sink)
+
+    def enqueue(self, sink: OutputSink, entry: OutboxEntry) -> None:
+        get_count_store().put_outbox_entry(entry)
+        self.get_queue(sink).put((sink, entry))
+
+    def resume(self, tenants: list[TenantConfig]) -> None:
+        """Queues every entry left in the outbox by an earlier run."""
+        sinks = {}
+        tenants_without_sinks = set()
+
+        for tenant in tenants:
+            try:
+                sinks.update({(tenant["id"], sink.name): sink for sink in create_sinks(tenant)})
+            except Exception as e:
+                logger.error(f"Not resuming posts of tenant {tenant['id']}, its sinks could not be set up: {e}", exc_info=True)
+                tenants_without_sinks.add(tenant["id"])
+
+        for entry in get_count_store().get_outbox_entries():
+            sink = sinks.get((entry["tenant_id"], entry["sink"]))
+
+            if not sink and entry["tenant_id"] in tenants_without_sinks:
+                continue
+
+            if not sink:
+                logger.warning(f"Not resuming post of {entry['date']} for tenant {entry['tenant_id']}, it has no sink {entry['sink']} any more")
+                continue
+
+            if is_parked(entry):
+                logger.error(f"Not resuming post of {entry['date']} for tenant {entry['tenant_id']} to {entry['sink']}, it failed {entry['attempts']} times: {entry['last_error']}")
+                metrics.increment("publish_parked", tenant=entry["tenant_id"], sink=entry["sink"])
+                continue
+
+            logger.info(f"Resuming post of {entry['date']} for tenant {entry['tenant_id']} to {entry['sink']}, {len(entry['post_ids'])}/{len(entry['parts'])} parts already sent")
+            self.get_queue(sink).put((sink, entry))
+
+    def drain(self) -> None:
+        """Waits until every queued entry was sent or left in the outbox."""
+        with self.lock:
+            queues = list(self.queues.values())
+
+        for sender_queue in queues:
+            sender_queue.join()
+
+    def run_sender(self, sink: OutputSink, sender_queue: queue.Queue) -> None:
+        try:
+            sink.warm_up()
+        except Exception as e:
+            logger.error(f"Warming up sink {sink.name} failed: {e}", exc_info=True)
+
+        while True:
+            sink, entry = sender_queue.get()
+
+            try:
+                with metrics.span("send", tenant=entry["tenant_id"], sink=entry["sink"]):
+                    self.send_until_done(sink, entry)
+            except Exception as e:
+                self.record_failure(entry, e)
+            finally:
+                sender_queue.task_done()
+
+    def record_failure(self, entry: OutboxEntry, error: Exception) -> None:
+        logger.error(f"Error while sending post of {entry['date']} for tenant {entry['tenant_id']} to {entry['sink']}, it stays in the outbox: {error}", exc_info=True)
+        metrics.increment("publish_errors", tenant=entry["tenant_id"], sink=entry["sink"])
+        entry["attempts"] += 1
+        entry["last_error"] = str(error)
+
+        if is_parked(entry):
+            logger.error(f"Giving up on post of {entry['date']} for tenant {entry['tenant_id']} to {entry['sink']} after {entry['attempts']} attempts, it stays parked in the outbox")
+            metrics.increment("publish_parked", tenant=entry["tenant_id"], sink=entry["sink"])
+
+        # The sender has to keep going, or every later entry of its queue is stuck and drain() never returns
+        try:
+            get_count_store().update_outbox_progress(entry)
+        except Exception as e:
+            logger.error(f"Could not save the failed attempt at post of {entry['date']} for tenant {entry['tenant_id']} to {entry['sink']}: {e}", exc_info=True)
+
+    def send_until_done(self, sink: OutputSink, entry: OutboxEntry) -> None:
+        """Sends the entry, waiting out rate limits up to MAX_RATE_LIMIT_WAIT_SECONDS."""
+        while True:
+            wait_seconds = (entry["not_before"] - datetime.now()).total_seconds() if entry["not_before"] else 0
+
+            if wait_seconds > MAX_RATE_LIMIT_WAIT_SECONDS:
+                logger.warning(f"Rate limited by {entry['sink']} until {entry['not_before']}, leaving post of {entry['date']} for tenant {entry['tenant_id']} to the next run")
+                return
+
+            if wait_seconds > 0:
+                logger.info(f"Rate limited by {entry['sink']}, sending post of {entry['date']} for tenant {entry['tenant_id']} at {entry['not_before']}")
+                time.sleep(wait_seconds)
+
+            try:
+                self.send(sink, entry)
+                return
+            except RateLimitedError as e:
+                metrics.increment("publish_rate_limited", tenant=entry["tenant_id"], sink=entry["sink"])
+                entry["not_before"] = e.reset_at
+                get_count_store().update_outbox_progress(entry)
+
+    def send(self, sink: OutputSink, entry: OutboxEntry) -> None:
+        sink.send(entry, get_count_store().update_outbox_progress)
+
+        if config.get("DEV") or API_MODE == "replay":
+            logger.debug("Not recording publication since program is running in development or replay mode")
+            get_count_store().complete_outbox_entry(entry, None)
+            return
+
+        get_count_store().complete_outbox_entry(entry, Publication(
+            tenant_id=entry["tenant_id"],
+            date=entry["date"],
+            input_hash=entry["input_hash"],
+            output_hash=entry["output_hash"],
+            post_ids=[f"{entry['sink']}:{post_id}" for post_id in entry["post_ids"]],
+            published_at=datetime.now()
+        ))
+
+        logger.info(f"Published post of {entry['date']} for tenant {entry['tenant_id']} to {entry['sink']}")
+
+publisher = Publisher()
@@ -0,0 +1,37 @@
+import numpy as np
+
+from eco_counter_bot.models import Interval, CounterData, DateRange, PeriodQuery, get_bucket_starts
+
+def plan_daily_range(queries: list[PeriodQuery]) -> DateRange:
+    """Returns the single range of days needed to answer all queries, whatever their interval."""
+    return DateRange(
+        start=min(query["period"]["start"] for query in queries),
+        end=max(query["period"]["end"] for query in queries)
+    )
+
+def plan_base_interval(queries: list[PeriodQuery]) -> Interval:
+    """Returns the interval to load counts at: days, unless a query needs a sub-daily one, in which case the finest of those."""
+    finest_interval = min((query["interval"] for query in queries), key=lambda interval: interval.value)
+    return finest_interval if finest_interval.is_sub_daily else Interval.DAYS
+
+def aggregate_counts(counts: CounterData, interval: Interval) -> CounterData:
+    """Sums counts into buckets of the given coarser interval, each dated by its first minute or day."""
+    if interval == counts.interval:
+        return counts
+
+    # Weeks straddle month boundaries, so they cannot be summed into months
+    if interval.value < counts.interval.value or counts.interval == Interval.WEEKS:
+        raise ValueError(f"Cannot aggregate {counts.interval} counts into {interval}")
+
+    if not len(counts):
+        return CounterData(counts.start, interval, [])
+
+    bucket_starts = get_bucket_starts(counts.dates, interval)
+    boundaries = np.flatnonzero(np.diff(bucket_starts, prepend=bucket_starts[0] - 1))
+
+    return CounterData.from_dates(bucket_starts[boundaries], np.add.reduceat(counts.counts, boundaries), interval)
+
+def resolve_query(base_counts: CounterData, query: PeriodQuery) -> CounterData:
+    """Answers a query from counts at the base interval covering at least its period."""
+    period = query["period"]
+    return aggregate_counts(base_counts.between(period["start"], period["end"]), query["interval"])
@@ -0,0 +1,97 @@
+import io
+import gzip
+import json
+import hashlib
+import logging
+import requests
+
+from pathlib import Path
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+from eco_counter_bot.config import config
+from eco_counter_bot.utils import write_atomically
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+# "live" talks to the API, "record" also saves every response as a fixture, "replay" serves the fixtures instead
+API_MODE = config.get("API_MODE", "live")
+FIXTURES_DIR = Path(config.get("API_FIXTURES_DIR", "fixtures"))
+
+def get_fixture_path(fixtures_dir: Path, url: str) -> Path:
+    return fixtures_dir / f"{hashlib.sha256(url.encode()).hexdigest()}.json.gz"
+
+def write_fixture(fixtures_dir: Path, url: str, status_code: int, body: bytes) -> None:
+    fixture_path = get_fixture_path(fixtures_dir, url)
+    fixtures_dir.mkdir(parents=True, exist_ok=True)
+
+    write_atomically(fixture_path, gzip.compress(json.dumps({"url": url, "status_code": status_code, "body": body.decode("utf-8")}).encode("utf-8")))
+
+    logger.debug(f"Recorded {url} to {fixture_path}")
+
+class RecordingAdapter(HTTPAdapter):
+    """Sends requests as usual and saves every response, keyed by its URL, to a gzipped fixture."""
+
+    def __init__(self, fixtures_dir: Path, **kwargs):
+        super().__init__(**kwargs)
+        self.fixtures_dir = fixtures_dir
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        response = super().send(request, **kwargs)
+
+        # Reading the whole body here leaves it to be iterated over again by the caller
+        write_fixture(self.fixtures_dir, request.url, response.status_code, response.content)
+
+        return response
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Answers requests from the fixtures a RecordingAdapter saved, without any
+    network access. A request nothing was recorded for gets a 404, which
+    fails straight away instead of being retried.
+    """
+
+    def __init__(self, fixtures_dir: Path):
+        super().__init__()
+        self.fixtures_dir = fixtures_dir
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        fixture_path = get_fixture_path(self.fixtures_dir, request.url)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = "utf-8"
+
+        try:
+            with gzip.open(fixture_path, "rt", encoding="utf-8") as f:
+                fixture = json.load(f)
+        except FileNotFoundError:
+            logger.warning(f"No fixture recorded for {request.url} in {self.fixtures_dir}")
+            response.status_code = 404
+            response.raw = io.BytesIO(f"No fixture recorded for {request.url}".encode())
+            return response
+
+        response.status_code = fixture["status_code"]
+        response.headers["Content-Type"] = "application/json"
+        response.raw = io.BytesIO(fixture["body"].encode("utf-8"))
+
+        return response
+
+    def close(self) -> None:
+        pass
+
+def mount_transport(session: requests.Session, pool_maxsize: int) -> None:
+    """Sets up the session for API_MODE, recording to or replaying from FIXTURES_DIR."""
+    if API_MODE == "replay":
+        adapter = ReplayAdapter(FIXTURES_DIR)
+    elif API_MODE == "record":
+        adapter = RecordingAdapter(FIXTURES_DIR, pool_maxsize=pool_maxsize)
+    elif API_MODE == "live":
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+    else:
+        raise ValueError(f"Unknown API_MODE {API_MODE}, expected live, record or replay")
+
+    if API_MODE != "live":
+        logger.info(f"API requests {'are recorded to' if API_MODE == 'record' else 'are replayed from'} {FIXTURES_DIR}")
+
+    for prefix in ("https://", "http://"):
+        session.mount(prefix, adapter)
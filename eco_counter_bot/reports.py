@@ -0,0 +1,377 @@
+import os
+import logging
+import multiprocessing
+
+from pathlib import Path
+from functools import partial
+from string import Template
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from dateutil.relativedelta import relativedelta
+
+from eco_counter_bot.config import config
+from eco_counter_bot.utils import content_hash, format_number_for_locale, today
+from eco_counter_bot.models import CounterConfig, CounterData, CounterWithCounts, DateRange, Interval, PeriodQuery, RecapTweetParams, Report, ReportDraft, ReportType, TenantConfig, YesterdaysResultsTweetParams
+from eco_counter_bot.counter_service import get_counts_for_periods, get_counters_missing_day, extract_highlights, flatten
+from eco_counter_bot.count_store import get_count_store
+from eco_counter_bot.grapher import generate_yearly_plot
+from eco_counter_bot.metrics import metrics
+from eco_counter_bot.emojis import EMOJIS
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+# Processes rendering the images of a batch; each one starts its own image exporter
+REPORT_WORKERS = int(config.get("REPORT_WORKERS", min(4, os.cpu_count() or 1)))
+
+TWEET_TEMPLATE = Template(f"""Yesterday's {EMOJIS['BICYCLE']} counts ($yesterdays_date):
+
+{EMOJIS['CHECKERED_FLAG']} Total: $count_total
+
+Top 3:
+{EMOJIS['MEDAL_1']} $counter_name_1: $counter_count_1
+{EMOJIS['MEDAL_2']} $counter_name_2: $counter_count_2
+{EMOJIS['MEDAL_3']} $counter_name_3: $counter_count_3
+
+$year_reference year's total: $count_current_year_total
+Preceding year's total: $count_preceding_year_total
+Preceding year's relative total: $count_preceding_year_relative_total
+Change: $percentage_change_emoji $percentage_change_number%
+
+$more_or_missing_text
+""")
+
+MORE_TEXT = Template(f"$more more than last year's total! {EMOJIS['PARTY']}")
+MISSING_TEXT = Template(f"$missing missing compared to last year's total!")
+
+RECAP_TEMPLATE = Template(f"""$period_title {EMOJIS['BICYCLE']} counts ($period_label):
+
+{EMOJIS['CHECKERED_FLAG']} Total: $count_total
+
+Top 3:
+{EMOJIS['MEDAL_1']} $counter_name_1: $counter_count_1
+{EMOJIS['MEDAL_2']} $counter_name_2: $counter_count_2
+{EMOJIS['MEDAL_3']} $counter_name_3: $counter_count_3
+
+Same period last year: $count_preceding_total
+Change: $percentage_change_emoji $percentage_change_number%
+""")
+
+RECAP_TITLES = {
+    ReportType.WEEKLY: "Weekly",
+    ReportType.MONTHLY: "Monthly",
+    ReportType.YEARLY: "Yearly",
+}
+
+def is_current_year(reference_date: date, today: date) -> bool:
+    return reference_date.year == today.year
+
+def to_daily_total(counter_data: CounterData) -> CounterData:
+    return counter_data.cumulative()
+
+def get_report_period(report_type: ReportType, reference_date: date) -> DateRange:
+    """Returns the days a report covers: its day, week, month or year up to the reference date."""
+    if report_type == ReportType.WEEKLY:
+        start = reference_date - timedelta(days=reference_date.weekday())
+    elif report_type == ReportType.MONTHLY:
+        start = reference_date.replace(day=1)
+    elif report_type == ReportType.YEARLY:
+        start = reference_date.replace(month=1, day=1)
+    else:
+        start = reference_date
+
+    return DateRange(start=start, end=reference_date)
+
+def get_reference_dates(report_type: ReportType, start_date: date, end_date: date) -> list[date]:
+    """Returns the days between start_date and end_date that complete a period of the report type: every day, Sunday, last day of a month or 31 December."""
+    days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+
+    return [day for day in days if get_report_period(report_type, day + timedelta(days=1))["start"] == day + timedelta(days=1)]
+
+def get_dataset_range(reference_dates: list[date]) -> DateRange:
+    """Returns the days needed for reports on the given dates, which compare each one with the whole preceding year."""
+    return DateRange(start=date(min(reference_dates).year - 1, 1, 1), end=max(reference_dates))
+
+def get_percentage_change(current_total: int, preceding_total: int) -> float or None:
+    return (current_total - preceding_total) / preceding_total * 100 if preceding_total else None
+
+class ReportDataset:
+    """
+    The daily counts of a tenant's counters over a range of days, loaded once
+    and sliced for every report made from it. Counts that were changed after
+    loading, e.g. imputed ones, are not in the count store, so totals are
+    then summed from the counts themselves.
+    """
+
+    def __init__(self, tenant: TenantConfig, period: DateRange, counters_with_counts: list[CounterWithCounts], from_store: bool = True):
+        self.tenant = tenant
+        self.period = period
+        self.counters_with_counts = counters_with_counts
+        self.from_store = from_store
+        self.counter_ids = [counter["id"] for counter in tenant["counters"]]
+
+    @classmethod
+    def load(cls, tenant: TenantConfig, period: DateRange) -> "ReportDataset":
+        with metrics.span("load_counts", tenant=tenant["id"]):
+            counters_with_counts = get_counts_for_periods(tenant["counters"], [PeriodQuery(period=period, interval=Interval.DAYS)])[0]
+
+        return cls(tenant, period, counters_with_counts)
+
+    def with_counts(self, counters_with_counts: list[CounterWithCounts]) -> "ReportDataset":
+        return ReportDataset(self.tenant, self.period, counters_with_counts, from_store=False)
+
+    def without_counters(self, counters: list[CounterConfig]) -> "ReportDataset":
+        """Leaves the counters out of everything, including the totals."""
+        excluded_ids = {counter["id"] for counter in counters}
+
+        return ReportDataset(
+            TenantConfig(self.tenant, counters=[counter for counter in self.tenant["counters"] if counter["id"] not in excluded_ids]),
+            self.period,
+            [counter_with_counts for counter_with_counts in self.counters_with_counts if counter_with_counts["counter"]["id"] not in excluded_ids],
+            self.from_store
+        )
+
+    def between(self, start_date: date, end_date: date) -> list[CounterWithCounts]:
+        return [
+            CounterWithCounts(counter=counter_with_counts["counter"], counts=counter_with_counts["counts"].between(start_date, end_date))
+            for counter_with_counts in self.counters_with_counts
+        ]
+
+    def total(self, period: DateRange) -> int:
+        if not self.from_store:
+            return sum(counter_with_counts["counts"].total() for counter_with_counts in self.between(period["start"], period["end"]))
+
+        # Totals come from the precomputed rollups rather than from summing every day
+        return get_count_store().get_period_total(self.counter_ids, period["start"], period["end"])
+
+    def get_counters_missing_day(self, day: date) -> list:
+        return get_counters_missing_day(self.counters_with_counts, day)
+
+    def get_input_hash(self, reference_date: date, *contents) -> str:
+        """Hashes the given contents and all counts up to the reference date, so an unchanged report can be told apart before rendering."""
+        return content_hash(
+            reference_date, self.tenant["chart_title"], self.tenant["locale"], *contents,
+            *(
+                content
+                for counter_with_counts in self.between(self.period["start"], reference_date)
+                for content in (counter_with_counts["counter"]["id"], counter_with_counts["counts"].start, counter_with_counts["counts"].values)
+            )
+        )
+
+    def get_chart_totals(self, reference_date: date) -> tuple[CounterData, CounterData]:
+        """Returns the running totals of the whole preceding year and of the current year up to the reference date."""
+        current_year = get_report_period(ReportType.YEARLY, reference_date)
+        preceding_year_start = current_year["start"] + relativedelta(years=-1)
+
+        return (
+            to_daily_total(flatten([counter_with_counts["counts"] for counter_with_counts in self.between(preceding_year_start, current_year["start"] - timedelta(days=1))])),
+            to_daily_total(flatten([counter_with_counts["counts"] for counter_with_counts in self.between(current_year["start"], reference_date)])),
+        )
+
+def compose_daily_report(dataset: ReportDataset, reference_date: date, today: date) -> ReportDraft:
+    tenant = dataset.tenant
+    format_number = partial(format_number_for_locale, locale=tenant["locale"])
+
+    current_week = get_report_period(ReportType.WEEKLY, reference_date)
+    current_year_relative = get_report_period(ReportType.YEARLY, reference_date)
+
+    preceding_year_relative = DateRange(
+        start=current_year_relative["start"] + relativedelta(years=-1),
+        end=reference_date + relativedelta(years=-1)
+    )
+
+    preceding_year_full = DateRange(
+        start=preceding_year_relative["start"],
+        end=current_year_relative["start"] - timedelta(days=1)
+    )
+
+    current_week_highlights = extract_highlights(dataset.between(current_week["start"], current_week["end"]))
+
+    current_year_total = dataset.total(current_year_relative)
+    preceding_year_relative_total = dataset.total(preceding_year_relative)
+    preceding_year_full_total = dataset.total(preceding_year_full)
+
+    percentage_change = get_percentage_change(current_year_total, preceding_year_relative_total)
+
+    ordered_counts = current_week_highlights["most_recent_counts_sorted"]
+
+    excess_compared_to_last_year = current_year_total - preceding_year_full_total
+
+    more_or_missing_text = MORE_TEXT.substitute({ "more": format_number(excess_compared_to_last_year) }) \
+        if excess_compared_to_last_year >= 0 else MISSING_TEXT.substitute({ "missing": format_number(abs(excess_compared_to_last_year)) })
+
+    tweet_template_params = YesterdaysResultsTweetParams(
+        yesterdays_date = reference_date.strftime("%d/%m"),
+        count_total = format_number(current_week_highlights["most_recent_flattened_count"]),
+        counter_name_1 = ordered_counts[0]["counter"]["name"],
+        counter_name_2 = ordered_counts[1]["counter"]["name"],
+        counter_name_3 = ordered_counts[2]["counter"]["name"],
+        counter_count_1 = format_number(ordered_counts[0]["count"]),
+        counter_count_2 = format_number(ordered_counts[1]["count"]),
+        counter_count_3 = format_number(ordered_counts[2]["count"]),
+        year_reference = "This" if is_current_year(reference_date, today) else "Last",
+        count_current_year_total = format_number(current_year_total),
+        count_preceding_year_total = format_number(preceding_year_full_total),
+        count_preceding_year_relative_total = format_number(preceding_year_relative_total),
+        percentage_change_emoji = EMOJIS["DOWN_RIGHT_ARROW"] if percentage_change is not None and percentage_change < 0 else EMOJIS["UP_RIGHT_ARROW"],
+        percentage_change_number = format_number(round(percentage_change, 1)) if percentage_change is not None else "–",
+        more_or_missing_text = more_or_missing_text
+    )
+
+    logger.debug(f"Assembled tweet params: {tweet_template_params}")
+
+    template = tenant["tweet_template"] or TWEET_TEMPLATE
+    previous_year_totals, current_year_totals = dataset.get_chart_totals(reference_date)
+
+    return ReportDraft(
+        tenant_id=tenant["id"],
+        report_type=ReportType.DAILY,
+        reference_date=reference_date,
+        text=template.substitute(tweet_template_params),
+        params=dict(tweet_template_params),
+        input_hash=dataset.get_input_hash(reference_date, ReportType.DAILY.value, template.template, tweet_template_params["year_reference"]),
+        chart_title=tenant["chart_title"],
+        locale=tenant["locale"],
+        previous_year_totals=previous_year_totals,
+        current_year_totals=current_year_totals
+    )
+
+def get_period_label(report_type: ReportType, period: DateRange) -> str:
+    if report_type == ReportType.WEEKLY:
+        return f"{period['start'].strftime('%d/%m')} – {period['end'].strftime('%d/%m')}"
+
+    if report_type == ReportType.MONTHLY:
+        return period["end"].strftime("%B %Y")
+
+    return period["end"].strftime("%Y")
+
+def compose_recap(dataset: ReportDataset, report_type: ReportType, reference_date: date) -> ReportDraft:
+    """Sums up the week, month or year up to the reference date, with the counters ranked by their total over it."""
+    tenant = dataset.tenant
+    format_number = partial(format_number_for_locale, locale=tenant["locale"])
+
+    period = get_report_period(report_type, reference_date)
+    preceding_period = DateRange(start=period["start"] + relativedelta(years=-1), end=period["end"] + relativedelta(years=-1))
+
+    ranked_counters = sorted(
+        ((counter_with_counts["counter"], counter_with_counts["counts"].total()) for counter_with_counts in dataset.between(period["start"], period["end"])),
+        key=lambda counter_and_total: counter_and_total[1],
+        reverse=True
+    )
+
+    period_total = dataset.total(period)
+    preceding_period_total = dataset.total(preceding_period)
+    percentage_change = get_percentage_change(period_total, preceding_period_total)
+
+    tweet_template_params = RecapTweetParams(
+        period_title = RECAP_TITLES[report_type],
+        period_label = get_period_label(report_type, period),
+        count_total = format_number(period_total),
+        counter_name_1 = ranked_counters[0][0]["name"],
+        counter_name_2 = ranked_counters[1][0]["name"],
+        counter_name_3 = ranked_counters[2][0]["name"],
+        counter_count_1 = format_number(ranked_counters[0][1]),
+        counter_count_2 = format_number(ranked_counters[1][1]),
+        counter_count_3 = format_number(ranked_counters[2][1]),
+        count_preceding_total = format_number(preceding_period_total),
+        percentage_change_emoji = EMOJIS["DOWN_RIGHT_ARROW"] if percentage_change is not None and percentage_change < 0 else EMOJIS["UP_RIGHT_ARROW"],
+        percentage_change_number = format_number(round(percentage_change, 1)) if percentage_change is not None else "–"
+    )
+
+    logger.debug(f"Assembled recap params: {tweet_template_params}")
+
+    previous_year_totals, current_year_totals = dataset.get_chart_totals(reference_date)
+
+    return ReportDraft(
+        tenant_id=tenant["id"],
+        report_type=report_type,
+        reference_date=reference_date,
+        text=RECAP_TEMPLATE.substitute(tweet_template_params),
+        params=dict(tweet_template_params),
+        input_hash=dataset.get_input_hash(reference_date, report_type.value, RECAP_TEMPLATE.template),
+        chart_title=tenant["chart_title"],
+        locale=tenant["locale"],
+        previous_year_totals=previous_year_totals,
+        current_year_totals=current_year_totals
+    )
+
+def compose_report(dataset: ReportDataset, report_type: ReportType, reference_date: date, today: date) -> ReportDraft:
+    """Builds the text of a report and everything its image is rendered from, without rendering it."""
+    if report_type == ReportType.DAILY:
+        return compose_daily_report(dataset, reference_date, today)
+
+    return compose_recap(dataset, report_type, reference_date)
+
+def to_report(draft: ReportDraft, image: bytes) -> Report:
+    return Report(
+        tenant_id=draft["tenant_id"],
+        report_type=draft["report_type"],
+        reference_date=draft["reference_date"],
+        text=draft["text"],
+        params=draft["params"],
+        input_hash=draft["input_hash"],
+        image=image
+    )
+
+def render_report(draft: ReportDraft) -> Report:
+    return to_report(draft, generate_yearly_plot(draft["previous_year_totals"], draft["current_year_totals"], draft["chart_title"], draft["locale"]))
+
+def render_reports(drafts: list[ReportDraft]) -> list[Report]:
+    """
+    Renders the images of many reports. The image exporter only renders one
+    image at a time per process, so batches are spread over REPORT_WORKERS
+    processes. They are spawned rather than forked, as a forked process would
+    share the parent's exporter.
+    """
+    workers = min(REPORT_WORKERS, len(drafts))
+
+    if workers <= 1:
+        return [render_report(draft) for draft in drafts]
+
+    logger.info(f"Rendering {len(drafts)} reports in {workers} processes")
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        images = executor.map(
+            generate_yearly_plot,
+            [draft["previous_year_totals"] for draft in drafts],
+            [draft["current_year_totals"] for draft in drafts],
+            [draft["chart_title"] for draft in drafts],
+            [draft["locale"] for draft in drafts]
+        )
+
+        return [to_report(draft, image) for draft, image in zip(drafts, images)]
+
+def generate_reports(tenant: TenantConfig, report_type: ReportType, reference_dates: list[date], current_day: date or None = None) -> list[Report]:
+    """
+    Generates a report of the given type for every reference date from a
+    single dataset covering all of them. Dates some counter has no count for
+    are skipped.
+    """
+    if not reference_dates:
+        return []
+
+    current_day = current_day or today()
+    dataset = ReportDataset.load(tenant, get_dataset_range(reference_dates))
+    drafts = []
+
+    for reference_date in reference_dates:
+        missing_counters = dataset.get_counters_missing_day(reference_date)
+
+        if missing_counters:
+            logger.warning(f"Skipping {report_type.value} report of {reference_date} for tenant {tenant['id']}, no counts from {', '.join(counter['name'] for counter in missing_counters)}")
+            continue
+
+        drafts.append(compose_report(dataset, report_type, reference_date, current_day))
+
+    return render_reports(drafts)
+
+def write_reports(reports: list[Report], output_dir: str) -> None:
+    """Writes the text and image of every report to <output_dir>/<tenant>/<type>-<date>.txt and .png."""
+    for report in reports:
+        tenant_dir = Path(output_dir) / report["tenant_id"]
+        tenant_dir.mkdir(parents=True, exist_ok=True)
+
+        file_stem = f"{report['report_type'].value}-{report['reference_date'].isoformat()}"
+        (tenant_dir / f"{file_stem}.txt").write_text(report["text"], encoding="utf-8")
+        (tenant_dir / f"{file_stem}.png").write_bytes(report["image"])
+
+    logger.info(f"Wrote {len(reports)} reports to {output_dir}")
@@ -0,0 +1,52 @@
+import numpy as np
+
+from datetime import date, timedelta
+
+from eco_counter_bot.models import Interval, get_bucket_starts
+
+ROLLUP_KINDS = ("week", "month", "year")
+
+# Week and month buckets are those of the series of their interval; years are no interval of the API
+ROLLUP_INTERVALS = {
+    "week": Interval.WEEKS,
+    "month": Interval.MONTHS,
+}
+
+def get_rollup_bucket_starts(dates: np.ndarray, kind: str) -> np.ndarray:
+    if kind == "year":
+        return dates.astype("datetime64[Y]").astype("datetime64[D]")
+
+    return get_bucket_starts(dates, ROLLUP_INTERVALS[kind])
+
+def sum_by_bucket(dates: np.ndarray, values: np.ndarray, kind: str) -> list[tuple[str, int]]:
+    """Sums values per bucket of the given kind, returning (bucket start as ISO date, sum) pairs."""
+    buckets, bucket_indices = np.unique(get_rollup_bucket_starts(dates, kind), return_inverse=True)
+    sums = np.bincount(bucket_indices, weights=values, minlength=len(buckets)).astype(np.int64)
+
+    return list(zip(buckets.astype(str).tolist(), sums.tolist()))
+
+def split_period(start_date: date, end_date: date) -> tuple[list[tuple[date, date]], list[date], list[date]]:
+    """
+    Splits a period into as few pieces as possible: whole years, whole months
+    and the remaining ranges of loose days. Returns (day ranges, month
+    starts, year starts).
+    """
+    day_ranges, months, years = [], [], []
+    month_start = start_date.replace(day=1)
+
+    while month_start <= end_date:
+        next_month_start = (month_start + timedelta(days=32)).replace(day=1)
+        month_end = next_month_start - timedelta(days=1)
+        year_end = month_start.replace(month=12, day=31)
+
+        if month_start.month == 1 and start_date <= month_start and year_end <= end_date:
+            years.append(month_start)
+            month_start = year_end + timedelta(days=1)
+        elif start_date <= month_start and month_end <= end_date:
+            months.append(month_start)
+            month_start = next_month_start
+        else:
+            day_ranges.append((max(month_start, start_date), min(month_end, end_date)))
+            month_start = next_month_start
+
+    return day_ranges, months, years
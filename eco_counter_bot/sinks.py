@@ -0,0 +1,293 @@
+import json
+import base64
+import logging
+import requests
+
+from html import escape
+from abc import ABC, abstractmethod
+from pathlib import Path
+from string import Template
+from typing import Callable
+from datetime import datetime, timedelta
+
+from eco_counter_bot.config import config
+from eco_counter_bot.metrics import metrics
+from eco_counter_bot.models import OutboxEntry, SinkConfig, TenantConfig
+from eco_counter_bot.utils import RateLimitedError, write_atomically
+from eco_counter_bot.tweet_service import get_tweet_service, split_thread
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+DEFAULT_TIMEOUT_SECONDS = float(config.get("SINK_TIMEOUT_SECONDS", 30))
+
+# Tenants without a "sinks" list keep posting to Twitter only
+DEFAULT_SINKS = [SinkConfig(type="twitter")]
+
+DASHBOARD_TEMPLATE = Template("""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>$title</title>
+</head>
+<body>
+<h1>$title</h1>
+<pre>$text</pre>
+<img src="$image" alt="$title">
+</body>
+</html>
+""")
+
+class SinkError(Exception):
+    pass
+
+SaveProgress = Callable[[OutboxEntry], None]
+
+def get_credentials_prefix(tenant: TenantConfig, sink_config: SinkConfig) -> str:
+    return sink_config.get("credentials_prefix", tenant["credentials_prefix"])
+
+class OutputSink(ABC):
+    """
+    A channel posts are sent to. Every sink of a tenant gets its own outbox
+    entry and sender thread, so a slow, failing or rate limited sink does
+    not hold up the others, and each one gives up after its own timeout.
+    """
+
+    # Longer texts are split into a thread; None keeps them in one piece
+    max_length: int or None = None
+
+    # Keys the sink's config has to set, and settings read as <credentials_prefix><name>
+    required_keys: tuple[str, ...] = ()
+    required_credentials: tuple[str, ...] = ()
+
+    def __init__(self, tenant: TenantConfig, sink_config: SinkConfig):
+        errors = self.get_config_errors(tenant, sink_config)
+
+        if errors:
+            raise SinkError(f"Sink {sink_config.get('name', sink_config['type'])} of tenant {tenant['id']} {' and '.join(errors)}")
+
+        self.tenant = tenant
+        self.name = sink_config.get("name", sink_config["type"])
+        self.timeout_seconds = float(sink_config.get("timeout_seconds", DEFAULT_TIMEOUT_SECONDS))
+        self.credentials_prefix = get_credentials_prefix(tenant, sink_config)
+
+    @classmethod
+    def get_config_errors(cls, tenant: TenantConfig, sink_config: SinkConfig) -> list[str]:
+        """Describes what the sink's config lacks. Credentials are not needed in development mode, which sends nothing."""
+        errors = [f"needs a {key}" for key in cls.required_keys if not sink_config.get(key)]
+        prefix = get_credentials_prefix(tenant, sink_config)
+
+        if not config.get("DEV"):
+            errors += [f"needs {prefix}{name} to be set" for name in cls.required_credentials if not config.get(f"{prefix}{name}")]
+
+        return errors
+
+    @property
+    def queue_key(self) -> str:
+        """Sinks with the same key share a sender thread, e.g. all tenants posting to one account."""
+        return f"{self.tenant['id']}/{self.name}"
+
+    def split(self, text: str) -> list[str]:
+        return split_thread(text, max_length=self.max_length) if self.max_length else [text]
+
+    def warm_up(self) -> None:
+        pass
+
+    @abstractmethod
+    def send(self, entry: OutboxEntry, save_progress: SaveProgress) -> None:
+        """Sends what was not sent of the entry yet, adding the ids of the new posts to its post_ids."""
+
+class ThreadSink(OutputSink):
+    """Posts the parts of an entry as a thread replying to each other, the first one with the image."""
+
+    # Uploaded media expires on most services after a day
+    media_max_age = timedelta(hours=float(config.get("PUBLISH_MEDIA_MAX_AGE_HOURS", 23)))
+
+    @abstractmethod
+    def upload_media(self, filename: str, image: bytes) -> str or None:
+        pass
+
+    @abstractmethod
+    def post(self, text: str, media_ids: list[str] or None, reply_to: str or None, idempotency_key: str) -> str:
+        pass
+
+    def send(self, entry: OutboxEntry, save_progress: SaveProgress) -> None:
+        """Uploads the image and posts the parts that were not sent yet, saving progress after each step."""
+        # Only the first part carries the image, so it is not needed any more once that was posted
+        media_expired = entry["media_uploaded_at"] is None or datetime.now() - entry["media_uploaded_at"] > self.media_max_age
+
+        if entry["image"] is not None and not entry["post_ids"] and media_expired:
+            entry["media_id"] = self.upload_media(entry["media_filename"], entry["image"])
+            entry["media_uploaded_at"] = datetime.now()
+            save_progress(entry)
+
+        for index in range(len(entry["post_ids"]), len(entry["parts"])):
+            media_ids = [entry["media_id"]] if index == 0 and entry["media_id"] else None
+            reply_to = entry["post_ids"][-1] if entry["post_ids"] else None
+
+            entry["post_ids"].append(self.post(entry["parts"][index], media_ids, reply_to, f"{entry['output_hash']}-{index}"))
+            save_progress(entry)
+
+class TwitterSink(ThreadSink):
+    max_length = 280
+    required_credentials = ("TWITTER_API_KEY", "TWITTER_API_SECRET", "TWITTER_ACCESS_TOKEN", "TWITTER_ACCESS_SECRET")
+
+    @property
+    def queue_key(self) -> str:
+        # Rate limits apply per account
+        return f"twitter/{self.credentials_prefix}"
+
+    def warm_up(self) -> None:
+        if not config.get("DEV"):
+            get_tweet_service(self.credentials_prefix, self.timeout_seconds)
+
+    def upload_media(self, filename: str, image: bytes) -> str or None:
+        if config.get("DEV"):
+            logger.debug(f"Not uploading media to {self.name} since program is running in development mode")
+            return None
+
+        media = get_tweet_service(self.credentials_prefix, self.timeout_seconds).upload_media(filename, image)
+        return str(media.media_id) if media else None
+
+    def post(self, text: str, media_ids: list[str] or None, reply_to: str or None, idempotency_key: str) -> str:
+        if config.get("DEV"):
+            logger.debug(f"Not posting to {self.name} since program is running in development mode")
+            return "DEV_POST_ID"
+
+        return get_tweet_service(self.credentials_prefix, self.timeout_seconds).post(text, media_ids, reply_to)
+
+def raise_for_response(response: requests.Response, sink_name: str) -> None:
+    if response.status_code == 429:
+        retry_after = response.headers.get("Retry-After", "")
+        raise RateLimitedError(datetime.now() + timedelta(seconds=int(retry_after) if retry_after.isdigit() else 15 * 60))
+
+    if not response.ok:
+        raise SinkError(f"{sink_name} answered HTTP {response.status_code} {response.text[:200]}")
+
+class MastodonSink(ThreadSink):
+    """Posts to a Mastodon-compatible server with the access token in <credentials_prefix>MASTODON_ACCESS_TOKEN."""
+
+    max_length = 500
+    required_keys = ("base_url",)
+    required_credentials = ("MASTODON_ACCESS_TOKEN",)
+
+    def __init__(self, tenant: TenantConfig, sink_config: SinkConfig):
+        super().__init__(tenant, sink_config)
+        self.base_url = sink_config["base_url"].rstrip("/")
+        self.access_token = config.get(f"{self.credentials_prefix}MASTODON_ACCESS_TOKEN")
+
+    @property
+    def queue_key(self) -> str:
+        # Rate limits apply per account
+        return f"mastodon/{self.base_url}/{self.credentials_prefix}"
+
+    def request(self, path: str, **kwargs) -> dict:
+        with metrics.span("sink_request", sink=self.name):
+            response = requests.post(
+                f"{self.base_url}{path}", timeout=self.timeout_seconds,
+                headers={"Authorization": f"Bearer {self.access_token}", **kwargs.pop("headers", {})}, **kwargs
+            )
+
+        raise_for_response(response, self.name)
+        return response.json()
+
+    def upload_media(self, filename: str, image: bytes) -> str or None:
+        if config.get("DEV"):
+            logger.debug(f"Not uploading media to {self.name} since program is running in development mode")
+            return None
+
+        return str(self.request("/api/v2/media", files={"file": (filename, image, "image/png")})["id"])
+
+    def post(self, text: str, media_ids: list[str] or None, reply_to: str or None, idempotency_key: str) -> str:
+        if config.get("DEV"):
+            logger.debug(f"Not posting to {self.name} since program is running in development mode")
+            return "DEV_POST_ID"
+
+        status = {"status": text, "media_ids": media_ids or [], **({"in_reply_to_id": reply_to} if reply_to else {})}
+
+        # The server drops a repeated status with the same key, e.g. when the answer to the first attempt was lost
+        return str(self.request("/api/v1/statuses", json=status, headers={"Idempotency-Key": idempotency_key})["id"])
+
+class WebhookSink(OutputSink):
+    """POSTs the post as JSON, with its template parameters and the image as base64, to a URL."""
+
+    required_keys = ("url",)
+
+    def __init__(self, tenant: TenantConfig, sink_config: SinkConfig):
+        super().__init__(tenant, sink_config)
+        self.url = sink_config["url"]
+
+    def send(self, entry: OutboxEntry, save_progress: SaveProgress) -> None:
+        if entry["post_ids"]:
+            return
+
+        payload = {
+            "tenant_id": entry["tenant_id"],
+            "date": entry["date"].isoformat(),
+            "text": entry["parts"][0],
+            "params": entry["params"],
+            "image_png_base64": base64.b64encode(entry["image"]).decode("ascii") if entry["image"] is not None else None,
+        }
+
+        if config.get("DEV"):
+            logger.debug(f"Not calling {self.name} since program is running in development mode")
+            entry["post_ids"].append("DEV_POST_ID")
+            return
+
+        with metrics.span("sink_request", sink=self.name):
+            response = requests.post(self.url, json=payload, headers={"Idempotency-Key": entry["output_hash"]}, timeout=self.timeout_seconds)
+
+        raise_for_response(response, self.name)
+        entry["post_ids"].append(str(response.status_code))
+
+class StaticSink(OutputSink):
+    """
+    Writes every post to <output_dir>/<tenant>/ as <date>.json and <date>.png,
+    and the latest one to latest.json and an index.html dashboard.
+    """
+
+    def __init__(self, tenant: TenantConfig, sink_config: SinkConfig):
+        super().__init__(tenant, sink_config)
+        self.tenant_dir = Path(sink_config.get("output_dir", "public")) / tenant["id"]
+
+    @property
+    def queue_key(self) -> str:
+        return f"static/{self.tenant_dir}"
+
+    def send(self, entry: OutboxEntry, save_progress: SaveProgress) -> None:
+        self.tenant_dir.mkdir(parents=True, exist_ok=True)
+
+        day = entry["date"].isoformat()
+        image_name = f"{day}.png" if entry["image"] is not None else None
+        document = json.dumps({
+            "tenant_id": entry["tenant_id"],
+            "date": day,
+            "text": entry["parts"][0],
+            "params": entry["params"],
+            "image": image_name,
+        }, ensure_ascii=False, indent=2).encode("utf-8")
+
+        if image_name:
+            write_atomically(self.tenant_dir / image_name, entry["image"])
+
+        write_atomically(self.tenant_dir / f"{day}.json", document)
+
+        # A late retry of an older day must not replace the dashboard of a newer one
+        latest_path = self.tenant_dir / "latest.json"
+
+        if not latest_path.exists() or json.loads(latest_path.read_bytes())["date"] <= day:
+            write_atomically(latest_path, document)
+            write_atomically(self.tenant_dir / "index.html", DASHBOARD_TEMPLATE.substitute(
+                title=escape(self.tenant["chart_title"]), text=escape(entry["parts"][0]), image=image_name or ""
+            ).encode("utf-8"))
+
+        entry["post_ids"].append(str(self.tenant_dir / f"{day}.json"))
+
+SINK_TYPES: dict[str, type[OutputSink]] = {
+    "twitter": TwitterSink,
+    "mastodon": MastodonSink,
+    "webhook": WebhookSink,
+    "static": StaticSink,
+}
+
+def create_sinks(tenant: TenantConfig) -> list[OutputSink]:
+    return [SINK_TYPES[sink_config["type"]](tenant, sink_config) for sink_config in tenant["sinks"]]
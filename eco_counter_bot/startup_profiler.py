@@ -0,0 +1,42 @@
+import sys
+import logging
+import subprocess
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+# What each code path imports; heavy dependencies are only loaded when their path is taken
+STARTUP_PATHS = {
+    "entry point": "eco_counter_bot.__main__",
+    "rendering": "plotly.graph_objects, plotly.io",
+    "tweeting": "tweepy",
+    "number formatting": "babel.numbers",
+}
+
+def measure_imports(modules: str) -> list[tuple[int, int, str]]:
+    """Imports modules in a fresh interpreter and returns (self µs, cumulative µs, module) for everything it loaded."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {modules}"],
+        capture_output=True, text=True
+    )
+
+    timings = []
+
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        self_us, cumulative_us, module = line.removeprefix("import time:").split("|")
+        timings.append((int(self_us), int(cumulative_us), module.strip()))
+
+    return timings
+
+def profile_startup(top: int = 10) -> None:
+    """Logs how long each code path spends importing, and its most expensive imports."""
+    for path_name, modules in STARTUP_PATHS.items():
+        timings = measure_imports(modules)
+        total_ms = sum(self_us for self_us, _, _ in timings) / 1000
+
+        logger.info(f"{path_name} ({modules}): {total_ms:.1f} ms in {len(timings)} imports")
+
+        for _, cumulative_us, module in sorted(timings, reverse=True, key=lambda timing: timing[1])[:top]:
+            logger.info(f"    {cumulative_us / 1000:8.1f} ms  {module}")
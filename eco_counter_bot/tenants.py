@@ -0,0 +1,116 @@
+import json
+import logging
+
+from string import Template
+
+from eco_counter_bot.config import config
+from eco_counter_bot.models import CounterConfig, SinkConfig, TenantConfig
+from eco_counter_bot.sinks import DEFAULT_SINKS, SINK_TYPES
+from eco_counter_bot.data_quality import POLICIES
+from eco_counter_bot.counters import counters as luxembourg_counters, make_url_template
+
+logger = logging.getLogger(f"eco_counter_bot.{__name__}")
+
+# Every post ranks the top three counters
+MIN_COUNTERS = 3
+
+DEFAULT_TENANT = TenantConfig(
+    id="luxembourg",
+    chart_title="Luxembourg-City bike counts",
+    locale="lb_LU",
+    tweet_template=None,
+    credentials_prefix="",
+    counters=luxembourg_counters,
+    sinks=DEFAULT_SINKS,
+    data_quality_policy=None
+)
+
+def parse_tenant(raw_tenant: dict) -> TenantConfig:
+    """
+    Builds a tenant from its JSON definition, e.g.
+
+        {
+            "id": "luxembourg",
+            "organisation_id": 4586,
+            "chart_title": "Luxembourg-City bike counts",
+            "locale": "lb_LU",
+            "tweet_template": "Yesterday's counts ($yesterdays_date): $count_total ...",
+            "credentials_prefix": "LUXEMBOURG_",
+            "counters": [
+                {"id": "viaduc", "name": "Viaduc", "counter_id": 100065111, "flow_ids": [101065111, 102065111]}
+            ],
+            "sinks": [
+                {"type": "twitter"},
+                {"type": "mastodon", "base_url": "https://mastodon.example", "timeout_seconds": 20},
+                {"type": "webhook", "name": "dashboard-hook", "url": "https://example.com/hook"},
+                {"type": "static", "output_dir": "public"}
+            ],
+            "data_quality_policy": "exclude"
+        }
+
+    Counter ids are prefixed with the tenant id, so cities can reuse them
+    without sharing stored counts. Twitter credentials are read from
+    <credentials_prefix>TWITTER_API_KEY and so on, the Mastodon access token
+    from <credentials_prefix>MASTODON_ACCESS_TOKEN. Without "sinks", the
+    tenant posts to Twitter only. Sinks are named after their type unless
+    given a "name", which has to be unique within the tenant, and need the
+    keys and credentials their type requires. Without
+    "data_quality_policy", DATA_QUALITY_POLICY applies. Posts rank the top
+    counters, so a tenant needs at least MIN_COUNTERS of them.
+    """
+    tenant_id = raw_tenant["id"]
+
+    if len(raw_tenant["counters"]) < MIN_COUNTERS:
+        raise ValueError(f"Tenant {tenant_id} has {len(raw_tenant['counters'])} counters, posts need at least {MIN_COUNTERS}")
+
+    sinks = [SinkConfig(**raw_sink) for raw_sink in raw_tenant.get("sinks", DEFAULT_SINKS)]
+    credentials_prefix = raw_tenant.get("credentials_prefix", "")
+
+    for sink in sinks:
+        if sink.get("type") not in SINK_TYPES:
+            raise ValueError(f"Tenant {tenant_id} has a sink of unknown type {sink.get('type')}, expected one of {', '.join(SINK_TYPES)}")
+
+        errors = SINK_TYPES[sink["type"]].get_config_errors(TenantConfig(id=tenant_id, credentials_prefix=credentials_prefix), sink)
+
+        if errors:
+            raise ValueError(f"Sink {sink.get('name', sink['type'])} of tenant {tenant_id} {' and '.join(errors)}")
+
+    sink_names = [sink.get("name", sink["type"]) for sink in sinks]
+
+    if len(set(sink_names)) < len(sink_names):
+        raise ValueError(f"Tenant {tenant_id} has several sinks named alike, give them distinct names")
+
+    data_quality_policy = raw_tenant.get("data_quality_policy")
+
+    if data_quality_policy is not None and data_quality_policy not in POLICIES:
+        raise ValueError(f"Tenant {tenant_id} has unknown data quality policy {data_quality_policy}, expected one of {', '.join(POLICIES)}")
+
+    return TenantConfig(
+        id=tenant_id,
+        chart_title=raw_tenant.get("chart_title", f"{tenant_id} bike counts"),
+        locale=raw_tenant.get("locale", DEFAULT_TENANT["locale"]),
+        tweet_template=Template(raw_tenant["tweet_template"]) if raw_tenant.get("tweet_template") else None,
+        credentials_prefix=credentials_prefix,
+        counters=[
+            CounterConfig(
+                id=f"{tenant_id}/{raw_counter['id']}",
+                name=raw_counter["name"],
+                url_template=make_url_template(raw_tenant["organisation_id"], raw_counter["counter_id"], raw_counter["flow_ids"])
+            )
+            for raw_counter in raw_tenant["counters"]
+        ],
+        sinks=sinks,
+        data_quality_policy=data_quality_policy
+    )
+
+def load_tenants() -> list[TenantConfig]:
+    """Returns the tenants defined in the JSON file at TENANTS_FILE, or just Luxembourg if it is not set."""
+    tenants_file = config.get("TENANTS_FILE")
+
+    if not tenants_file:
+        return [DEFAULT_TENANT]
+
+    logger.debug(f"Loading tenants from {tenants_file}")
+
+    with open(tenants_file, encoding="utf-8") as f:
+        return [parse_tenant(raw_tenant) for raw_tenant in json.load(f)]
@@ -1,92 +1,111 @@
 import logging
-import tweepy
 
+from io import BytesIO
 from textwrap import wrap
-from tweepy.models import Media
+from functools import lru_cache
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Iterator
 
 from eco_counter_bot.config import config
+from eco_counter_bot.metrics import metrics
+from eco_counter_bot.utils import RateLimitedError, TimeoutAdapter
+
+if TYPE_CHECKING:
+    from tweepy.models import Media
 
 logger = logging.getLogger(f"eco_counter_bot.{__name__}")
 
+# Twitter's rate limit windows last 15 minutes
+DEFAULT_RATE_LIMIT_RESET = timedelta(minutes=15)
+
+@contextmanager
+def raise_rate_limits() -> Iterator[None]:
+    """Turns tweepy's rate limit errors into RateLimitedErrors telling when the limit resets."""
+    import tweepy
+
+    try:
+        yield
+    except tweepy.TooManyRequests as e:
+        reset = e.response.headers.get("x-rate-limit-reset") if e.response is not None else None
+        raise RateLimitedError(datetime.fromtimestamp(int(reset)) if reset else datetime.now() + DEFAULT_RATE_LIMIT_RESET) from e
+
+# Used for the Twitter API calls unless given otherwise
+DEFAULT_TIMEOUT_SECONDS = float(config.get("TWITTER_TIMEOUT_SECONDS", 60))
+
+def split_thread(text: str, extra_parts: list[str] = [], max_length: int = 280) -> list[str]:
+    """Splits text into numbered parts of at most max_length characters each, followed by extra_parts."""
+    parts = [text]
+
+    if len(text) > max_length:
+        logger.debug(f"Text longer than {max_length} chars, wrapping it")
+        raw_wrapped = wrap(text, max_length - 10, replace_whitespace=False)
+        parts = list(map(lambda part_tuple: f"{part_tuple[1]} {part_tuple[0]+1}/{len(raw_wrapped)}", enumerate(raw_wrapped)))
+
+    return [*parts, *extra_parts]
+
 class TweetService:
 
-    def __init__(self):
+    def __init__(self, credentials_prefix="", timeout_seconds=DEFAULT_TIMEOUT_SECONDS):
         self.api = None
         self.client = None
+        self.timeout_seconds = timeout_seconds
         self.do_authentication(
-            config.get("TWITTER_API_KEY"),
-            config.get("TWITTER_API_SECRET"),
-            config.get("TWITTER_ACCESS_TOKEN"),
-            config.get("TWITTER_ACCESS_SECRET")
+            config.get(f"{credentials_prefix}TWITTER_API_KEY"),
+            config.get(f"{credentials_prefix}TWITTER_API_SECRET"),
+            config.get(f"{credentials_prefix}TWITTER_ACCESS_TOKEN"),
+            config.get(f"{credentials_prefix}TWITTER_ACCESS_SECRET")
         )
 
     def do_authentication(self, consumer_key, consumer_secret, access_token, access_token_secret) -> None:
+        import tweepy
+
         logger.debug("Setting Twitter authentication")
 
         auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
         auth.set_access_token(access_token, access_token_secret)
 
-        self.api = tweepy.API(auth, wait_on_rate_limit=True)
+        # Rate limits raise RateLimitedError instead of blocking, so the caller decides whether to wait
+        self.api = tweepy.API(auth, wait_on_rate_limit=False, timeout=self.timeout_seconds)
         self.client = tweepy.Client(
             consumer_key=consumer_key, consumer_secret=consumer_secret,
             access_token=access_token, access_token_secret=access_token_secret,
-            wait_on_rate_limit=True
+            wait_on_rate_limit=False
         )
+        # The client sends its requests without a timeout of its own
+        self.client.session.mount("https://", TimeoutAdapter(self.timeout_seconds))
 
-    def upload_media(self, filename) -> Media:
+    def upload_media(self, filename, image=None) -> "Media":
+        """Uploads the file at filename, or the in-memory image bytes if given (filename then only sets the media type)."""
         if config.get("DEV"):
             logger.debug("Not uploading media since program is running in development mode")
             return None
 
         logger.debug(f"Uploading media with filename {filename}")
 
-        return self.api.media_upload(filename=filename)
+        with metrics.span("upload_media"), raise_rate_limits():
+            return self.api.media_upload(filename=filename, file=BytesIO(image) if image is not None else None)
 
-    def tweet_thread(self, text, lat=None, lon=None, media_filename=None, extra_parts=[], answer_to=None) -> list[str]:
-        logger.debug("Sending tweet (as thread if necessary)")
+    def post(self, text: str, media_ids: list[str] or None = None, reply_to: str or None = None) -> str:
+        """Posts a single tweet, optionally with media and as a reply, and returns its id."""
+        tweet_params = { 'text': text }
 
-        media = None
+        if media_ids:
+            tweet_params['media_ids'] = media_ids
 
-        if media_filename:
-            media = self.upload_media(media_filename)
-            logger.debug(f"Uploaded media: {media}")
+        if reply_to:
+            tweet_params['in_reply_to_tweet_id'] = reply_to
 
-        parts = [text]
+        logger.debug(f'Tweeting with params: {tweet_params}')
 
-        if len(text) > 280:
-            logger.debug("Text longer than 280 chars, wrapping it")
-            raw_wrapped = wrap(text, 270, replace_whitespace=False)
-            parts = list(map(lambda part_tuple: f"{part_tuple[1]} {part_tuple[0]+1}/{len(raw_wrapped)}", enumerate(raw_wrapped)))
-
-        parts.extend(extra_parts)
-        last_status = answer_to
-        tweet_ids = []
-
-        for index, part in enumerate(parts):
-            logger.debug(f"Tweeting part {index+1}/{len(parts)}")
-            tweet_params = { 'text': part }
-
-            if index == 0 and media:
-                tweet_params['media_ids'] = [media.media_id]
-
-            if last_status:
-                tweet_params['in_reply_to_tweet_id'] = last_status
-                #tweet_params['auto_populate_reply_metadata'] = True
-
-            #if lat and lon:
-            #    tweet_params['lat'] = lat
-            #    tweet_params['long'] = lon
-            #    tweet_params['display_coordinates'] = True
-
-            logger.debug(f'Tweeting with params: {tweet_params}')
-
-            if config.get("DEV"):
-                logger.debug("Not sending tweet since program is running in development mode")
-                return ["TWEET_ID1", "TWEET_ID2", "TWEET_ID3"]
-            else:
-                last_status = self.client.create_tweet(**tweet_params).data["id"]
-                tweet_ids.append(last_status)
+        if config.get("DEV"):
+            logger.debug("Not sending tweet since program is running in development mode")
+            return "DEV_TWEET_ID"
 
-        return tweet_ids
+        with metrics.span("create_tweet"), raise_rate_limits():
+            return str(self.client.create_tweet(**tweet_params).data["id"])
 
-tweet_service = TweetService()
+@lru_cache(maxsize=None)
+def get_tweet_service(credentials_prefix: str = "", timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS) -> TweetService:
+    """Creates and authenticates the TweetService for a set of credentials on first use, so runs that never tweet never load tweepy."""
+    return TweetService(credentials_prefix, timeout_seconds)
@@ -1,4 +1,93 @@
-from babel.numbers import format_number
+import os
+import time
+import hashlib
+import threading
+
+from pathlib import Path
+from datetime import date, datetime
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator
+from requests.adapters import HTTPAdapter
+
+from eco_counter_bot.config import config
+
+if TYPE_CHECKING:
+    import numpy as np
+
+def content_hash(*contents: "np.ndarray" or bytes or str or int) -> str:
+    """Hashes the contents in order; arrays by their raw values."""
+    digest = hashlib.sha256()
+
+    for content in contents:
+        if hasattr(content, "tobytes"):
+            content = content.tobytes()
+        elif not isinstance(content, bytes):
+            content = str(content).encode()
+
+        digest.update(content)
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+def today() -> date:
+    """The current day, unless TODAY (YYYY-MM-DD) is set to run as if it were that day."""
+    return date.fromisoformat(config["TODAY"]) if config.get("TODAY") else date.today()
+
+@contextmanager
+def replacing_atomically(path: Path) -> Iterator[Path]:
+    """Yields a temporary path to write to, which then replaces path in one step, so readers never see a half-written file."""
+    temporary_path = path.with_name(f".{path.name}.tmp")
+    temporary_path.unlink(missing_ok=True)
+
+    try:
+        yield temporary_path
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+
+    os.replace(temporary_path, path)
+
+def write_atomically(path: Path, content: bytes or str) -> None:
+    with replacing_atomically(path) as temporary_path:
+        temporary_path.write_bytes(content.encode("utf-8") if isinstance(content, str) else content)
+
+def format_number_for_locale(number: int or float, locale: str) -> str:
+    from babel.numbers import format_number
+
+    return format_number(number, locale)
 
 def format_number_lb(number: int or float) -> str:
-    return format_number(number, 'lb_LU')
+    return format_number_for_locale(number, 'lb_LU')
+
+class RateLimitedError(Exception):
+    """Raised when a service refuses requests until reset_at."""
+
+    def __init__(self, reset_at: datetime):
+        super().__init__(f"Rate limited until {reset_at}")
+        self.reset_at = reset_at
+
+class TimeoutAdapter(HTTPAdapter):
+    """Gives every request of a session a timeout, for clients that do not pass one themselves."""
+
+    def __init__(self, timeout: float or tuple[float, float], **kwargs):
+        super().__init__(**kwargs)
+        self.timeout = timeout
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+class RateLimiter:
+    """Spaces out calls to wait() so that at most `rate` of them return per second, across threads."""
+
+    def __init__(self, rate: float):
+        self.spacing = 1 / rate
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.spacing
+
+        time.sleep(slot - now)
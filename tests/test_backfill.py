@@ -0,0 +1,32 @@
+import pytest
+
+from datetime import date, timedelta
+
+from eco_counter_bot.backfill import iterate_chunks
+from eco_counter_bot.models import Interval
+
+@pytest.mark.parametrize("interval", [Interval.DAYS, Interval.WEEKS, Interval.MONTHS])
+def test_chunks_cover_the_range_without_overlap(interval):
+    chunks = list(iterate_chunks(date(2021, 3, 5), date(2023, 5, 10), interval, 92))
+
+    assert chunks[0]["end"] == date(2023, 5, 10)
+    assert chunks[-1]["start"] == date(2021, 3, 5)
+
+    for newer, older in zip(chunks, chunks[1:]):
+        assert older["end"] == newer["start"] - timedelta(days=1)
+
+@pytest.mark.parametrize("interval", [Interval.DAYS, Interval.WEEKS, Interval.MONTHS])
+def test_chunks_stay_the_same_from_one_day_to_the_next(interval):
+    chunks = list(iterate_chunks(date(2021, 3, 5), date(2023, 5, 10), interval, 92))
+    next_days_chunks = list(iterate_chunks(date(2021, 3, 5), date(2023, 5, 11), interval, 92))
+
+    # Only the newest chunk grows, every older one keeps its checkpoint
+    assert next_days_chunks[0] == {"start": chunks[0]["start"], "end": date(2023, 5, 11)}
+    assert next_days_chunks[1:] == chunks[1:]
+
+def test_week_and_month_chunks_start_on_their_boundaries():
+    for chunk in list(iterate_chunks(date(2021, 3, 5), date(2023, 5, 10), Interval.WEEKS, 92))[:-1]:
+        assert chunk["start"].weekday() == 0
+
+    for chunk in list(iterate_chunks(date(2021, 3, 5), date(2023, 5, 10), Interval.MONTHS, 92))[:-1]:
+        assert chunk["start"].day == 1
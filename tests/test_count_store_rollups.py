@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from datetime import date, timedelta
+
+from eco_counter_bot.count_store import CountStore
+from eco_counter_bot.models import MISSING_COUNT, CounterData, DateRange, Interval
+
+START = date(2022, 11, 20)
+END = date(2024, 2, 10)
+
+PERIODS = [
+    (START, END),
+    (date(2023, 1, 1), date(2023, 12, 31)),
+    (date(2023, 3, 1), date(2023, 3, 31)),
+    (date(2023, 2, 14), date(2023, 7, 3)),
+    (date(2022, 12, 31), date(2023, 1, 1)),
+    (date(2024, 1, 1), date(2024, 2, 10)),
+]
+
+def make_counts(start: date, end: date, seed: int) -> CounterData:
+    days = (end - start).days + 1
+    return CounterData(start, Interval.DAYS, np.random.default_rng(seed).integers(0, 2000, days))
+
+def sum_daily_counts(store: CountStore, counter_id: str, start: date, end: date) -> int:
+    return store.get_counts(counter_id, start, end).total()
+
+def assert_totals_match_daily_counts(store: CountStore, counter_ids: list[str]) -> None:
+    for start, end in PERIODS:
+        expected = sum(sum_daily_counts(store, counter_id, start, end) for counter_id in counter_ids)
+        assert store.get_period_total(counter_ids, start, end) == expected, (start, end)
+
+@pytest.fixture
+def store() -> CountStore:
+    return CountStore(":memory:")
+
+def test_totals_match_daily_counts(store):
+    store.put_counts("a", DateRange(start=START, end=END), make_counts(START, END, 1))
+    store.put_counts("b", DateRange(start=START, end=END), make_counts(START, END, 2))
+
+    assert_totals_match_daily_counts(store, ["a"])
+    assert_totals_match_daily_counts(store, ["a", "b"])
+
+def test_overlapping_corrections_replace_rather_than_add(store):
+    store.put_counts("a", DateRange(start=START, end=END), make_counts(START, END, 1))
+
+    # Corrections overlapping each other and crossing month and year boundaries
+    for seed, (start, end) in enumerate([(date(2023, 1, 15), date(2023, 4, 2)), (date(2022, 12, 20), date(2023, 2, 1)), (date(2023, 3, 30), date(2023, 3, 30))], start=10):
+        store.put_counts("a", DateRange(start=start, end=end), make_counts(start, end, seed))
+
+    assert_totals_match_daily_counts(store, ["a"])
+
+def test_gaps_count_as_nothing(store):
+    counts = make_counts(START, END, 1)
+    store.put_counts("a", DateRange(start=START, end=END), counts)
+
+    with_gaps = CounterData(START, Interval.DAYS, counts.values.copy())
+    with_gaps.values[30:60] = MISSING_COUNT
+    store.put_counts("a", DateRange(start=START, end=END), with_gaps)
+
+    assert store.get_counts("a", START + timedelta(days=30), START + timedelta(days=59)).total() == 0
+    assert_totals_match_daily_counts(store, ["a"])
+
+def test_rollups_are_rebuilt_when_missing(tmp_path):
+    path = str(tmp_path / "counts.sqlite")
+    store = CountStore(path)
+    store.put_counts("a", DateRange(start=START, end=END), make_counts(START, END, 1))
+    expected = [store.get_period_total(["a"], start, end) for start, end in PERIODS]
+
+    store.write([("DELETE FROM rollups", [()])])
+    store.connection.close()
+
+    assert [CountStore(path).get_period_total(["a"], start, end) for start, end in PERIODS] == expected
@@ -0,0 +1,108 @@
+import pytest
+import requests
+
+from eco_counter_bot import counter_api
+from eco_counter_bot.counter_api import CircuitBreaker, CircuitOpenError, EcoCounterApiError, RetryableApiError, fetch_counts
+from eco_counter_bot.models import Interval
+
+HOST = "counters.test"
+URL = f"http://{HOST}/counts"
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+class Response:
+    def __init__(self, status_code: int, body: bytes = b"[]"):
+        self.status_code = status_code
+        self.body = body
+        self.text = body.decode()
+
+    def __enter__(self) -> "Response":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def iter_content(self, chunk_size: int) -> list[bytes]:
+        return [self.body]
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(counter_api.time, "monotonic", clock)
+    return clock
+
+@pytest.fixture
+def breaker(monkeypatch) -> CircuitBreaker:
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+    monkeypatch.setitem(counter_api.circuit_breakers, HOST, breaker)
+    return breaker
+
+def respond(monkeypatch, response) -> None:
+    def get(url: str, **kwargs) -> Response:
+        if isinstance(response, Exception):
+            raise response
+
+        return response
+
+    monkeypatch.setattr(counter_api.session, "get", get)
+
+def test_circuit_opens_after_consecutive_failures(clock, breaker):
+    breaker.before_request(HOST)
+    breaker.record_failure(HOST)
+    breaker.before_request(HOST)
+    breaker.record_failure(HOST)
+
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request(HOST)
+
+def test_success_resets_the_failure_count(clock, breaker):
+    breaker.record_failure(HOST)
+    breaker.record_success()
+    breaker.record_failure(HOST)
+
+    breaker.before_request(HOST)
+
+def test_half_open_circuit_lets_one_trial_through(clock, breaker):
+    breaker.record_failure(HOST)
+    breaker.record_failure(HOST)
+    clock.now += 60
+
+    breaker.before_request(HOST)
+
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request(HOST)
+
+def test_failed_trial_opens_the_circuit_again(clock, breaker, monkeypatch):
+    breaker.record_failure(HOST)
+    breaker.record_failure(HOST)
+    clock.now += 60
+    respond(monkeypatch, requests.ConnectionError("refused"))
+
+    with pytest.raises(RetryableApiError):
+        fetch_counts(URL, Interval.DAYS)
+
+    clock.now += 59
+
+    with pytest.raises(CircuitOpenError):
+        fetch_counts(URL, Interval.DAYS)
+
+@pytest.mark.parametrize("response", [Response(200, b'[["01/01/2024", "5"]]'), Response(404, b"not found")])
+def test_answered_trial_closes_the_circuit(clock, breaker, monkeypatch, response):
+    breaker.record_failure(HOST)
+    breaker.record_failure(HOST)
+    clock.now += 60
+    respond(monkeypatch, response)
+
+    try:
+        fetch_counts(URL, Interval.DAYS)
+    except EcoCounterApiError as e:
+        assert not isinstance(e, RetryableApiError)
+
+    assert breaker.opened_at is None
+    assert breaker.failures == 0
+    breaker.before_request(HOST)
@@ -0,0 +1,48 @@
+import json
+
+from datetime import date, datetime
+
+from eco_counter_bot.counter_api import parse_counts_stream
+from eco_counter_bot.models import Interval
+from eco_counter_bot.data_quality import duplicate_dates
+
+def to_chunks(data_points: list[list[str]], chunk_size: int) -> list[bytes]:
+    payload = json.dumps(data_points).encode()
+    return [payload[start:start + chunk_size] for start in range(0, len(payload), chunk_size)]
+
+def test_series_without_gaps():
+    data_points = [[f"01/{day:02d}/2024", str(day * 10)] for day in range(1, 32)]
+
+    for chunk_size in (1, 7, 4096):
+        series = parse_counts_stream(to_chunks(data_points, chunk_size), Interval.DAYS)
+
+        assert series.start.item() == date(2024, 1, 1)
+        assert series.counts.tolist() == [day * 10 for day in range(1, 32)]
+        assert series.dates.tolist()[-1] == date(2024, 1, 31)
+
+def test_gaps_keep_later_counts_on_their_dates():
+    data_points = [["12/30/2023", "1"], ["12/31/2023", "2"], ["01/03/2024", "3"], ["01/04/2024", "4"]]
+    series = parse_counts_stream(to_chunks(data_points, 5), Interval.DAYS)
+
+    assert series.dates.tolist() == [date(2023, 12, 30), date(2023, 12, 31), date(2024, 1, 3), date(2024, 1, 4)]
+    assert series.counts.tolist() == [1, 2, 3, 4]
+    assert series.count_for(date(2024, 1, 1)) is None
+
+def test_sub_daily_gaps():
+    data_points = [["03/01/2024 00:00", "1"], ["03/01/2024 00:15", "2"], ["03/01/2024 01:00", "3"]]
+    series = parse_counts_stream(to_chunks(data_points, 9), Interval.QUARTER_HOURS)
+
+    assert series.dates.tolist() == [datetime(2024, 3, 1, 0, 0), datetime(2024, 3, 1, 0, 15), datetime(2024, 3, 1, 1, 0)]
+    assert series.counts.tolist() == [1, 2, 3]
+
+def test_empty_response():
+    assert len(parse_counts_stream([b"[]"], Interval.DAYS)) == 0
+
+def test_repeated_dates_keep_their_last_count():
+    # A repeated date offset by a gap spans as many days as a gap-free series would
+    data_points = [["06/01/2024", "5"], ["06/02/2024", "6"], ["06/02/2024", "7"], ["06/04/2024", "8"]]
+    series = parse_counts_stream(to_chunks(data_points, 11), Interval.DAYS, "test/repeated")
+
+    assert series.dates.tolist() == [date(2024, 6, 1), date(2024, 6, 2), date(2024, 6, 4)]
+    assert series.counts.tolist() == [5, 7, 8]
+    assert duplicate_dates["test/repeated"] == {date(2024, 6, 2)}
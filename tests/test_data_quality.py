@@ -0,0 +1,192 @@
+import json
+import numpy as np
+import pytest
+
+from collections import defaultdict
+from datetime import date, timedelta
+
+from eco_counter_bot import bot, data_quality, reports
+from eco_counter_bot.config import config
+from eco_counter_bot.count_store import CountStore
+from eco_counter_bot.counter_service import DataNotReadyException, extract_highlights
+from eco_counter_bot.data_quality import QualityCheck, record_duplicate_dates, report_quality
+from eco_counter_bot.models import MISSING_COUNT, CounterConfig, CounterData, CounterWithCounts, DateRange, Interval, TenantConfig
+from eco_counter_bot.reports import ReportDataset, ReportType, get_report_period
+
+START = date(2024, 1, 1)
+DAY = date(2024, 3, 10)
+DAYS = (DAY - START).days + 1
+
+COUNTERS = [CounterConfig(id=f"quality-{name}", name=name, url_template=None) for name in ("a", "b", "c", "d")]
+
+TENANT = TenantConfig(id="test", chart_title="Test", locale="en", tweet_template=None, credentials_prefix="TEST_", counters=COUNTERS, sinks=[], data_quality_policy=None)
+
+def make_values(seed: int) -> np.ndarray:
+    """Daily counts with a weekly pattern and some noise, like a busy counter's."""
+    weekdays = (np.arange(DAYS) + START.weekday()) % 7
+    return (np.random.default_rng(seed).poisson(400 + 40 * weekdays)).astype(np.int32)
+
+def make_dataset(**changes: dict[int, int]) -> ReportDataset:
+    """Builds a dataset whose counters count normally, except for the counts of the given days, keyed by counter name."""
+    counters_with_counts = []
+
+    for seed, counter in enumerate(COUNTERS):
+        values = make_values(seed)
+
+        for offset, count in changes.get(counter["name"], {}).items():
+            values[offset] = count
+
+        counters_with_counts.append(CounterWithCounts(counter=counter, counts=CounterData(START, Interval.DAYS, values)))
+
+    return ReportDataset(TENANT, DateRange(start=START, end=DAY), counters_with_counts)
+
+def offset_of(day: date) -> int:
+    return (day - START).days
+
+def get_report(check: QualityCheck, name: str) -> dict:
+    return next(report for report in check.reports if report["counter_name"] == name)
+
+def get_issues(check: QualityCheck, name: str, kind: str) -> list[tuple[date, date]]:
+    return [(issue["start"], issue["end"]) for issue in get_report(check, name)["issues"] if issue["kind"] == kind]
+
+@pytest.fixture(autouse=True)
+def no_recorded_duplicates(monkeypatch):
+    monkeypatch.setattr(data_quality, "duplicate_dates", defaultdict(set))
+
+@pytest.fixture
+def get_dataset_when_ready(monkeypatch):
+    """Runs bot.get_dataset_when_ready for DAY on the given counts under the given policy, without polling."""
+    def run(dataset: ReportDataset, policy: str) -> ReportDataset:
+        monkeypatch.setattr(ReportDataset, "load", classmethod(lambda cls, tenant, period: dataset))
+        return bot.get_dataset_when_ready(TenantConfig(TENANT, data_quality_policy=policy), dataset.period, DAY)
+
+    monkeypatch.setitem(config, "POLL_UNTIL_READY_MINUTES", 0)
+    return run
+
+@pytest.fixture
+def store(monkeypatch) -> CountStore:
+    store = CountStore(":memory:")
+    monkeypatch.setattr(reports, "get_count_store", lambda: store)
+    return store
+
+def test_imputed_daily_total_matches_year_to_date_totals(store):
+    dataset = make_dataset(c={offset_of(DAY): MISSING_COUNT})
+
+    for counter_with_counts in dataset.counters_with_counts:
+        store.put_counts(counter_with_counts["counter"]["id"], dataset.period, counter_with_counts["counts"])
+
+    check = QualityCheck(dataset.counters_with_counts, DAY)
+    imputed = bot.apply_quality_policy(dataset, check, "impute", check.get_counters(("missing", "suspect")))
+
+    daily_total = extract_highlights(imputed.between(DAY, DAY))["most_recent_flattened_count"]
+    year_to_date = get_report_period(ReportType.YEARLY, DAY)
+    year_to_day_before = DateRange(start=year_to_date["start"], end=DAY - timedelta(days=1))
+
+    assert imputed.total(year_to_date) - imputed.total(year_to_day_before) == daily_total
+    assert imputed.total(year_to_date) > dataset.total(year_to_date)
+
+def test_clean_counts_have_no_issues():
+    check = QualityCheck(make_dataset().counters_with_counts, DAY)
+
+    for report in check.reports:
+        assert report["issues"] == []
+        assert report["reference_day_status"] == "ok"
+        assert report["completeness"] == 1.0
+        assert report["first_date"] == START
+
+def test_gaps_are_found_from_the_first_count_on():
+    dataset = make_dataset(a={offset: MISSING_COUNT for offset in (0, 1, 20, 21, 22)})
+    check = QualityCheck(dataset.counters_with_counts, DAY)
+
+    assert get_issues(check, "a", "gap") == [(date(2024, 1, 21), date(2024, 1, 23))]
+    assert get_report(check, "a")["first_date"] == date(2024, 1, 3)
+    assert get_report(check, "a")["completeness"] == round((DAYS - 5) / (DAYS - 2), 4)
+
+def test_zero_runs_need_several_days():
+    dataset = make_dataset(a={30: 0, 31: 0, 32: 0}, b={40: 0})
+    check = QualityCheck(dataset.counters_with_counts, DAY)
+
+    assert get_issues(check, "a", "zero_run") == [(date(2024, 1, 31), date(2024, 2, 2))]
+    assert get_issues(check, "b", "zero_run") == []
+
+def test_outliers_are_compared_to_the_same_weekday():
+    check = QualityCheck(make_dataset(a={50: 5000}).counters_with_counts, DAY)
+    [outlier] = [issue for issue in get_report(check, "a")["issues"] if issue["kind"] == "outlier"]
+
+    assert (outlier["start"], outlier["count"]) == (date(2024, 2, 20), 5000)
+    assert 400 < outlier["expected"] < 700
+
+def test_day_all_counters_change_on_is_no_outlier():
+    check = QualityCheck(make_dataset(**{counter["name"]: {50: 4 * make_values(seed)[50]} for seed, counter in enumerate(COUNTERS)}).counters_with_counts, DAY)
+
+    assert all(get_issues(check, counter["name"], "outlier") == [] for counter in COUNTERS)
+
+def test_recorded_duplicates_are_reported():
+    record_duplicate_dates("quality-a", np.array(["2024-02-01", "2023-06-01"], dtype="datetime64[D]"))
+    check = QualityCheck(make_dataset().counters_with_counts, DAY)
+
+    # Dates outside the checked days belong to another report
+    assert get_issues(check, "a", "duplicate") == [(date(2024, 2, 1), date(2024, 2, 1))]
+
+@pytest.mark.parametrize("changes, status", [
+    ({}, "ok"),
+    ({offset_of(DAY): MISSING_COUNT}, "missing"),
+    ({offset_of(DAY): 5000}, "suspect"),
+    ({offset_of(DAY) - 1: 0, offset_of(DAY): 0}, "suspect"),
+])
+def test_reference_day_status(changes, status):
+    check = QualityCheck(make_dataset(a=changes).counters_with_counts, DAY)
+
+    assert get_report(check, "a")["reference_day_status"] == status
+    assert check.get_counters(("missing", "suspect")) == ([] if status == "ok" else [COUNTERS[0]])
+
+def test_duplicate_reference_day_is_suspect():
+    record_duplicate_dates("quality-a", np.array([DAY], dtype="datetime64[D]"))
+    check = QualityCheck(make_dataset().counters_with_counts, DAY)
+
+    assert get_report(check, "a")["reference_day_status"] == "suspect"
+
+def test_report_policy_only_waits_for_missing_counts(get_dataset_when_ready):
+    dataset = get_dataset_when_ready(make_dataset(a={offset_of(DAY): 5000}), "report")
+    assert dataset.counters_with_counts[0]["counts"].count_for(DAY) == 5000
+
+    with pytest.raises(DataNotReadyException):
+        get_dataset_when_ready(make_dataset(a={offset_of(DAY): MISSING_COUNT}), "report")
+
+def test_impute_policy_fills_in_expected_counts(get_dataset_when_ready):
+    dataset = make_dataset(a={offset_of(DAY): MISSING_COUNT})
+    imputed = get_dataset_when_ready(dataset, "impute")
+    check = QualityCheck(dataset.counters_with_counts, DAY)
+
+    assert imputed.counters_with_counts[0]["counts"].count_for(DAY) == round(check.expected[0, check.day_position])
+    assert [counter_with_counts["counts"].count_for(DAY) for counter_with_counts in imputed.counters_with_counts[1:]] == [
+        counter_with_counts["counts"].count_for(DAY) for counter_with_counts in dataset.counters_with_counts[1:]
+    ]
+
+def test_impute_policy_needs_a_history(get_dataset_when_ready):
+    # Without counts of the same weekday before there is nothing to expect
+    with pytest.raises(DataNotReadyException):
+        get_dataset_when_ready(make_dataset(a={offset: MISSING_COUNT for offset in range(offset_of(DAY) % 7, offset_of(DAY) + 1, 7)}), "impute")
+
+def test_exclude_policy_leaves_bad_counters_out(get_dataset_when_ready):
+    excluded = get_dataset_when_ready(make_dataset(a={offset_of(DAY): MISSING_COUNT}), "exclude")
+
+    assert excluded.counter_ids == [counter["id"] for counter in COUNTERS[1:]]
+    assert [counter_with_counts["counter"] for counter_with_counts in excluded.counters_with_counts] == COUNTERS[1:]
+
+def test_exclude_policy_keeps_enough_counters(get_dataset_when_ready):
+    with pytest.raises(DataNotReadyException):
+        get_dataset_when_ready(make_dataset(a={offset_of(DAY): MISSING_COUNT}, b={offset_of(DAY): MISSING_COUNT}), "exclude")
+
+def test_delay_policy_does_not_post(get_dataset_when_ready):
+    with pytest.raises(DataNotReadyException):
+        get_dataset_when_ready(make_dataset(a={offset_of(DAY): 5000}), "delay")
+
+def test_report_is_written_to_the_report_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(config, "DATA_QUALITY_REPORT_DIR", str(tmp_path))
+    report_quality(TENANT, QualityCheck(make_dataset(a={offset_of(DAY): MISSING_COUNT}).counters_with_counts, DAY))
+
+    report = json.loads((tmp_path / "test.json").read_text(encoding="utf-8"))
+
+    assert report["date"] == DAY.isoformat()
+    assert [counter["reference_day_status"] for counter in report["counters"]] == ["missing", "ok", "ok", "ok"]
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from datetime import date, datetime
+
+from eco_counter_bot.models import MISSING_COUNT, CounterSeries, Interval
+
+def make_series(start: date, interval: Interval, values: list[int]) -> CounterSeries:
+    return CounterSeries(start, interval, np.array(values, dtype=np.int32))
+
+@pytest.mark.parametrize("interval, start, aligned", [
+    (Interval.DAYS, date(2024, 6, 6), date(2024, 6, 6)),
+    (Interval.WEEKS, date(2024, 6, 6), date(2024, 6, 3)),
+    (Interval.WEEKS, date(2024, 6, 3), date(2024, 6, 3)),
+    (Interval.MONTHS, date(2024, 6, 30), date(2024, 6, 1)),
+    (Interval.QUARTER_HOURS, datetime(2024, 6, 6, 10, 14), datetime(2024, 6, 6, 10, 0)),
+    (Interval.HOURS, datetime(2024, 6, 6, 10, 59), datetime(2024, 6, 6, 10, 0)),
+])
+def test_start_is_aligned_to_its_bucket(interval, start, aligned):
+    assert make_series(start, interval, [1]).start.item() == aligned
+
+def test_weeks_and_months_are_dated_by_their_first_day():
+    weeks = CounterSeries.from_dates(np.array(["2024-06-05", "2024-06-19"], dtype="datetime64[D]"), [3, 5], Interval.WEEKS)
+    months = make_series(date(2023, 11, 15), Interval.MONTHS, [1, 2, 3, 4])
+
+    assert weeks.dates.tolist() == [date(2024, 6, 3), date(2024, 6, 17)]
+    assert weeks.values.tolist() == [3, MISSING_COUNT, 5]
+    assert months.dates.tolist() == [date(2023, 11, 1), date(2023, 12, 1), date(2024, 1, 1), date(2024, 2, 1)]
+    assert months.positions_of(date(2024, 2, 29)) == 3
+
+def test_count_for_needs_the_first_day_of_a_bucket():
+    weeks = make_series(date(2024, 6, 3), Interval.WEEKS, [10, MISSING_COUNT, 30])
+    months = make_series(date(2024, 1, 1), Interval.MONTHS, [100, 200])
+
+    assert weeks.count_for(date(2024, 6, 3)) == 10
+    assert weeks.count_for(date(2024, 6, 5)) is None
+    assert weeks.count_for(date(2024, 6, 10)) is None
+    assert weeks.count_for(date(2024, 6, 17)) == 30
+    assert weeks.count_for(date(2024, 6, 24)) is None
+    assert months.count_for(date(2024, 2, 1)) == 200
+    assert months.count_for(date(2024, 2, 15)) is None
+    assert months.count_for(date(2023, 12, 1)) is None
+
+def test_between_takes_whole_days_of_sub_daily_counts():
+    quarter_hours = make_series(datetime(2024, 6, 1, 23, 0), Interval.QUARTER_HOURS, list(range(4 + 96 + 4)))
+
+    day = quarter_hours.between(date(2024, 6, 2), date(2024, 6, 2))
+    assert (day.start.item(), len(day)) == (datetime(2024, 6, 2), 96)
+    assert day.counts.tolist() == list(range(4, 100))
+
+    until_noon = quarter_hours.between(date(2024, 6, 2), datetime(2024, 6, 2, 12, 0))
+    assert until_noon.end.item() == datetime(2024, 6, 2, 12, 0)
+    assert len(until_noon) == 49
+
+def test_between_starts_at_the_next_whole_bucket():
+    weeks = make_series(date(2024, 6, 3), Interval.WEEKS, [1, 2, 3, 4])
+
+    assert weeks.between(date(2024, 6, 5), date(2024, 6, 30)).dates.tolist() == [date(2024, 6, 10), date(2024, 6, 17), date(2024, 6, 24)]
+    assert len(weeks.between(date(2024, 7, 1), date(2024, 7, 31))) == 0
+
+@pytest.mark.parametrize("start, length, expected", [
+    # The grid begins before the series
+    (date(2024, 6, 1), 6, [MISSING_COUNT, MISSING_COUNT, 1, 2, 3, MISSING_COUNT]),
+    # The grid begins inside the series
+    (date(2024, 6, 4), 3, [2, 3, MISSING_COUNT]),
+    # The grid ends inside the series
+    (date(2024, 6, 2), 2, [MISSING_COUNT, 1]),
+    # The grid lies beyond the series
+    (date(2024, 6, 10), 2, [MISSING_COUNT, MISSING_COUNT]),
+])
+def test_reindex_places_values_at_their_offset(start, length, expected):
+    series = make_series(date(2024, 6, 3), Interval.DAYS, [1, 2, 3])
+
+    assert series.reindex(np.datetime64(start), length).tolist() == expected
+
+def test_indexing_and_slicing_skip_missing_intervals():
+    series = make_series(date(2024, 6, 1), Interval.DAYS, [1, MISSING_COUNT, 3, 4, MISSING_COUNT, 6])
+
+    assert len(series) == 4
+    assert dict(series[1]) == {"date": date(2024, 6, 3), "count": 3}
+    assert series[-1]["date"] == date(2024, 6, 6)
+    assert [point["count"] for point in series] == [1, 3, 4, 6]
+    assert [series[index]["count"] for index in range(len(series))] == [1, 3, 4, 6]
+
+    assert series[1:3].dates.tolist() == [date(2024, 6, 3), date(2024, 6, 4)]
+    assert series[::2].dates.tolist() == [date(2024, 6, 1), date(2024, 6, 4)]
+    assert series[::2].values.tolist() == [1, MISSING_COUNT, MISSING_COUNT, 4]
+    # A series stays in date order whatever the step
+    assert series[::-1].counts.tolist() == [1, 3, 4, 6]
+    assert len(series[10:]) == 0
+
+def test_data_point_view_only_has_a_date_and_count():
+    point = make_series(date(2024, 6, 1), Interval.DAYS, [5])[0]
+
+    assert list(point) == ["date", "count"]
+
+    with pytest.raises(KeyError):
+        point["counter"]
+
+def test_cumulative_skips_missing_intervals():
+    cumulative = make_series(date(2024, 6, 1), Interval.DAYS, [1, MISSING_COUNT, 2, 3, MISSING_COUNT]).cumulative()
+
+    assert cumulative.values.tolist() == [1, MISSING_COUNT, 3, 6, MISSING_COUNT]
+    assert cumulative.values.dtype == np.int64
+    assert cumulative[-1]["count"] == 6
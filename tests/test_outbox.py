@@ -0,0 +1,209 @@
+import sqlite3
+import pytest
+
+from datetime import date, datetime, timedelta
+
+from eco_counter_bot import bot, publisher as publisher_module
+from eco_counter_bot.config import config
+from eco_counter_bot.count_store import CountStore
+from eco_counter_bot.models import OutboxEntry, Publication, SinkConfig, TenantConfig
+from eco_counter_bot.publisher import Publisher
+from eco_counter_bot.sinks import ThreadSink
+from eco_counter_bot.utils import RateLimitedError
+
+DAY = date(2024, 6, 1)
+
+TENANT = TenantConfig(id="test", credentials_prefix="TEST_", sinks=[SinkConfig(type="thread")])
+
+class RecordingSink(ThreadSink):
+    """Posts into a list, optionally failing or hitting a rate limit before the post with a given index."""
+
+    def __init__(self, tenant: TenantConfig, sink_config: SinkConfig):
+        super().__init__(tenant, sink_config)
+        self.posts = []
+        self.uploads = 0
+        self.fail_at = None
+        self.rate_limited_at = None
+
+    def upload_media(self, filename: str, image: bytes) -> str or None:
+        self.uploads += 1
+        return f"media-{self.uploads}"
+
+    def post(self, text: str, media_ids: list[str] or None, reply_to: str or None, idempotency_key: str) -> str:
+        if self.fail_at == len(self.posts):
+            raise RuntimeError("HTTP 400")
+
+        if self.rate_limited_at == len(self.posts):
+            self.rate_limited_at = None
+            raise RateLimitedError(datetime.now() + timedelta(hours=1))
+
+        self.posts.append((text, media_ids, reply_to))
+        return f"post-{len(self.posts)}"
+
+def make_entry(day: date = DAY) -> OutboxEntry:
+    return OutboxEntry(
+        tenant_id=TENANT["id"], date=day, sink="thread", input_hash="input", output_hash="output",
+        parts=["first", "second", "third"], params={}, media_filename="chart.png", image=b"png",
+        media_id=None, media_uploaded_at=None, post_ids=[], not_before=None, attempts=0, last_error=None,
+        created_at=datetime(2024, 6, 2, 8)
+    )
+
+@pytest.fixture
+def store(monkeypatch) -> CountStore:
+    # Publications are only recorded outside development mode
+    monkeypatch.setitem(config, "DEV", False)
+
+    store = CountStore(":memory:")
+    monkeypatch.setattr(publisher_module, "get_count_store", lambda: store)
+    return store
+
+@pytest.fixture
+def sink(monkeypatch) -> RecordingSink:
+    sink = RecordingSink(TENANT, SinkConfig(type="thread"))
+    monkeypatch.setattr(publisher_module, "create_sinks", lambda tenant: [sink])
+    return sink
+
+def test_sent_entry_becomes_a_publication(store, sink):
+    publisher = Publisher()
+    publisher.enqueue(sink, make_entry())
+    publisher.drain()
+
+    assert sink.posts == [("first", ["media-1"], None), ("second", None, "post-1"), ("third", None, "post-2")]
+    assert store.get_outbox_entries() == []
+    assert store.get_publication(TENANT["id"], DAY)["post_ids"] == ["thread:post-1", "thread:post-2", "thread:post-3"]
+
+def test_long_rate_limit_leaves_entry_to_be_resumed_where_it_stopped(store, sink):
+    sink.rate_limited_at = 1
+
+    publisher = Publisher()
+    publisher.enqueue(sink, make_entry())
+    publisher.drain()
+
+    [entry] = store.get_outbox_entries()
+    assert entry["post_ids"] == ["post-1"]
+    assert entry["not_before"] > datetime.now()
+    assert store.get_publication(TENANT["id"], DAY) is None
+
+    # The limit has passed by the next run
+    entry["not_before"] = None
+    store.update_outbox_progress(entry)
+
+    publisher = Publisher()
+    publisher.resume([TENANT])
+    publisher.drain()
+
+    # The image is not uploaded again and the thread goes on from the first post
+    assert sink.uploads == 1
+    assert sink.posts[1:] == [("second", None, "post-1"), ("third", None, "post-2")]
+    assert store.get_outbox_entries() == []
+
+def test_failing_entry_is_parked_after_max_attempts(store, sink, monkeypatch):
+    monkeypatch.setattr(publisher_module, "MAX_ATTEMPTS", 2)
+    sink.fail_at = 0
+
+    publisher = Publisher()
+    publisher.enqueue(sink, make_entry())
+    publisher.drain()
+    publisher.resume([TENANT])
+    publisher.drain()
+
+    [entry] = store.get_outbox_entries()
+    assert entry["attempts"] == 2
+    assert entry["last_error"] == "HTTP 400"
+
+    publisher.resume([TENANT])
+    publisher.drain()
+
+    assert store.get_outbox_entries()[0]["attempts"] == 2
+
+def test_sender_survives_failing_to_save_a_failure(store, sink, monkeypatch):
+    sink.fail_at = 0
+
+    def fail_to_save(entry: OutboxEntry) -> None:
+        raise OSError("disk full")
+
+    publisher = Publisher()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(store, "update_outbox_progress", fail_to_save)
+        publisher.enqueue(sink, make_entry(DAY))
+        publisher.drain()
+
+    sink.fail_at = None
+    publisher.enqueue(sink, make_entry(DAY + timedelta(days=1)))
+    publisher.drain()
+
+    assert [entry["date"] for entry in store.get_outbox_entries()] == [DAY]
+    assert store.get_publication(TENANT["id"], DAY + timedelta(days=1)) is not None
+
+def test_resume_skips_tenants_whose_sinks_cannot_be_set_up(store, monkeypatch):
+    def create_sinks(tenant: TenantConfig):
+        raise KeyError("base_url")
+
+    monkeypatch.setattr(publisher_module, "create_sinks", create_sinks)
+    store.put_outbox_entry(make_entry())
+
+    publisher = Publisher()
+    publisher.resume([TENANT])
+    publisher.drain()
+
+    assert len(store.get_outbox_entries()) == 1
+
+def test_published_day_is_skipped_before_its_counts_are_awaited(store, monkeypatch):
+    def get_dataset_when_ready(tenant: TenantConfig, period, day: date):
+        raise AssertionError("counts awaited for a published day")
+
+    def load(tenant: TenantConfig, period):
+        raise RuntimeError("offline")
+
+    monkeypatch.setattr(bot, "get_count_store", lambda: store)
+    monkeypatch.setattr(bot, "today", lambda: DAY + timedelta(days=1))
+    monkeypatch.setattr(bot, "get_dataset_when_ready", get_dataset_when_ready)
+    monkeypatch.setattr(bot.ReportDataset, "load", load)
+
+    store.put_outbox_entry(make_entry())
+    store.complete_outbox_entry(make_entry(), Publication(
+        tenant_id=TENANT["id"], date=DAY, input_hash="input", output_hash="output", post_ids=["thread:post-1"], published_at=datetime(2024, 6, 2, 8)
+    ))
+
+    bot.publish_yesterdays_results(TENANT)
+
+    assert store.get_outbox_entries() == []
+
+OUTBOX_BEFORE_SINKS = """
+CREATE TABLE outbox (
+    tenant_id TEXT NOT NULL,
+    date TEXT NOT NULL,
+    credentials_prefix TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    output_hash TEXT NOT NULL,
+    parts TEXT NOT NULL,
+    media_filename TEXT NOT NULL,
+    image BLOB,
+    media_id TEXT,
+    media_uploaded_at TEXT,
+    post_ids TEXT NOT NULL,
+    not_before TEXT,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (tenant_id, date)
+);
+INSERT INTO outbox VALUES ('test', '2024-06-01', 'TEST_', 'input', 'output', '["first", "second"]', 'chart.png', X'00', 'media-1', '2024-06-02T08:00:00', '["post-1"]', NULL, 1, 'timeout', '2024-06-02T08:00:00');
+"""
+
+def test_outbox_from_before_sinks_is_migrated_to_twitter_entries(tmp_path):
+    path = tmp_path / "counts.sqlite"
+    connection = sqlite3.connect(path)
+    connection.executescript(OUTBOX_BEFORE_SINKS)
+    connection.close()
+
+    [entry] = CountStore(str(path)).get_outbox_entries()
+
+    assert entry["sink"] == "twitter"
+    assert entry["date"] == DAY
+    assert entry["parts"] == ["first", "second"]
+    assert entry["post_ids"] == ["post-1"]
+    assert entry["media_id"] == "media-1"
+    assert entry["attempts"] == 1
+    assert entry["params"] == {}
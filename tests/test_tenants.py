@@ -0,0 +1,46 @@
+import pytest
+
+from eco_counter_bot.config import config
+from eco_counter_bot.tenants import parse_tenant
+
+RAW_TENANT = {
+    "id": "test",
+    "organisation_id": 1,
+    "credentials_prefix": "TEST_",
+    "counters": [{"id": name, "name": name, "counter_id": 1, "flow_ids": [2]} for name in ("a", "b", "c")],
+}
+
+@pytest.fixture(autouse=True)
+def production_mode(monkeypatch):
+    # Development mode needs no credentials
+    monkeypatch.setitem(config, "DEV", False)
+
+@pytest.mark.parametrize("sink, error", [
+    ({"type": "mastodon"}, "needs a base_url"),
+    ({"type": "mastodon", "base_url": "https://mastodon.example"}, "needs TEST_MASTODON_ACCESS_TOKEN"),
+    ({"type": "webhook"}, "needs a url"),
+    ({"type": "twitter"}, "needs TEST_TWITTER_API_KEY"),
+    ({"type": "carrier_pigeon"}, "unknown type"),
+])
+def test_incomplete_sinks_are_rejected(sink, error):
+    with pytest.raises(ValueError, match=error):
+        parse_tenant({**RAW_TENANT, "sinks": [sink]})
+
+def test_complete_sinks_are_accepted(monkeypatch):
+    monkeypatch.setitem(config, "TEST_MASTODON_ACCESS_TOKEN", "token")
+
+    tenant = parse_tenant({**RAW_TENANT, "sinks": [
+        {"type": "mastodon", "base_url": "https://mastodon.example"},
+        {"type": "webhook", "url": "https://example.com/hook"},
+        {"type": "static"},
+    ]})
+
+    assert [sink["type"] for sink in tenant["sinks"]] == ["mastodon", "webhook", "static"]
+
+def test_sink_names_must_be_unique():
+    with pytest.raises(ValueError, match="distinct names"):
+        parse_tenant({**RAW_TENANT, "sinks": [{"type": "static"}, {"type": "static", "output_dir": "elsewhere"}]})
+
+def test_tenants_need_three_counters():
+    with pytest.raises(ValueError, match="at least 3"):
+        parse_tenant({**RAW_TENANT, "counters": RAW_TENANT["counters"][:2]})